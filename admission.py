@@ -0,0 +1,185 @@
+import math
+import os
+import threading
+import zlib
+from PIL import Image
+from PyPDF2 import PdfReader
+from PyPDF2.generic import ArrayObject, IndirectObject
+from image_encoding import MAX_IMAGE_PIXELS, check_image_size
+
+# Stamping work allowed in flight per process, in cost units: one per PDF
+# page or image megapixel, which take about as long to stamp as each other
+ADMISSION_CAPACITY = int(os.getenv('ADMISSION_CAPACITY', 1000))
+# Fraction of the capacity one client may hold; beyond it requests get HTTP 429
+ADMISSION_CLIENT_SHARE = float(os.getenv('ADMISSION_CLIENT_SHARE', 0.5))
+# How long a request waits for capacity before it gets HTTP 503
+ADMISSION_WAIT_SECONDS = float(os.getenv('ADMISSION_WAIT_SECONDS', 1))
+# Retry-After sent with 429 and 503 responses
+ADMISSION_RETRY_AFTER_SECONDS = int(os.getenv('ADMISSION_RETRY_AFTER_SECONDS', 5))
+# PDFs with more pages than this are refused
+MAX_PDF_PAGES = int(os.getenv('MAX_PDF_PAGES', 10000))
+# PDFs with a page whose content streams decompress to more than this are refused
+MAX_PDF_PAGE_CONTENT_BYTES = int(os.getenv('MAX_PDF_PAGE_CONTENT_BYTES', 64 * 1024 * 1024))
+
+
+class InputTooLarge(Exception):
+    """A document or image is too large to be stamped at all."""
+
+
+class Saturated(Exception):
+    """There is no capacity for a request now; ``status`` is 429 or 503."""
+
+    def __init__(self, message, status):
+        super().__init__(message)
+        self.status = status
+
+
+def _decoded_size(stream, limit):
+    """The size of a stream's data once decompressed, counting no further than ``limit``."""
+    data = stream._data
+    filters = stream.get('/Filter')
+    if isinstance(filters, ArrayObject):
+        filters = filters[0] if filters else None
+    if filters not in ('/FlateDecode', '/Fl'):
+        return len(data)
+    inflater = zlib.decompressobj()
+    size = 0
+    try:
+        while data and size <= limit:
+            size += len(inflater.decompress(data, limit + 1 - size))
+            data = inflater.unconsumed_tail
+    except zlib.error:
+        pass
+    return size
+
+
+def _check_page(page):
+    """Raise InputTooLarge if a page's content would decompress to more than
+    MAX_PDF_PAGE_CONTENT_BYTES or it draws an image over MAX_IMAGE_PIXELS."""
+    contents = page.get('/Contents')
+    streams = contents if isinstance(contents, ArrayObject) else [contents] if contents is not None else []
+    size = 0
+    for stream in streams:
+        size += _decoded_size(stream.get_object(), MAX_PDF_PAGE_CONTENT_BYTES - size)
+        if size > MAX_PDF_PAGE_CONTENT_BYTES:
+            raise InputTooLarge(f'PDF page content is larger than the limit of {MAX_PDF_PAGE_CONTENT_BYTES} bytes')
+    resources = page.get('/Resources')
+    xobjects = resources.get('/XObject') if resources is not None else None
+    for xobject in (xobjects or {}).values():
+        xobject = xobject.get_object()
+        if xobject.get('/Subtype') == '/Image':
+            width, height = int(xobject.get('/Width', 0)), int(xobject.get('/Height', 0))
+            if width * height > MAX_IMAGE_PIXELS:
+                raise InputTooLarge(f'PDF image of {width}x{height} pixels is larger than the limit of '
+                                    f'{MAX_IMAGE_PIXELS} pixels')
+
+
+def count_pdf_pages(reader, limit=None):
+    """Count and check the pages of a PDF by walking its page tree.
+
+    The /Count the tree declares is not trusted, since stamping walks the
+    tree itself. Raises InputTooLarge once there are more than ``limit``
+    pages, or for a page that fails _check_page().
+    """
+    limit = MAX_PDF_PAGES if limit is None else limit
+    count = 0
+    seen = set()
+    stack = [reader.trailer['/Root'].raw_get('/Pages')]
+    while stack:
+        node = stack.pop()
+        if isinstance(node, IndirectObject):
+            # Reference cycles would otherwise never end
+            if (node.idnum, node.generation) in seen:
+                continue
+            seen.add((node.idnum, node.generation))
+        node = node.get_object()
+        if '/Kids' in node:
+            # Reversed so pages are visited in document order
+            stack.extend(reversed(node['/Kids']))
+            continue
+        count += 1
+        if count > limit:
+            raise InputTooLarge(f'PDF has more than the limit of {limit} pages')
+        _check_page(node)
+    return count
+
+
+def estimate_cost(file, extension):
+    """Estimate the cost of stamping ``file`` without decoding it.
+
+    PDFs cost their page count, found by walking the page tree (see
+    count_pdf_pages), and images their megapixels, read from the image
+    header. Raises InputTooLarge for PDFs over MAX_PDF_PAGES or with pages
+    too large to stamp, and images over MAX_IMAGE_PIXELS. Files that can't
+    be read cost 1 and are left for the stamp function to report.
+    """
+    try:
+        file.seek(0)
+        if extension == 'pdf':
+            return max(1, count_pdf_pages(PdfReader(file, strict=False)))
+        with Image.open(file) as image:
+            check_image_size(image)
+            return max(1, math.ceil(image.width * image.height / 1_000_000))
+    except Image.DecompressionBombError as e:
+        raise InputTooLarge(str(e))
+    except InputTooLarge:
+        raise
+    except Exception:
+        return 1
+    finally:
+        file.seek(0)
+
+
+class WorkLimiter:
+    """A semaphore over the estimated cost of the stamping in flight.
+
+    A request holds its cost while it is stamped. Requests that would take
+    a client past ``client_share`` of the capacity are refused with 429, and
+    requests that can't get their cost within the wait time with 503. A
+    request costing more than the whole capacity waits for all of it.
+    """
+
+    def __init__(self, capacity=ADMISSION_CAPACITY, client_share=ADMISSION_CLIENT_SHARE):
+        self.capacity = capacity
+        self.client_share = client_share
+        self.in_use = 0
+        self._clients = {}
+        self._condition = threading.Condition()
+        self._stats = {'admitted': 0, 'throttled': 0, 'saturated': 0}
+
+    def acquire(self, cost, client=None, timeout=ADMISSION_WAIT_SECONDS):
+        """Take ``cost`` units, waiting up to ``timeout`` seconds (None: no
+        limit). Returns the units taken, to give back with release()."""
+        cost = max(1, min(cost, self.capacity))
+        with self._condition:
+            held = self._clients.get(client, 0)
+            # A client with nothing in flight is never throttled, however large its request
+            if client is not None and held and held + cost > self.capacity * self.client_share:
+                self._stats['throttled'] += 1
+                raise Saturated('Too many requests in progress for this client, try again later', 429)
+            if not self._condition.wait_for(lambda: self.in_use + cost <= self.capacity, timeout):
+                self._stats['saturated'] += 1
+                raise Saturated('The server is busy, try again later', 503)
+            self.in_use += cost
+            if client is not None:
+                self._clients[client] = self._clients.get(client, 0) + cost
+            self._stats['admitted'] += 1
+        return cost
+
+    def release(self, cost, client=None):
+        with self._condition:
+            self.in_use -= cost
+            if client is not None:
+                remaining = self._clients.get(client, 0) - cost
+                if remaining > 0:
+                    self._clients[client] = remaining
+                else:
+                    self._clients.pop(client, None)
+            self._condition.notify_all()
+
+    def stats(self):
+        with self._condition:
+            return dict(self._stats, in_use=self.in_use, capacity=self.capacity)
+
+
+work_limiter = WorkLimiter()
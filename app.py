@@ -1,11 +1,38 @@
 import os
 import io
+import time
 import base64
-import logging
+import shutil
+import uuid
+import unicodedata
+import zipfile
+from urllib.parse import quote
 from dotenv import load_dotenv
-from flask import Flask, request, jsonify, render_template, url_for, send_from_directory
+from itertools import chain
+from flask import (Flask, Response, g, request, jsonify, render_template, url_for, send_file, send_from_directory,
+                   stream_with_context)
 from flasgger import Swagger, swag_from
-from stamp import stamp_pdf, stamp_image, stamp_pdf_with_image, stamp_image_with_image
+from werkzeug.datastructures import FileStorage, Headers
+from werkzeug.middleware.proxy_fix import ProxyFix
+from PIL import Image, UnidentifiedImageError
+from stamp import (stamp_pdf, stamp_image, stamp_pdf_with_image, stamp_image_with_image, stamp_asset_cache,
+                   PageSelection, warm_up)
+from stamp_templates import register_template, get_template, delete_template, preload_templates, template_cache
+from fonts import font_registry
+from layout import wrap_text
+from image_encoding import EncodeOptions, max_dimension_option
+from batch import (BATCH_MAX_DOCUMENTS, check_documents, read_archive, read_upload, run_batch,
+                   write_batch_archive)
+from jobs import job_queue
+from admission import (ADMISSION_RETRY_AFTER_SECONDS, InputTooLarge, Saturated, estimate_cost,
+                       work_limiter)
+from storage import storage, ttl_option
+from expiry import expiry_scheduler
+from results import content_hash, find_result, result_key, store_result, stats as result_stats
+from metrics import Collected, recording, registry, request_seconds, requests_in_flight
+import audit
+from streaming import StreamingOutput
+from uploads import MAX_REQUEST_BYTES, RAW_UPLOAD_MIMETYPES, new_spool, spool_base64, spool_stream
 
 # Load environment variables from .env file
 load_dotenv()
@@ -14,14 +41,55 @@ load_dotenv()
 base_url = os.getenv('BASE_URL', 'localhost:5000')
 
 app = Flask(__name__)
+# Number of proxies in front of the app whose X-Forwarded-For is trusted for
+# the client address admission control shares capacity by. Off by default,
+# since without a proxy a client could set the header to any address
+TRUSTED_PROXIES = int(os.getenv('TRUSTED_PROXIES', 0))
+if TRUSTED_PROXIES:
+    app.wsgi_app = ProxyFix(app.wsgi_app, x_for=TRUSTED_PROXIES)
+# Oversized requests are refused from their Content-Length, before any buffering
+app.config['MAX_CONTENT_LENGTH'] = MAX_REQUEST_BYTES
 
-# Ensure the 'downloads' directory exists
-if not os.path.exists('downloads'):
-    os.makedirs('downloads')
+# Whether the Swagger UI is served at /apidocs/
+SWAGGER_ENABLED = os.getenv('SWAGGER_ENABLED', '1').lower() in ('1', 'true', 'yes')
 
+# Configure logging: JSON lines written by a background thread, so requests never wait for the log file
+audit.install()
+# Load the shipped fonts once, before any request needs them
+font_registry.preload()
 
-# Configure logging
-logging.basicConfig(filename='stamping.log', level=logging.INFO, format='%(asctime)s - %(message)s')
+
+@app.before_request
+def start_background_threads():
+    # Started by the first request rather than at import, so each server
+    # process (including forked workers) runs its own expiry thread and
+    # saves its own metrics
+    expiry_scheduler.start()
+    registry.start()
+
+
+@app.before_request
+def start_timer():
+    g.request_start = time.perf_counter()
+    # A request ID sent by a proxy is kept, so log entries can be matched up
+    g.request_id = request.headers.get('X-Request-ID', '')[:64] or uuid.uuid4().hex
+    requests_in_flight.inc()
+
+
+@app.after_request
+def record_request_time(response):
+    # Streamed responses are timed up to their first byte
+    if 'request_start' in g:
+        request_seconds.observe(time.perf_counter() - g.request_start, request.endpoint or 'unknown',
+                                str(response.status_code))
+        response.headers['X-Request-ID'] = g.request_id
+    return response
+
+
+@app.teardown_request
+def finish_request(error=None):
+    if 'request_start' in g:
+        requests_in_flight.dec()
 
 
 def decode_base64(data):
@@ -32,8 +100,293 @@ def decode_base64(data):
     return base64.b64decode(data)
 
 
-def log_stamp_activity(file_name):
-    logging.info(f'File stamped: {file_name}')
+def is_raw_upload():
+    """Whether the request body is the document itself rather than a form or JSON."""
+    return request.mimetype in RAW_UPLOAD_MIMETYPES
+
+
+def name_upload(file, default_name):
+    """Give a decoded upload a file name matching its detected type."""
+    file.filename = f'{default_name}.{get_file_extension(file.read(8))}'
+    file.seek(0)
+    return file
+
+
+def raw_upload():
+    """Spool a raw request body, base64-decoding it if the client says it is encoded."""
+    base64_encoded = request.headers.get('Content-Transfer-Encoding', '').lower() == 'base64'
+    return name_upload(spool_stream(request.stream, base64_encoded), 'uploaded_file')
+
+
+def base64_upload(data, default_name):
+    """Decode a base64 JSON field into a spooled file."""
+    return name_upload(spool_base64(data), default_name)
+
+
+def page_selection():
+    """Parse the optional ``pages`` option into a PageSelection."""
+    spec = request_option('pages')
+    return PageSelection(spec) if spec else None
+
+
+def font_option(file_ext, template=None):
+    """Resolve the font for a stamp on a ``file_ext`` file.
+
+    A template's font takes precedence over the ``font`` option. Raises
+    ValueError for unknown fonts and fonts that can't be used in PDFs.
+    """
+    context_type = 'pdf' if file_ext == 'pdf' else 'image'
+    if template is not None:
+        return font_registry.get(template.font.name, context_type).name
+    font = request_option('font')
+    return font_registry.get(font, context_type).name if font else None
+
+
+def raster_options():
+    """Read the image-only options: how stamped images are encoded (encoding,
+    quality, compression, progressive) and the size they are scaled down to
+    (max_dimension, preview)."""
+    progressive = request_flag('progressive') if request_option('progressive') is not None else None
+    encoding = EncodeOptions(request_option('encoding'), request_option('quality'), request_option('compression'),
+                             progressive)
+    max_dimension = max_dimension_option(request_option('max_dimension'), request_flag('preview'))
+    return {'encoding': encoding, 'max_dimension': max_dimension}
+
+
+def raw_upload_needs_template_response():
+    return jsonify({'status': 'fail', 'message': 'Raw uploads must reference a stamp template with template_id'}), 400
+
+
+def upload_size(file):
+    position = file.tell()
+    size = file.seek(0, os.SEEK_END)
+    file.seek(position)
+    return size
+
+
+def audited(stamp_function, file, request_id, mode):
+    """Wrap ``stamp_function`` to write an audit log entry for each call.
+
+    The entry has the input's hash and size, the page or pixel count, the
+    output's name and size, and the time taken in total and per stage.
+    """
+    def run(*args, **kwargs):
+        record = {}
+        start = time.perf_counter()
+        output_path = None
+        error = None
+        try:
+            with recording(record):
+                output_path = stamp_function(file, *args, **kwargs)
+            return output_path
+        except Exception as e:
+            error = str(e) or e.__class__.__name__
+            raise
+        finally:
+            output = kwargs.get('output')
+            if output is not None:
+                bytes_out = output.tell()
+            elif output_path is not None:
+                bytes_out = storage.size(output_path)
+            else:
+                bytes_out = None
+            log_stamp_activity(request_id, stamp_function.__name__, mode, file, output=output_path,
+                               bytes_out=bytes_out, error=error, elapsed=time.perf_counter() - start, **record)
+    return run
+
+
+def log_stamp_activity(request_id, stamp_type, mode, file=None, elapsed=None, stages=None, error=None, **fields):
+    """Write a stamp event to the audit log."""
+    if file is not None:
+        fields.update(input_sha256=content_hash(file), bytes_in=upload_size(file))
+    if elapsed is not None:
+        fields['elapsed'] = round(elapsed, 6)
+    if stages:
+        fields['stages'] = {name: round(seconds, 6) for name, seconds in stages.items()}
+    audit.audit('stamp', request_id=request_id, stamp_type=stamp_type, mode=mode,
+                status='fail' if error else 'success', error=error, **fields)
+
+
+def request_option(name):
+    """Read a string option from the query string, JSON body or form."""
+    value = request.args.get(name)
+    if value is None:
+        value = request.get_json().get(name) if request.is_json else request.form.get(name)
+    return value
+
+
+def request_flag(name):
+    """Read a boolean option from the query string, JSON body or form."""
+    return str(request_option(name)).lower() in ('1', 'true', 'yes')
+
+
+def wants_async():
+    """Whether the client asked for the job to run in the background (?async=1)."""
+    return request_flag('async')
+
+
+OUTPUT_MIMETYPES = {
+    'pdf': 'application/pdf',
+    'png': 'image/png',
+    'jpg': 'image/jpeg',
+    'jpeg': 'image/jpeg',
+}
+
+
+def wants_inline(mimetype):
+    """Whether the stamped file should be sent back in this response.
+
+    Clients opt in with ?inline=1 or by preferring the file's type over JSON
+    in their Accept header.
+    """
+    if request_flag('inline'):
+        return True
+    return request.accept_mimetypes.best_match(['application/json', mimetype]) == mimetype
+
+
+def inline_response(stamp_function, file, mimetype, cost, *args, **kwargs):
+    """Stream the stamped file straight back without touching downloads/."""
+    client = request.remote_addr
+    try:
+        held = work_limiter.acquire(cost, client)
+    except Saturated as e:
+        return saturated_response(e)
+
+    output = StreamingOutput()
+    stamp = audited(stamp_function, file, g.request_id, 'inline')
+
+    def write(output_file):
+        # Capacity is held until the file has been written, not just until the response starts
+        try:
+            stamp(*args, output=output_file, **kwargs)
+        finally:
+            work_limiter.release(held, client)
+
+    output.start(write)
+
+    # Wait for the first chunk so stamping errors still get an error response
+    chunks = output.chunks()
+    first_chunk = next(chunks, b'')
+
+    headers = Headers()
+    headers.set('Content-Disposition', 'inline', **download_names(f'stamped_{os.path.basename(file.filename)}'))
+    return Response(stream_with_context(chain([first_chunk], chunks)), mimetype=mimetype, headers=headers)
+
+
+def download_names(filename):
+    """Content-Disposition parameters for ``filename``, quoted as send_file
+    does: names that aren't ASCII get an ASCII ``filename`` and the full
+    name as ``filename*``."""
+    try:
+        filename.encode('ascii')
+    except UnicodeEncodeError:
+        simple = unicodedata.normalize('NFKD', filename).encode('ascii', 'ignore').decode('ascii')
+        return {'filename': simple, 'filename*': f"UTF-8''{quote(filename, safe='!#$&+-.^_`|~')}"}
+    return {'filename': filename}
+
+
+def detach_upload(file):
+    """Copy a multipart upload into a spool so it outlives the request that received it."""
+    if not isinstance(file, FileStorage):
+        return file
+    detached = new_spool()
+    shutil.copyfileobj(file.stream, detached)
+    detached.seek(0)
+    detached.filename = file.filename
+    detached.content_hash = getattr(file, 'content_hash', None)
+    return detached
+
+
+def stamped_response(stamp_function, file, *args, **kwargs):
+    """Run a stamp function and respond with the download link.
+
+    In async mode the work is queued instead and the response carries the job
+    ID to poll at /api/jobs/<job_id>, and in inline mode the stamped file
+    itself is streamed back as the response body.
+    """
+    # Inputs too large to stamp are refused before anything is decoded
+    try:
+        cost = request_cost(file, args)
+    except InputTooLarge as e:
+        return jsonify({'status': 'fail', 'message': str(e)}), 413
+
+    mimetype = OUTPUT_MIMETYPES.get(file.filename.split('.')[-1].lower())
+    if mimetype is not None and not wants_async() and wants_inline(mimetype):
+        return inline_response(stamp_function, file, mimetype, cost, *args, **kwargs)
+
+    try:
+        kwargs['ttl'] = ttl_option(request_option('ttl'))
+    except ValueError as e:
+        return jsonify({'status': 'fail', 'message': str(e)}), 400
+
+    # Identical requests (retries, resubmissions) get the file stamped the first time
+    key = result_key(stamp_function, file, args, kwargs)
+
+    if not wants_async():
+        output_path = find_result(key, kwargs['ttl'])
+        if output_path is None:
+            client = request.remote_addr
+            try:
+                held = work_limiter.acquire(cost, client)
+            except Saturated as e:
+                return saturated_response(e)
+            try:
+                output_path = audited(stamp_function, file, g.request_id, 'sync')(*args, **kwargs)
+            finally:
+                work_limiter.release(held, client)
+            store_result(key, output_path)
+        else:
+            log_stamp_activity(g.request_id, stamp_function.__name__, 'sync', file, output=output_path, cached=True)
+        return jsonify({
+            'status': 'success',
+            'download_link': url_for('download_file', filename=output_path, _external=True)
+        })
+
+    file = detach_upload(file)
+    args = [detach_upload(arg) if hasattr(arg, 'read') else arg for arg in args]
+    stamp = audited(stamp_function, file, g.request_id, 'async')
+
+    def work(progress):
+        # Queued jobs wait for capacity instead of being refused
+        held = work_limiter.acquire(cost, timeout=None)
+        try:
+            output_path = stamp(*args, progress=progress, **kwargs)
+        finally:
+            work_limiter.release(held)
+        store_result(key, output_path)
+        return output_path
+
+    job = job_queue.submit(work)
+    if job is None:
+        response = jsonify({'status': 'fail', 'message': 'Too many queued jobs, try again later'})
+        response.headers['Retry-After'] = '5'
+        return response, 503
+
+    return jsonify({
+        'status': 'accepted',
+        'job_id': job.job_id,
+        'status_link': url_for('job_status', job_id=job.job_id, _external=True)
+    }), 202
+
+
+def request_cost(file, args):
+    """Estimated cost of stamping ``file`` and any stamp image in ``args``.
+    Raises InputTooLarge."""
+    cost = estimate_cost(file, file.filename.split('.')[-1].lower())
+    for arg in args:
+        if hasattr(arg, 'read'):
+            cost += estimate_cost(arg, 'image')
+    return cost
+
+
+def saturated_response(error):
+    response = jsonify({'status': 'fail', 'message': str(error)})
+    response.headers['Retry-After'] = str(ADMISSION_RETRY_AFTER_SECONDS)
+    return response, error.status
+
+
+def unknown_template_response():
+    return jsonify({'status': 'fail', 'message': 'Unknown stamp template'}), 404
 
 
 # Get file ext.
@@ -85,11 +438,23 @@ template = {
         {
             "name": "Stamping",
             "description": "Operations related to stamping text/images/text & images on documents and images"
+        },
+        {
+            "name": "Templates",
+            "description": "Register stamp images once and reference them by ID when stamping"
+        },
+        {
+            "name": "Fonts",
+            "description": "Fonts available for stamp text"
+        },
+        {
+            "name": "Monitoring",
+            "description": "Operational statistics for the stamping service"
         }
     ]
 }
 
-swagger = Swagger(app, config=swagger_config, template=template)
+swagger = Swagger(app, config=swagger_config, template=template) if SWAGGER_ENABLED else None
 
 
 # Serve custom CSS and JavaScript
@@ -105,6 +470,8 @@ def home():
 
 @app.route('/apidocs/')
 def api_docs():
+    if swagger is None:
+        return jsonify({'status': 'fail', 'message': 'API documentation is disabled'}), 404
     return render_template('swagger_ui.html')
 
 
@@ -113,7 +480,10 @@ def api_docs():
     'tags': ['Stamping'],
     'consumes': [
         'multipart/form-data',
-        'application/json'
+        'application/json',
+        'application/pdf',
+        'image/png',
+        'image/jpeg'
     ],
     'parameters': [
         {
@@ -137,6 +507,101 @@ def api_docs():
             'required': False,
             'description': 'Position to affix the stamp (top, center, bottom, right, left)'
         },
+        {
+            'name': 'font',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'Font for the stamp text, e.g. helvetica, helvetica-bold, helvetica-oblique '
+                           '(see /api/fonts; default: helvetica)'
+        },
+        {
+            'name': 'encoding',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'For images, fast (quicker, larger output), balanced (default) or small '
+                           '(slower, smaller output)'
+        },
+        {
+            'name': 'quality',
+            'in': 'formData',
+            'type': 'integer',
+            'required': False,
+            'description': 'For JPEGs, the output quality from 1 to 95 (default: the quality of the upload)'
+        },
+        {
+            'name': 'compression',
+            'in': 'formData',
+            'type': 'integer',
+            'required': False,
+            'description': 'For PNGs, the zlib compression level from 0 to 9 (overrides encoding)'
+        },
+        {
+            'name': 'progressive',
+            'in': 'formData',
+            'type': 'boolean',
+            'required': False,
+            'description': 'For JPEGs, whether to write a progressive JPEG'
+        },
+        {
+            'name': 'max_dimension',
+            'in': 'formData',
+            'type': 'integer',
+            'required': False,
+            'description': 'For images, scale the image down to fit within this many pixels before stamping'
+        },
+        {
+            'name': 'preview',
+            'in': 'formData',
+            'type': 'boolean',
+            'required': False,
+            'description': 'For images, stamp a reduced-size preview (max_dimension defaults to 1024)'
+        },
+        {
+            'name': 'ttl',
+            'in': 'formData',
+            'type': 'integer',
+            'required': False,
+            'description': 'Seconds the stamped file stays downloadable (default: 86400)'
+        },
+        {
+            'name': 'pages',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'For PDFs, the pages to stamp: page numbers and ranges such as 1-3,7 or 10-, '
+                           'or first, last, odd, even, all (default: all)'
+        },
+        {
+            'name': 'incremental',
+            'in': 'query',
+            'type': 'boolean',
+            'required': False,
+            'description': 'For PDFs, append the stamp as an incremental update instead of rewriting the file '
+                           '(keeps existing digital signatures valid)'
+        },
+        {
+            'name': 'inline',
+            'in': 'query',
+            'type': 'boolean',
+            'required': False,
+            'description': 'Return the stamped file in the response body instead of a download link'
+        },
+        {
+            'name': 'async',
+            'in': 'query',
+            'type': 'boolean',
+            'required': False,
+            'description': 'Queue the job and return a job ID to poll at /api/jobs/<job_id> instead of waiting'
+        },
+        {
+            'name': 'template_id',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'ID of a registered stamp template to use instead of uploading a stamp'
+        },
         {
             'name': 'body',
             'in': 'body',
@@ -153,9 +618,17 @@ def api_docs():
                         'type': 'string',
                         'description': 'Text to be used as stamp'
                     },
+                    'template_id': {
+                        'type': 'string',
+                        'description': 'ID of a registered stamp template to use instead of uploading a stamp'
+                    },
                     'position': {
                         'type': 'string',
                         'description': 'Position to affix the stamp (top, center, bottom, right, left)'
+                    },
+                    'font': {
+                        'type': 'string',
+                        'description': 'Font for the stamp text (see /api/fonts; default: helvetica)'
                     }
                 }
             }
@@ -183,37 +656,48 @@ def api_docs():
     }
 })
 def stamp_document_text_only():
-    if request.is_json:
+    if is_raw_upload():
+        file = raw_upload()
+        stamp_text = request.args.get('stamp')
+        position = request.args.get('position')
+        template_id = request.args.get('template_id')
+    elif request.is_json:
         data = request.get_json()
-        file_data = data.get('file')
-        file_bytes = decode_base64(file_data)
-        file_extension = get_file_extension(file_bytes)
-        file = io.BytesIO(file_bytes)
-        # Set a default name
-        file.filename = f'uploaded_file.{file_extension}'
-        stamp_text = data.get('stamp', 'CONFIDENTIAL')
-        position = data.get('position', 'center')
+        file = base64_upload(data.get('file'), 'uploaded_file')
+        stamp_text = data.get('stamp')
+        position = data.get('position')
+        template_id = data.get('template_id')
     else:
         file = request.files['file']
-        stamp_text = request.form.get('stamp', 'CONFIDENTIAL')
-        position = request.form.get('position', 'center')
+        stamp_text = request.form.get('stamp')
+        position = request.form.get('position')
+        template_id = request.form.get('template_id')
+
+    template = None
+    if template_id:
+        template = get_template(template_id)
+        if template is None:
+            return unknown_template_response()
+        stamp_text = stamp_text or template.signer_text
+        position = position or template.position
+
+    stamp_text = stamp_text or 'CONFIDENTIAL'
+    position = position or 'center'
 
     file_ext = file.filename.split('.')[-1].lower()
 
+    try:
+        pages = page_selection()
+        font = font_option(file_ext, template)
+        raster = raster_options()
+    except ValueError as e:
+        return jsonify({'status': 'fail', 'message': str(e)}), 400
+
     if file_ext in ['pdf']:
-        output_path = stamp_pdf(file, stamp_text, position)
-        log_stamp_activity(output_path)
-        return jsonify({
-            'status': 'success',
-            'download_link': url_for('download_file', filename=output_path, _external=True)
-        })
+        return stamped_response(stamp_pdf, file, stamp_text, position, incremental=request_flag('incremental'),
+                                pages=pages, font=font)
     elif file_ext in ['png', 'jpg', 'jpeg']:
-        output_path = stamp_image(file, stamp_text, position)
-        log_stamp_activity(output_path)
-        return jsonify({
-            'status': 'success',
-            'download_link': url_for('download_file', filename=output_path, _external=True)
-        })
+        return stamped_response(stamp_image, file, stamp_text, position, font=font, **raster)
     else:
         return jsonify({'status': 'fail', 'message': 'Unsupported file type'}), 400
 
@@ -223,7 +707,10 @@ def stamp_document_text_only():
     'tags': ['Stamping'],
     'consumes': [
         'multipart/form-data',
-        'application/json'
+        'application/json',
+        'application/pdf',
+        'image/png',
+        'image/jpeg'
     ],
     'parameters': [
         {
@@ -237,8 +724,8 @@ def stamp_document_text_only():
             'name': 'stamp_image',
             'in': 'formData',
             'type': 'file',
-            'required': True,
-            'description': 'Image file to be used as stamp'
+            'required': False,
+            'description': 'Image file to be used as stamp (required unless template_id is given)'
         },
         {
             'name': 'position',
@@ -247,6 +734,101 @@ def stamp_document_text_only():
             'required': False,
             'description': 'Position to affix the stamp (top, center, bottom, right, left)'
         },
+        {
+            'name': 'font',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'Font for the stamp text, e.g. helvetica, helvetica-bold, helvetica-oblique '
+                           '(see /api/fonts; default: helvetica)'
+        },
+        {
+            'name': 'encoding',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'For images, fast (quicker, larger output), balanced (default) or small '
+                           '(slower, smaller output)'
+        },
+        {
+            'name': 'quality',
+            'in': 'formData',
+            'type': 'integer',
+            'required': False,
+            'description': 'For JPEGs, the output quality from 1 to 95 (default: the quality of the upload)'
+        },
+        {
+            'name': 'compression',
+            'in': 'formData',
+            'type': 'integer',
+            'required': False,
+            'description': 'For PNGs, the zlib compression level from 0 to 9 (overrides encoding)'
+        },
+        {
+            'name': 'progressive',
+            'in': 'formData',
+            'type': 'boolean',
+            'required': False,
+            'description': 'For JPEGs, whether to write a progressive JPEG'
+        },
+        {
+            'name': 'max_dimension',
+            'in': 'formData',
+            'type': 'integer',
+            'required': False,
+            'description': 'For images, scale the image down to fit within this many pixels before stamping'
+        },
+        {
+            'name': 'preview',
+            'in': 'formData',
+            'type': 'boolean',
+            'required': False,
+            'description': 'For images, stamp a reduced-size preview (max_dimension defaults to 1024)'
+        },
+        {
+            'name': 'ttl',
+            'in': 'formData',
+            'type': 'integer',
+            'required': False,
+            'description': 'Seconds the stamped file stays downloadable (default: 86400)'
+        },
+        {
+            'name': 'pages',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'For PDFs, the pages to stamp: page numbers and ranges such as 1-3,7 or 10-, '
+                           'or first, last, odd, even, all (default: all)'
+        },
+        {
+            'name': 'incremental',
+            'in': 'query',
+            'type': 'boolean',
+            'required': False,
+            'description': 'For PDFs, append the stamp as an incremental update instead of rewriting the file '
+                           '(keeps existing digital signatures valid)'
+        },
+        {
+            'name': 'inline',
+            'in': 'query',
+            'type': 'boolean',
+            'required': False,
+            'description': 'Return the stamped file in the response body instead of a download link'
+        },
+        {
+            'name': 'async',
+            'in': 'query',
+            'type': 'boolean',
+            'required': False,
+            'description': 'Queue the job and return a job ID to poll at /api/jobs/<job_id> instead of waiting'
+        },
+        {
+            'name': 'template_id',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'ID of a registered stamp template to use instead of uploading a stamp'
+        },
         {
             'name': 'body',
             'in': 'body',
@@ -264,9 +846,17 @@ def stamp_document_text_only():
                         'format': 'binary',
                         'description': 'Image file to be used as stamp'
                     },
+                    'template_id': {
+                        'type': 'string',
+                        'description': 'ID of a registered stamp template to use instead of uploading a stamp'
+                    },
                     'position': {
                         'type': 'string',
                         'description': 'Position to affix the stamp (top, center, bottom, right, left)'
+                    },
+                    'font': {
+                        'type': 'string',
+                        'description': 'Font for the stamp text (see /api/fonts; default: helvetica)'
                     }
                 }
             }
@@ -294,41 +884,51 @@ def stamp_document_text_only():
     }
 })
 def stamp_document_image():
-    if request.is_json:
+    if is_raw_upload():
+        template_id = request.args.get('template_id')
+        if not template_id:
+            return raw_upload_needs_template_response()
+        file = raw_upload()
+        position = request.args.get('position')
+    elif request.is_json:
         data = request.get_json()
-        file_data = data.get('file')
-        file_bytes = decode_base64(file_data)
-        file_extension = get_file_extension(file_bytes)
-        file = io.BytesIO(file_bytes)
-        # Set a default name
-        file.filename = f'uploaded_file.{file_extension}'
-        stamp_image_data = data.get('stamp_image')
-        stamp_image_file_bytes = decode_base64(stamp_image_data)
-        stamp_image_file_ext = get_file_extension(stamp_image_file_bytes)
-        stamp_image_file = io.BytesIO(stamp_image_file_bytes)
-        stamp_image_file.filename = f'uploaded_file_2.{stamp_image_file_ext}'
-        position = data.get('position', 'center')
+        file = base64_upload(data.get('file'), 'uploaded_file')
+        template_id = data.get('template_id')
+        if not template_id:
+            stamp_image_file = base64_upload(data.get('stamp_image'), 'uploaded_file_2')
+        position = data.get('position')
     else:
         file = request.files['file']
-        stamp_image_file = request.files['stamp_image']
-        position = request.form.get('position', 'center')
+        template_id = request.form.get('template_id')
+        if not template_id:
+            stamp_image_file = request.files['stamp_image']
+        position = request.form.get('position')
+
+    template = None
+    if template_id:
+        template = get_template(template_id)
+        if template is None:
+            return unknown_template_response()
+        stamp_image_file = None
+        position = position or template.position
+
+    position = position or 'center'
 
     file_ext = file.filename.split('.')[-1].lower()
 
+    try:
+        pages = page_selection()
+        font = font_option(file_ext, template)
+        raster = raster_options()
+    except ValueError as e:
+        return jsonify({'status': 'fail', 'message': str(e)}), 400
+
     if file_ext in ['pdf']:
-        output_path = stamp_pdf_with_image(file, stamp_image_file, position=position)
-        log_stamp_activity(output_path)
-        return jsonify({
-            'status': 'success',
-            'download_link': url_for('download_file', filename=output_path, _external=True)
-        })
+        return stamped_response(stamp_pdf_with_image, file, stamp_image_file, position=position, template=template,
+                                incremental=request_flag('incremental'), pages=pages, font=font)
     elif file_ext in ['png', 'jpg', 'jpeg']:
-        output_path = stamp_image_with_image(file, stamp_image_file, position=position)
-        log_stamp_activity(output_path)
-        return jsonify({
-            'status': 'success',
-            'download_link': url_for('download_file', filename=output_path, _external=True)
-        })
+        return stamped_response(stamp_image_with_image, file, stamp_image_file, position=position, template=template,
+                                font=font, **raster)
     else:
         return jsonify({'status': 'fail', 'message': 'Unsupported file type'}), 400
 
@@ -338,7 +938,10 @@ def stamp_document_image():
     'tags': ['Stamping'],
     'consumes': [
         'multipart/form-data',
-        'application/json'
+        'application/json',
+        'application/pdf',
+        'image/png',
+        'image/jpeg'
     ],
     'parameters': [
         {
@@ -352,8 +955,8 @@ def stamp_document_image():
             'name': 'stamp_image',
             'in': 'formData',
             'type': 'file',
-            'required': True,
-            'description': 'Image file to be used as stamp'
+            'required': False,
+            'description': 'Image file to be used as stamp (required unless template_id is given)'
         },
         {
             'name': 'signer_text_message',
@@ -370,34 +973,137 @@ def stamp_document_image():
             'description': 'Position to affix the stamp (top, center, bottom, right, left)'
         },
         {
-            'name': 'body',
-            'in': 'body',
+            'name': 'font',
+            'in': 'formData',
+            'type': 'string',
             'required': False,
-            'schema': {
-                'type': 'object',
-                'properties': {
-                    'file': {
-                        'type': 'string',
-                        'format': 'binary',
-                        'description': 'PDF or image file to be stamped'
-                    },
-                    'stamp_image': {
-                        'type': 'string',
-                        'format': 'binary',
-                        'description': 'Image to be used as stamp'
-                    },
-                    'signer_text_message': {
-                        'type': 'string',
-                        'description': 'Signer name to be included in the stamp'
-                    },
-                    'position': {
-                        'type': 'string',
-                        'description': 'Position to affix the stamp (top, center, bottom, right, left)'
-                    }
-                }
-            }
-        }
-    ],
+            'description': 'Font for the stamp text, e.g. helvetica, helvetica-bold, helvetica-oblique '
+                           '(see /api/fonts; default: helvetica)'
+        },
+        {
+            'name': 'encoding',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'For images, fast (quicker, larger output), balanced (default) or small '
+                           '(slower, smaller output)'
+        },
+        {
+            'name': 'quality',
+            'in': 'formData',
+            'type': 'integer',
+            'required': False,
+            'description': 'For JPEGs, the output quality from 1 to 95 (default: the quality of the upload)'
+        },
+        {
+            'name': 'compression',
+            'in': 'formData',
+            'type': 'integer',
+            'required': False,
+            'description': 'For PNGs, the zlib compression level from 0 to 9 (overrides encoding)'
+        },
+        {
+            'name': 'progressive',
+            'in': 'formData',
+            'type': 'boolean',
+            'required': False,
+            'description': 'For JPEGs, whether to write a progressive JPEG'
+        },
+        {
+            'name': 'max_dimension',
+            'in': 'formData',
+            'type': 'integer',
+            'required': False,
+            'description': 'For images, scale the image down to fit within this many pixels before stamping'
+        },
+        {
+            'name': 'preview',
+            'in': 'formData',
+            'type': 'boolean',
+            'required': False,
+            'description': 'For images, stamp a reduced-size preview (max_dimension defaults to 1024)'
+        },
+        {
+            'name': 'ttl',
+            'in': 'formData',
+            'type': 'integer',
+            'required': False,
+            'description': 'Seconds the stamped file stays downloadable (default: 86400)'
+        },
+        {
+            'name': 'pages',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'For PDFs, the pages to stamp: page numbers and ranges such as 1-3,7 or 10-, '
+                           'or first, last, odd, even, all (default: all)'
+        },
+        {
+            'name': 'incremental',
+            'in': 'query',
+            'type': 'boolean',
+            'required': False,
+            'description': 'For PDFs, append the stamp as an incremental update instead of rewriting the file '
+                           '(keeps existing digital signatures valid)'
+        },
+        {
+            'name': 'inline',
+            'in': 'query',
+            'type': 'boolean',
+            'required': False,
+            'description': 'Return the stamped file in the response body instead of a download link'
+        },
+        {
+            'name': 'async',
+            'in': 'query',
+            'type': 'boolean',
+            'required': False,
+            'description': 'Queue the job and return a job ID to poll at /api/jobs/<job_id> instead of waiting'
+        },
+        {
+            'name': 'template_id',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'ID of a registered stamp template to use instead of uploading a stamp'
+        },
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': False,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'file': {
+                        'type': 'string',
+                        'format': 'binary',
+                        'description': 'PDF or image file to be stamped'
+                    },
+                    'stamp_image': {
+                        'type': 'string',
+                        'format': 'binary',
+                        'description': 'Image to be used as stamp'
+                    },
+                    'signer_text_message': {
+                        'type': 'string',
+                        'description': 'Signer name to be included in the stamp'
+                    },
+                    'template_id': {
+                        'type': 'string',
+                        'description': 'ID of a registered stamp template to use instead of uploading a stamp'
+                    },
+                    'position': {
+                        'type': 'string',
+                        'description': 'Position to affix the stamp (top, center, bottom, right, left)'
+                    },
+                    'font': {
+                        'type': 'string',
+                        'description': 'Font for the stamp text (see /api/fonts; default: helvetica)'
+                    }
+                }
+            }
+        }
+    ],
     'responses': {
         200: {
             'description': 'Stamped file',
@@ -420,51 +1126,757 @@ def stamp_document_image():
     }
 })
 def stamp_document_image_text():
-    if request.is_json:
+    if is_raw_upload():
+        template_id = request.args.get('template_id')
+        if not template_id:
+            return raw_upload_needs_template_response()
+        file = raw_upload()
+        signer_text = request.args.get('signer_text_message')
+        position = request.args.get('position')
+    elif request.is_json:
         data = request.get_json()
-        file_data = data.get('file')
-        file_bytes = decode_base64(file_data)
-        file_extension = get_file_extension(file_bytes)
-        file = io.BytesIO(file_bytes)
-        # Set a default name
-        file.filename = f'uploaded_file.{file_extension}'
-        stamp_image_data = data.get('stamp_image')
-        stamp_image_file_bytes = decode_base64(stamp_image_data)
-        stamp_image_file_ext = get_file_extension(stamp_image_file_bytes)
-        stamp_image_file = io.BytesIO(stamp_image_file_bytes)
-        stamp_image_file.filename = f'uploaded_file_2.{stamp_image_file_ext}'
+        file = base64_upload(data.get('file'), 'uploaded_file')
+        template_id = data.get('template_id')
+        if not template_id:
+            stamp_image_file = base64_upload(data.get('stamp_image'), 'uploaded_file_2')
         signer_text = data.get('signer_text_message')
-        position = data.get('position', 'center')
+        position = data.get('position')
     else:
         file = request.files['file']
-        stamp_image_file = request.files['stamp_image']
+        template_id = request.form.get('template_id')
+        if not template_id:
+            stamp_image_file = request.files['stamp_image']
         signer_text = request.form.get('signer_text_message')
-        position = request.form.get('position', 'center')
+        position = request.form.get('position')
+
+    template = None
+    if template_id:
+        template = get_template(template_id)
+        if template is None:
+            return unknown_template_response()
+        stamp_image_file = None
+        signer_text = signer_text or template.signer_text
+        position = position or template.position
+
+    position = position or 'center'
 
     file_ext = file.filename.split('.')[-1].lower()
 
+    try:
+        pages = page_selection()
+        font = font_option(file_ext, template)
+        raster = raster_options()
+    except ValueError as e:
+        return jsonify({'status': 'fail', 'message': str(e)}), 400
+
     if file_ext in ['pdf']:
-        output_path = stamp_pdf_with_image(file, stamp_image_file, signer_text, position)
-        log_stamp_activity(output_path)
-        return jsonify({
-            'status': 'success',
-            'download_link': url_for('download_file', filename=output_path, _external=True)
-        })
+        return stamped_response(stamp_pdf_with_image, file, stamp_image_file, signer_text, position,
+                                template=template, incremental=request_flag('incremental'), pages=pages, font=font)
     elif file_ext in ['png', 'jpg', 'jpeg']:
-        output_path = stamp_image_with_image(file, stamp_image_file, signer_text, position)
-        log_stamp_activity(output_path)
-        return jsonify({
-            'status': 'success',
-            'download_link': url_for('download_file', filename=output_path, _external=True)
-        })
+        return stamped_response(stamp_image_with_image, file, stamp_image_file, signer_text, position,
+                                template=template, font=font, **raster)
     else:
         return jsonify({'status': 'fail', 'message': 'Unsupported file type'}), 400
 
 
+@app.route('/api/stamp/batch', methods=['POST'])
+@swag_from({
+    'tags': ['Stamping'],
+    'consumes': [
+        'multipart/form-data',
+        'application/json'
+    ],
+    'parameters': [
+        {
+            'name': 'files',
+            'in': 'formData',
+            'type': 'array',
+            'items': {
+                'type': 'file'
+            },
+            'collectionFormat': 'multi',
+            'required': False,
+            'description': 'PDF or image files to be stamped'
+        },
+        {
+            'name': 'archive',
+            'in': 'formData',
+            'type': 'file',
+            'required': False,
+            'description': 'Zip archive of PDF or image files to be stamped'
+        },
+        {
+            'name': 'stamp',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'Text to be used as stamp when no stamp image or template is given'
+        },
+        {
+            'name': 'stamp_image',
+            'in': 'formData',
+            'type': 'file',
+            'required': False,
+            'description': 'Image file to be used as stamp'
+        },
+        {
+            'name': 'signer_text_message',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'Signer name to be included with an image stamp'
+        },
+        {
+            'name': 'template_id',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'ID of a registered stamp template to use instead of uploading a stamp'
+        },
+        {
+            'name': 'position',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'Position to affix the stamp (top, center, bottom, right, left)'
+        },
+        {
+            'name': 'font',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'Font for the stamp text, e.g. helvetica, helvetica-bold, helvetica-oblique '
+                           '(see /api/fonts; default: helvetica)'
+        },
+        {
+            'name': 'encoding',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'For images, fast (quicker, larger output), balanced (default) or small '
+                           '(slower, smaller output)'
+        },
+        {
+            'name': 'quality',
+            'in': 'formData',
+            'type': 'integer',
+            'required': False,
+            'description': 'For JPEGs, the output quality from 1 to 95 (default: the quality of the upload)'
+        },
+        {
+            'name': 'compression',
+            'in': 'formData',
+            'type': 'integer',
+            'required': False,
+            'description': 'For PNGs, the zlib compression level from 0 to 9 (overrides encoding)'
+        },
+        {
+            'name': 'progressive',
+            'in': 'formData',
+            'type': 'boolean',
+            'required': False,
+            'description': 'For JPEGs, whether to write a progressive JPEG'
+        },
+        {
+            'name': 'max_dimension',
+            'in': 'formData',
+            'type': 'integer',
+            'required': False,
+            'description': 'For images, scale the image down to fit within this many pixels before stamping'
+        },
+        {
+            'name': 'preview',
+            'in': 'formData',
+            'type': 'boolean',
+            'required': False,
+            'description': 'For images, stamp a reduced-size preview (max_dimension defaults to 1024)'
+        },
+        {
+            'name': 'ttl',
+            'in': 'formData',
+            'type': 'integer',
+            'required': False,
+            'description': 'Seconds the stamped file stays downloadable (default: 86400)'
+        },
+        {
+            'name': 'output',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'links (default) for one download link per file, or zip for a single archive'
+        },
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': False,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'files': {
+                        'type': 'array',
+                        'items': {
+                            'type': 'object',
+                            'properties': {
+                                'file': {
+                                    'type': 'string',
+                                    'format': 'binary',
+                                    'description': 'PDF or image file to be stamped'
+                                },
+                                'filename': {
+                                    'type': 'string',
+                                    'description': 'Name of the file'
+                                }
+                            }
+                        }
+                    },
+                    'stamp': {
+                        'type': 'string',
+                        'description': 'Text to be used as stamp when no stamp image or template is given'
+                    },
+                    'stamp_image': {
+                        'type': 'string',
+                        'format': 'binary',
+                        'description': 'Image to be used as stamp'
+                    },
+                    'signer_text_message': {
+                        'type': 'string',
+                        'description': 'Signer name to be included with an image stamp'
+                    },
+                    'template_id': {
+                        'type': 'string',
+                        'description': 'ID of a registered stamp template to use instead of uploading a stamp'
+                    },
+                    'position': {
+                        'type': 'string',
+                        'description': 'Position to affix the stamp (top, center, bottom, right, left)'
+                    },
+                    'output': {
+                        'type': 'string',
+                        'description': 'links (default) for one download link per file, or zip for a single archive'
+                    }
+                }
+            }
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Stamped files',
+            'content': {
+                'application/json': {
+                    'schema': {
+                        'type': 'object',
+                        'properties': {
+                            'status': {
+                                'type': 'string'
+                            },
+                            'download_link': {
+                                'type': 'string'
+                            },
+                            'documents': {
+                                'type': 'array',
+                                'items': {
+                                    'type': 'object'
+                                }
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+})
+def stamp_document_batch():
+    if request.is_json:
+        data = request.get_json()
+        documents = []
+        for index, entry in enumerate(data.get('files', [])):
+            file_bytes = decode_base64(entry.get('file'))
+            filename = entry.get('filename') or f'uploaded_file_{index}.{get_file_extension(file_bytes)}'
+            documents.append((filename, read_upload(io.BytesIO(file_bytes))))
+        stamp_image_data = data.get('stamp_image')
+        stamp_image_bytes = decode_base64(stamp_image_data) if stamp_image_data else None
+    else:
+        data = request.form
+        documents = [(file.filename, read_upload(file)) for file in request.files.getlist('files')]
+        if 'archive' in request.files:
+            try:
+                documents.extend(read_archive(request.files['archive']))
+            except InputTooLarge as e:
+                return jsonify({'status': 'fail', 'message': str(e)}), 413
+            except zipfile.BadZipFile:
+                return jsonify({'status': 'fail', 'message': 'Invalid zip archive'}), 400
+        stamp_image_bytes = request.files['stamp_image'].read() if 'stamp_image' in request.files else None
+
+    if not documents:
+        return jsonify({'status': 'fail', 'message': 'No files to stamp'}), 400
+    if len(documents) > BATCH_MAX_DOCUMENTS:
+        message = f'Batch has {len(documents)} files, more than the limit of {BATCH_MAX_DOCUMENTS}'
+        return jsonify({'status': 'fail', 'message': message}), 413
+
+    template_id = data.get('template_id')
+    signer_text = data.get('signer_text_message')
+    position = data.get('position')
+    stamp_text = data.get('stamp')
+    if template_id:
+        template = get_template(template_id)
+        if template is None:
+            return unknown_template_response()
+        signer_text = signer_text or template.signer_text
+        position = position or template.position
+
+    font = data.get('font')
+    try:
+        if font:
+            font = font_registry.get(font, 'image').name
+        raster = raster_options()
+        ttl = ttl_option(data.get('ttl'))
+    except ValueError as e:
+        return jsonify({'status': 'fail', 'message': str(e)}), 400
+
+    cost, rejected = check_documents(documents)
+    if stamp_image_bytes is not None:
+        try:
+            cost += estimate_cost(io.BytesIO(stamp_image_bytes), 'image')
+        except InputTooLarge as e:
+            return jsonify({'status': 'fail', 'message': str(e)}), 413
+    client = request.remote_addr
+    try:
+        held = work_limiter.acquire(cost, client)
+    except Saturated as e:
+        return saturated_response(e)
+    try:
+        results = run_batch(documents,
+                            rejected,
+                            stamp_text=stamp_text or 'CONFIDENTIAL',
+                            stamp_image_bytes=stamp_image_bytes,
+                            signer_text=signer_text,
+                            position=position or 'center',
+                            template_id=template_id,
+                            font=font,
+                            ttl=ttl,
+                            **raster)
+    finally:
+        work_limiter.release(held, client)
+
+    manifest = []
+    for filename, output_filename, error in results:
+        log_stamp_activity(g.request_id, 'batch', 'batch', filename=filename, output=output_filename, error=error)
+        if output_filename is None:
+            manifest.append({'filename': filename, 'status': 'fail', 'message': error})
+        else:
+            manifest.append({
+                'filename': filename,
+                'status': 'success',
+                'download_link': url_for('download_file', filename=output_filename, _external=True)
+            })
+
+    response = {'status': 'success', 'documents': manifest}
+    if data.get('output') == 'zip':
+        archive_filename = write_batch_archive(results, ttl)
+        log_stamp_activity(g.request_id, 'batch_archive', 'batch', output=archive_filename,
+                           bytes_out=storage.size(archive_filename))
+        response['download_link'] = url_for('download_file', filename=archive_filename, _external=True)
+    return jsonify(response)
+
+
+@app.route('/api/templates', methods=['POST'])
+@swag_from({
+    'tags': ['Templates'],
+    'consumes': [
+        'multipart/form-data',
+        'application/json'
+    ],
+    'parameters': [
+        {
+            'name': 'stamp_image',
+            'in': 'formData',
+            'type': 'file',
+            'required': True,
+            'description': 'Image file to be used as stamp'
+        },
+        {
+            'name': 'signer_text_message',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'Signer name to be included in the stamp'
+        },
+        {
+            'name': 'position',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'Position to affix the stamp (top, center, bottom, right, left)'
+        },
+        {
+            'name': 'font',
+            'in': 'formData',
+            'type': 'string',
+            'required': False,
+            'description': 'Font for the stamp text, e.g. helvetica, helvetica-bold, helvetica-oblique '
+                           '(see /api/fonts; default: helvetica)'
+        },
+        {
+            'name': 'stamp_width',
+            'in': 'formData',
+            'type': 'number',
+            'required': False,
+            'description': 'Width of the stamp on PDF pages, in points (default: 100)'
+        },
+        {
+            'name': 'stamp_height',
+            'in': 'formData',
+            'type': 'number',
+            'required': False,
+            'description': 'Height of the stamp on PDF pages, in points (default: 100)'
+        },
+        {
+            'name': 'stamp_ratio',
+            'in': 'formData',
+            'type': 'number',
+            'required': False,
+            'description': 'Width of the stamp on images, as a fraction of the image width (default: 0.2)'
+        },
+        {
+            'name': 'body',
+            'in': 'body',
+            'required': False,
+            'schema': {
+                'type': 'object',
+                'properties': {
+                    'stamp_image': {
+                        'type': 'string',
+                        'format': 'binary',
+                        'description': 'Image to be used as stamp'
+                    },
+                    'signer_text_message': {
+                        'type': 'string',
+                        'description': 'Signer name to be included in the stamp'
+                    },
+                    'position': {
+                        'type': 'string',
+                        'description': 'Position to affix the stamp (top, center, bottom, right, left)'
+                    },
+                    'stamp_width': {
+                        'type': 'number',
+                        'description': 'Width of the stamp on PDF pages, in points (default: 100)'
+                    },
+                    'stamp_height': {
+                        'type': 'number',
+                        'description': 'Height of the stamp on PDF pages, in points (default: 100)'
+                    },
+                    'stamp_ratio': {
+                        'type': 'number',
+                        'description': 'Width of the stamp on images, as a fraction of the image width (default: 0.2)'
+                    }
+                }
+            }
+        }
+    ],
+    'responses': {
+        201: {
+            'description': 'Registered stamp template',
+            'content': {
+                'application/json': {
+                    'schema': {
+                        'type': 'object',
+                        'properties': {
+                            'status': {
+                                'type': 'string'
+                            },
+                            'template_id': {
+                                'type': 'string'
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+})
+def create_template():
+    if request.is_json:
+        data = request.get_json()
+        stamp_image = data.get('stamp_image') or None
+    else:
+        data = request.form
+        stamp_image = request.files.get('stamp_image')
+    if stamp_image is None:
+        return jsonify({'status': 'fail', 'message': 'No stamp image'}), 400
+
+    try:
+        template = register_template(
+            decode_base64(stamp_image) if request.is_json else stamp_image.read(),
+            signer_text=data.get('signer_text_message'),
+            position=data.get('position', 'center'),
+            stamp_width=float(data.get('stamp_width', 100)),
+            stamp_height=float(data.get('stamp_height', 100)),
+            stamp_ratio=float(data.get('stamp_ratio', 0.2)),
+            font=data.get('font'),
+        )
+    except Image.DecompressionBombError as e:
+        return jsonify({'status': 'fail', 'message': str(e)}), 413
+    except (UnidentifiedImageError, ValueError):
+        return jsonify({'status': 'fail', 'message': 'Invalid stamp template'}), 400
+
+    return jsonify({'status': 'success', 'template_id': template.template_id, 'template': template.to_dict()}), 201
+
+
+@app.route('/api/templates/<template_id>', methods=['GET'])
+@swag_from({
+    'tags': ['Templates'],
+    'parameters': [
+        {
+            'name': 'template_id',
+            'in': 'path',
+            'type': 'string',
+            'required': True,
+            'description': 'ID of the stamp template'
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Stamp template settings'
+        },
+        404: {
+            'description': 'Unknown stamp template'
+        }
+    }
+})
+def show_template(template_id):
+    template = get_template(template_id)
+    if template is None:
+        return unknown_template_response()
+    return jsonify({'status': 'success', 'template': template.to_dict()})
+
+
+@app.route('/api/templates/<template_id>', methods=['DELETE'])
+@swag_from({
+    'tags': ['Templates'],
+    'parameters': [
+        {
+            'name': 'template_id',
+            'in': 'path',
+            'type': 'string',
+            'required': True,
+            'description': 'ID of the stamp template'
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Stamp template deleted'
+        },
+        404: {
+            'description': 'Unknown stamp template'
+        }
+    }
+})
+def remove_template(template_id):
+    if not delete_template(template_id):
+        return unknown_template_response()
+    return jsonify({'status': 'success'})
+
+
+@app.route('/api/jobs/<job_id>', methods=['GET'])
+@swag_from({
+    'tags': ['Stamping'],
+    'parameters': [
+        {
+            'name': 'job_id',
+            'in': 'path',
+            'type': 'string',
+            'required': True,
+            'description': 'ID returned by a stamping request made with async=1'
+        }
+    ],
+    'responses': {
+        200: {
+            'description': 'Job progress, with the download link once the job is done',
+            'content': {
+                'application/json': {
+                    'schema': {
+                        'type': 'object',
+                        'properties': {
+                            'status': {
+                                'type': 'string'
+                            },
+                            'job': {
+                                'type': 'object'
+                            },
+                            'download_link': {
+                                'type': 'string'
+                            }
+                        }
+                    }
+                }
+            }
+        },
+        404: {
+            'description': 'Unknown job'
+        }
+    }
+})
+def job_status(job_id):
+    job = job_queue.get(job_id)
+    if job is None:
+        return jsonify({'status': 'fail', 'message': 'Unknown job'}), 404
+
+    response = {'status': 'success', 'job': job.to_dict()}
+    if job.status == 'done':
+        response['download_link'] = url_for('download_file', filename=job.output_filename, _external=True)
+    return jsonify(response)
+
+
+@app.route('/api/fonts', methods=['GET'])
+@swag_from({
+    'tags': ['Fonts'],
+    'responses': {
+        200: {
+            'description': 'Fonts that can be passed as the font option, and whether each can be used '
+                           'for PDFs and images',
+            'content': {
+                'application/json': {
+                    'schema': {
+                        'type': 'object',
+                        'properties': {
+                            'status': {
+                                'type': 'string'
+                            },
+                            'fonts': {
+                                'type': 'array'
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+})
+def list_fonts():
+    return jsonify({'status': 'success', 'fonts': font_registry.to_list()})
+
+
+def cache_counters():
+    """Hit and miss counts of every cache, as ``{name: (hits, misses)}``."""
+    counters = {name: (stats['hits'], stats['misses'])
+                for name, stats in (('stamp_assets', stamp_asset_cache.stats()), ('templates', template_cache.stats()),
+                                    ('results', result_stats()))}
+    layout = wrap_text.cache_info()
+    counters['layout'] = (layout.hits, layout.misses)
+    return counters
+
+
+registry.register(Collected('stamp_cache_hits_total', 'Cache lookups that found an entry.', 'counter', ('cache',),
+                            lambda: {(name,): hits for name, (hits, misses) in cache_counters().items()}))
+registry.register(Collected('stamp_cache_misses_total', 'Cache lookups that found nothing.', 'counter', ('cache',),
+                            lambda: {(name,): misses for name, (hits, misses) in cache_counters().items()}))
+registry.register(Collected('stamp_jobs', 'Asynchronous jobs by status.', 'gauge', ('status',),
+                            lambda: {(status,): count for status, count in job_queue.stats().items()}))
+registry.register(Collected('stamp_admission_in_use', 'Cost units of stamping work in progress.', 'gauge', (),
+                            lambda: {(): work_limiter.stats()['in_use']}))
+registry.register(Collected('stamp_admission_refused_total', 'Requests refused for lack of capacity.', 'counter',
+                            ('reason',), lambda: {(reason,): work_limiter.stats()[reason]
+                                                  for reason in ('throttled', 'saturated')}))
+
+
+@app.route('/metrics', methods=['GET'])
+@swag_from({
+    'tags': ['Monitoring'],
+    'responses': {
+        200: {
+            'description': 'Request and per-stage latency histograms, page and pixel counts, cache hits and '
+                           'job counts in the Prometheus text format',
+            'content': {
+                'text/plain': {
+                    'schema': {
+                        'type': 'string'
+                    }
+                }
+            }
+        }
+    }
+})
+def metrics():
+    return Response(registry.render(), mimetype='text/plain; version=0.0.4')
+
+
+@app.route('/api/cache/stats', methods=['GET'])
+@swag_from({
+    'tags': ['Monitoring'],
+    'responses': {
+        200: {
+            'description': 'Stamp image cache statistics',
+            'content': {
+                'application/json': {
+                    'schema': {
+                        'type': 'object',
+                        'properties': {
+                            'stamp_assets': {
+                                'type': 'object'
+                            },
+                            'templates': {
+                                'type': 'object'
+                            },
+                            'results': {
+                                'type': 'object'
+                            }
+                        }
+                    }
+                }
+            }
+        }
+    }
+})
+def cache_stats():
+    return jsonify({'stamp_assets': stamp_asset_cache.stats(), 'templates': template_cache.stats(),
+                    'results': result_stats(), 'expiry': expiry_scheduler.stats(),
+                    'admission': work_limiter.stats()})
+
+
 @app.route('/download/<filename>')
 def download_file(filename):
-    return send_from_directory('downloads', filename)
+    expires_at = storage.expires_at(filename)
+    # Stored files never change, so caches may keep them until they expire
+    max_age = max(0, int(expires_at - time.time())) if expires_at is not None else None
+    try:
+        etag = storage.etag(filename)
+        # Files on disk are sent by path, so their size is known and byte ranges can be served
+        stamped_file = storage.path(filename) or storage.open(filename)
+        response = send_file(stamped_file, download_name=filename, etag=etag, max_age=max_age)
+    except FileNotFoundError:
+        return jsonify({'status': 'fail', 'message': 'File not found or expired'}), 404
+    # Advertised on every response, since PDF viewers only fetch pages by range if they see it
+    response.accept_ranges = 'bytes'
+    if max_age:
+        # Stamped documents are only for whoever holds the link
+        response.cache_control.public = False
+        response.cache_control.private = True
+        response.cache_control.immutable = True
+    return response
+
+
+_warmed = False
+
+
+def create_app(warm=True):
+    """Return the app, warmed up first with ``warm``. Safe to call more than once.
+
+    Everything the app needs is set up when this module is imported, so
+    ``gunicorn app:app`` and ``flask run`` serve it as is. Warming up loads
+    the registered templates and stamps a small PDF and images, so what is
+    otherwise loaded on first use is ready. A pre-forking server calls this
+    once in its master process, and the workers start with all of it
+    already in memory.
+    """
+    global _warmed
+    if warm and not _warmed:
+        _warmed = True
+        preload_templates()
+        warm_up()
+        # The warm-up isn't traffic
+        registry.clear()
+    return app
 
 
 if __name__ == '__main__':
-    app.run(debug=True)
+    create_app().run(debug=True)
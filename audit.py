@@ -0,0 +1,103 @@
+import json
+import logging
+import os
+import queue
+import threading
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, WatchedFileHandler
+
+# Every server process appends to this file, so it is rotated from outside
+# (e.g. by logrotate): a process rotating it would rename it under the others
+AUDIT_LOG_FILE = os.getenv('AUDIT_LOG_FILE', 'stamping.log')
+# Records waiting to be written; beyond this they are dropped rather than wait
+AUDIT_QUEUE_SIZE = int(os.getenv('AUDIT_QUEUE_SIZE', 10000))
+
+
+class JsonFormatter(logging.Formatter):
+    """Formats records as one JSON object per line.
+
+    Records whose message is a dict have its items as fields; other records
+    get a ``message`` field.
+    """
+
+    def format(self, record):
+        entry = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(timespec='milliseconds'),
+            'level': record.levelname,
+        }
+        if isinstance(record.msg, dict):
+            entry.update(record.msg)
+        else:
+            entry['message'] = record.getMessage()
+        if record.exc_info:
+            entry['exception'] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str)
+
+
+class BackgroundHandler(QueueHandler):
+    """A log handler that hands records to a background thread, which writes
+    them with ``target``.
+
+    Logging never waits for the disk: records are queued without being
+    formatted, and when the queue is full they are dropped and counted in
+    ``dropped``. The thread is started on first use, and again in a forked
+    child, which doesn't inherit it.
+    """
+
+    def __init__(self, target, queue_size=AUDIT_QUEUE_SIZE):
+        super().__init__(queue.Queue(queue_size))
+        self.target = target
+        self.queue_size = queue_size
+        self.dropped = 0
+        self._listener = None
+        self._pid = None
+        self._start_lock = threading.Lock()
+
+    def _start(self):
+        if self._pid == os.getpid():
+            return
+        with self._start_lock:
+            if self._pid != os.getpid():
+                if self._pid is not None:
+                    # Records queued before a fork belong to the parent
+                    self.queue = queue.Queue(self.queue_size)
+                self._listener = QueueListener(self.queue, self.target)
+                self._listener.start()
+                self._pid = os.getpid()
+
+    def prepare(self, record):
+        # Formatting happens in the background thread
+        return record
+
+    def enqueue(self, record):
+        self._start()
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+    def close(self):
+        # Called by logging.shutdown() at exit: write out what is still queued
+        if self._listener is not None and self._pid == os.getpid():
+            self._listener.stop()
+            self._listener = None
+        self.target.close()
+        super().close()
+
+
+def install(logger=None, level=logging.INFO, path=AUDIT_LOG_FILE):
+    """Send ``logger`` (default: the root logger) to a JSON-lines file
+    through a BackgroundHandler, and return the handler. The file is reopened
+    when it has been moved away by an external rotation."""
+    target = WatchedFileHandler(path, delay=True)
+    target.setFormatter(JsonFormatter())
+    handler = BackgroundHandler(target)
+    logger = logger or logging.getLogger()
+    logger.addHandler(handler)
+    logger.setLevel(level)
+    return handler
+
+
+def audit(event, **fields):
+    """Log an audit event, e.g. ``audit('stamp', request_id=..., pages=...)``."""
+    logging.getLogger('audit').info({'event': event, **fields})
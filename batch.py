@@ -0,0 +1,179 @@
+import io
+import functools
+import os
+import shutil
+import time
+import zipfile
+from concurrent.futures import FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+from admission import InputTooLarge, estimate_cost
+from pools import WorkerPool
+from stamp import stamp_pdf, stamp_image, stamp_pdf_with_image, stamp_image_with_image
+from stamp_templates import get_template
+from storage import storage
+from uploads import MAX_UPLOAD_BYTES
+
+SUPPORTED_EXTENSIONS = ('pdf', 'png', 'jpg', 'jpeg')
+
+# Number of worker processes used for batch stamping (default: one per core)
+BATCH_WORKERS = int(os.getenv('BATCH_WORKERS', os.cpu_count() or 1))
+# Most documents in one batch, and most bytes a zip upload may expand to
+BATCH_MAX_DOCUMENTS = int(os.getenv('BATCH_MAX_DOCUMENTS', 1000))
+BATCH_MAX_BYTES = int(os.getenv('BATCH_MAX_BYTES', 1024 * 1024 * 1024))
+
+# The process pool shared by all batch requests
+batch_pool = WorkerPool(BATCH_WORKERS)
+
+
+def file_extension(filename):
+    return filename.split('.')[-1].lower()
+
+
+def stamp_document(filename, data, stamp_text=None, stamp_image_bytes=None,
+                   signer_text=None, position='center', template_id=None, font=None, encoding=None,
+                   max_dimension=None, ttl=None):
+    """Stamp a single document inside a pool worker.
+
+    Returns a ``(filename, output_filename, error)`` tuple; exactly one of
+    ``output_filename`` and ``error`` is set.
+    """
+    file = io.BytesIO(data)
+    file.filename = filename
+    file_ext = file_extension(filename)
+
+    try:
+        template = None
+        if template_id:
+            template = get_template(template_id)
+            if template is None:
+                return filename, None, 'Unknown stamp template'
+
+        if template is None and stamp_image_bytes is None:
+            if file_ext == 'pdf':
+                output_filename = stamp_pdf(file, stamp_text, position, font=font, ttl=ttl)
+            else:
+                output_filename = stamp_image(file, stamp_text, position, font=font, encoding=encoding,
+                                              max_dimension=max_dimension, ttl=ttl)
+        else:
+            stamp_image_file = io.BytesIO(stamp_image_bytes) if stamp_image_bytes is not None else None
+            if file_ext == 'pdf':
+                output_filename = stamp_pdf_with_image(file, stamp_image_file, signer_text, position, template=template,
+                                                       font=font, ttl=ttl)
+            else:
+                output_filename = stamp_image_with_image(file, stamp_image_file, signer_text, position,
+                                                         template=template, font=font, encoding=encoding,
+                                                         max_dimension=max_dimension, ttl=ttl)
+    except Exception as e:
+        return filename, None, str(e) or e.__class__.__name__
+
+    return filename, output_filename, None
+
+
+def read_upload(file):
+    """Return a loader for the bytes of an uploaded file, which can be called more than once."""
+    def load():
+        file.seek(0)
+        return file.read()
+    return load
+
+
+def read_archive(archive):
+    """Return ``(filename, load)`` for the files in a zip upload.
+
+    Members are only decompressed when ``load()`` is called. The sizes the
+    archive declares are checked first, and zipfile never decompresses a
+    member past its declared size, so an archive of highly compressible
+    entries is refused with InputTooLarge instead of filling memory.
+    """
+    zip_file = zipfile.ZipFile(archive)
+    members = [info for info in zip_file.infolist() if not info.is_dir()]
+    if len(members) > BATCH_MAX_DOCUMENTS:
+        raise InputTooLarge(f'Archive has {len(members)} files, more than the limit of {BATCH_MAX_DOCUMENTS}')
+    for info in members:
+        if info.file_size > MAX_UPLOAD_BYTES:
+            raise InputTooLarge(f'{info.filename} is {info.file_size} bytes uncompressed, more than the limit of '
+                                f'{MAX_UPLOAD_BYTES}')
+    total_size = sum(info.file_size for info in members)
+    if total_size > BATCH_MAX_BYTES:
+        raise InputTooLarge(f'Archive is {total_size} bytes uncompressed, more than the limit of {BATCH_MAX_BYTES}')
+    return [(os.path.basename(info.filename), functools.partial(zip_file.read, info)) for info in members]
+
+
+def check_documents(documents):
+    """Estimate the cost of stamping ``(filename, load)`` documents.
+
+    Returns the total cost and ``{index: error}`` for the documents that
+    are too large to stamp, to pass on to run_batch().
+    """
+    cost = 0
+    rejected = {}
+    for index, (filename, load) in enumerate(documents):
+        extension = file_extension(filename)
+        if extension not in SUPPORTED_EXTENSIONS:
+            continue
+        try:
+            cost += estimate_cost(io.BytesIO(load()), extension)
+        except InputTooLarge as e:
+            rejected[index] = str(e)
+    return cost, rejected
+
+
+def run_batch(documents, rejected=None, **stamp_spec):
+    """Stamp ``(filename, load)`` documents in the process pool.
+
+    Unsupported files and those in ``rejected`` (see check_documents) are
+    reported as errors without being sent to a worker. Documents are loaded
+    as workers become free, so only a few are held in memory at once.
+    Results are returned in input order.
+    """
+    rejected = rejected or {}
+    results = [None] * len(documents)
+    pending = {}
+    for index, (filename, load) in enumerate(documents):
+        if file_extension(filename) not in SUPPORTED_EXTENSIONS or index in rejected:
+            results[index] = (filename, None, rejected.get(index, 'Unsupported file type'))
+            continue
+        if not storage.shared:
+            # Worker processes can't write to this process's storage
+            results[index] = stamp_document(filename, load(), **stamp_spec)
+            continue
+        while len(pending) >= BATCH_WORKERS * 2:
+            done, _ = wait(pending, return_when=FIRST_COMPLETED)
+            _collect(pending, done, results)
+        pending[batch_pool.submit(stamp_document, filename, load(), **stamp_spec)] = (index, filename)
+
+    _collect(pending, list(pending), results)
+    return results
+
+
+def _collect(pending, futures, results):
+    for future in futures:
+        index, filename = pending.pop(future)
+        try:
+            results[index] = future.result()
+        except BrokenProcessPool:
+            # The pool is replaced for the documents that follow
+            results[index] = (filename, None, 'The worker process stamping this document stopped')
+
+
+def write_batch_archive(results, ttl=None):
+    """Bundle the stamped outputs of a batch into one zip in storage."""
+    def write(output_file):
+        used_names = set()
+        with zipfile.ZipFile(output_file, 'w') as archive:
+            for filename, output_filename, error in results:
+                if output_filename is None:
+                    continue
+                # Keep the uploaded name, suffixed if the batch repeats it
+                name = f"stamped_{filename.rsplit('.', 1)[0]}.{file_extension(output_filename)}"
+                counter = 1
+                while name in used_names:
+                    name = f"stamped_{filename.rsplit('.', 1)[0]}_{counter}.{file_extension(output_filename)}"
+                    counter += 1
+                used_names.add(name)
+                # Stamped files are already compressed, so just store them
+                with storage.open(output_filename) as stamped_file, \
+                        archive.open(zipfile.ZipInfo(name, time.localtime()[:6]), 'w', force_zip64=True) as entry:
+                    shutil.copyfileobj(stamped_file, entry)
+
+    return storage.save(write, 'zip', ttl)
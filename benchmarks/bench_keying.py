@@ -0,0 +1,43 @@
+"""Benchmark white-to-transparent keying of stamp images.
+
+Run from the repository root:
+
+    python benchmarks/bench_keying.py
+"""
+import os
+import sys
+import time
+
+from PIL import Image, ImageDraw
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+
+from stamp import key_white_to_transparent  # noqa: E402
+
+
+def make_stamp_image(side):
+    # White background with a dark ring, like a scanned seal
+    image = Image.new('RGB', (side, side), (255, 255, 255))
+    draw = ImageDraw.Draw(image)
+    draw.ellipse((side // 10, side // 10, side * 9 // 10, side * 9 // 10),
+                 outline=(150, 20, 20), width=max(side // 40, 1))
+    return image
+
+
+def bench(side, repeat=5):
+    image = make_stamp_image(side)
+    best = None
+    for _ in range(repeat):
+        start = time.perf_counter()
+        key_white_to_transparent(image)
+        elapsed = time.perf_counter() - start
+        best = elapsed if best is None else min(best, elapsed)
+    megapixels = side * side / 1_000_000
+    return megapixels, best
+
+
+if __name__ == '__main__':
+    print(f"{'size':>11} {'MP':>6} {'best ms':>9} {'ms/MP':>8}")
+    for side in (500, 1000, 2000, 4000):
+        megapixels, best = bench(side)
+        print(f"{side:>5}x{side:<5} {megapixels:>6.2f} {best * 1000:>9.2f} {best * 1000 / megapixels:>8.2f}")
@@ -0,0 +1,335 @@
+"""Benchmark the stamping functions and HTTP routes.
+
+Synthetic fixtures are generated locally: PDFs of 1, 100 and 1000 pages
+mixing page sizes and orientations, photos from 1 to 100 megapixels and
+stamp images of several sizes. Each case runs in a fresh Python process,
+so the peak RSS reported is its own (not counting page-parallel workers),
+and large PDFs take the page-parallel path as they do in the server. Cases
+report p50/p99 latency, throughput (pages or megapixels per second) and
+peak RSS. Routes are called through
+the Flask test client, with stamped files written to a temporary
+directory.
+
+Run from the repository root:
+
+    python benchmarks/bench_stamping.py
+    python benchmarks/bench_stamping.py --quick --json after.json
+    python benchmarks/bench_stamping.py --compare before.json after.json
+
+``--quick`` skips the 1000-page PDF and the photos over 10 MP, and
+``--fixtures DIR`` keeps the generated fixtures in DIR for the next run.
+"""
+import argparse
+import io
+import json
+import math
+import os
+import platform
+import random
+import resource
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+from PIL import Image
+from reportlab.lib.pagesizes import A4, landscape, legal, letter
+from reportlab.pdfgen import canvas
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from bench_keying import make_stamp_image  # noqa: E402
+
+# Page sizes cycled through by the generated PDFs
+PAGE_SIZES = (letter, A4, legal, landscape(letter), landscape(A4), (300, 420))
+PDF_PAGES = (1, 100, 1000)
+PHOTO_MEGAPIXELS = (1, 10, 25, 100)
+STAMP_SIDES = (100, 500, 2000)
+SEED = 1234
+
+
+def make_pdf(path, page_count):
+    rng = random.Random(SEED + page_count)
+    can = canvas.Canvas(path)
+    for index in range(page_count):
+        width, height = PAGE_SIZES[index % len(PAGE_SIZES)]
+        can.setPageSize((width, height))
+        can.setFont('Helvetica', 10)
+        for line in range(int(height // 14) - 4):
+            words = ' '.join(rng.choice(('lorem', 'ipsum', 'dolor', 'sit', 'amet', 'stamp', 'page'))
+                             for _ in range(int(width // 40)))
+            can.drawString(36, height - 36 - line * 14, words)
+        can.showPage()
+    can.save()
+
+
+def make_photo(path, megapixels):
+    # A 4:3 image with gradients and noise, so it compresses like a photo
+    width = int(math.sqrt(megapixels * 1_000_000 * 4 / 3))
+    height = int(width * 3 / 4)
+    red = Image.linear_gradient('L').resize((width, height))
+    green = Image.effect_noise((width, height), 40)
+    blue = Image.radial_gradient('L').resize((width, height))
+    Image.merge('RGB', (red, green, blue)).save(path, quality=90)
+
+
+def make_stamp(path, side):
+    make_stamp_image(side).save(path)
+
+
+def make_fixtures(directory, quick=False):
+    """Generate the fixtures that are not in ``directory`` yet and return their paths by name."""
+    os.makedirs(directory, exist_ok=True)
+    fixtures = {}
+    for page_count in PDF_PAGES:
+        if quick and page_count > 100:
+            continue
+        fixtures[f'pdf_{page_count}p'] = (os.path.join(directory, f'pages_{page_count}.pdf'), make_pdf, page_count)
+    for megapixels in PHOTO_MEGAPIXELS:
+        if quick and megapixels > 10:
+            continue
+        fixtures[f'photo_{megapixels}mp'] = (os.path.join(directory, f'photo_{megapixels}mp.jpg'), make_photo,
+                                             megapixels)
+    for side in STAMP_SIDES:
+        fixtures[f'stamp_{side}'] = (os.path.join(directory, f'stamp_{side}.png'), make_stamp, side)
+
+    paths = {}
+    for name, (path, make, size) in fixtures.items():
+        if not os.path.exists(path):
+            make(path, size)
+        paths[name] = path
+    return paths
+
+
+def cases(fixtures):
+    """The benchmark cases: ``(name, kind, target, document, stamp image, unit, units)``."""
+    result = []
+
+    def units(document):
+        if document.startswith('pdf_'):
+            return 'pages', int(document[4:-1])
+        return 'MP', int(document[6:-2])
+
+    pdfs = [name for name in fixtures if name.startswith('pdf_')]
+    photos = [name for name in fixtures if name.startswith('photo_')]
+    for pdf in pdfs:
+        result.append((f'stamp_pdf/{pdf}', 'function', 'stamp_pdf', pdf, None) + units(pdf))
+        result.append((f'stamp_pdf_with_image/{pdf}', 'function', 'stamp_pdf_with_image', pdf, 'stamp_500')
+                      + units(pdf))
+    for photo in photos:
+        result.append((f'stamp_image/{photo}', 'function', 'stamp_image', photo, None) + units(photo))
+        result.append((f'stamp_image_with_image/{photo}', 'function', 'stamp_image_with_image', photo, 'stamp_500')
+                      + units(photo))
+    for side in STAMP_SIDES:
+        result.append((f'stamp_image_with_image/photo_10mp/stamp_{side}', 'function', 'stamp_image_with_image',
+                       'photo_10mp', f'stamp_{side}') + units('photo_10mp'))
+    result.append(('POST /api/stamp/text/pdf_100p', 'route', '/api/stamp/text', 'pdf_100p', None)
+                  + units('pdf_100p'))
+    result.append(('POST /api/stamp/image/pdf_100p', 'route', '/api/stamp/image', 'pdf_100p', 'stamp_500')
+                  + units('pdf_100p'))
+    result.append(('POST /api/stamp/text/photo_10mp', 'route', '/api/stamp/text', 'photo_10mp', None)
+                  + units('photo_10mp'))
+    result.append(('POST /api/stamp/image-and-text/photo_10mp', 'route', '/api/stamp/image-and-text', 'photo_10mp',
+                   'stamp_500') + units('photo_10mp'))
+    return result
+
+
+def peak_rss():
+    """Peak resident set size of this process, in bytes."""
+    try:
+        # Unlike ru_maxrss, which Linux carries over from the parent process,
+        # VmHWM starts afresh in every new process image
+        with open('/proc/self/status') as status:
+            for line in status:
+                if line.startswith('VmHWM:'):
+                    return int(line.split()[1]) * 1024
+    except OSError:
+        pass
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == 'darwin' else peak * 1024
+
+
+def percentile(samples, fraction):
+    """Nearest-rank percentile."""
+    ordered = sorted(samples)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+
+def call_function(target, document, stamp_image, iteration):
+    import stamp
+
+    filename, data = document
+    file = io.BytesIO(data)
+    file.filename = filename
+    # Stamped to memory, so the disk doesn't skew the numbers
+    output = io.BytesIO()
+    text = f'BENCHMARK {iteration}'
+    if stamp_image is None:
+        getattr(stamp, target)(file, text, 'center', output=output)
+    else:
+        getattr(stamp, target)(file, io.BytesIO(stamp_image[1]), text, 'center', output=output)
+
+
+def call_route(client, target, document, stamp_image, iteration, work_dir):
+    import results
+
+    # A new result index for every call, so earlier results are never reused
+    results.RESULTS_DIR = os.path.join(work_dir, 'results', str(iteration))
+    data = {'file': (io.BytesIO(document[1]), document[0]), 'position': 'center'}
+    if target == '/api/stamp/text':
+        data['stamp'] = f'BENCHMARK {iteration}'
+    else:
+        data['signer_text_message'] = f'BENCHMARK {iteration}'
+    if stamp_image is not None:
+        data['stamp_image'] = (io.BytesIO(stamp_image[1]), stamp_image[0])
+    response = client.post(target, data=data, content_type='multipart/form-data')
+    response.get_data()
+    if response.status_code != 200:
+        raise RuntimeError(f'{target} returned {response.status_code}: {response.get_data(as_text=True)[:200]}')
+
+
+def run_case(case, fixtures, repeat, work_dir):
+    """Run one case in this (fresh) process and return its measurements."""
+    name, kind, target, document, stamp_image, unit, units = case
+
+    def load(fixture):
+        with open(fixtures[fixture], 'rb') as fixture_file:
+            return os.path.basename(fixtures[fixture]), fixture_file.read()
+
+    document = load(document)
+    stamp_image = load(stamp_image) if stamp_image else None
+
+    if kind == 'route':
+        from app import create_app
+
+        client = create_app().test_client()
+
+        def call(iteration):
+            call_route(client, target, document, stamp_image, iteration, work_dir)
+    else:
+        def call(iteration):
+            call_function(target, document, stamp_image, iteration)
+
+    # The first call loads fonts and fills caches, as the first request of a server would
+    call(0)
+    baseline_rss = peak_rss()
+    samples = []
+    for iteration in range(1, repeat + 1):
+        start = time.perf_counter()
+        call(iteration)
+        samples.append(time.perf_counter() - start)
+
+    p50 = percentile(samples, 0.5)
+    return {
+        'name': name,
+        'kind': kind,
+        'runs': len(samples),
+        'p50_ms': p50 * 1000,
+        'p99_ms': percentile(samples, 0.99) * 1000,
+        'mean_ms': sum(samples) / len(samples) * 1000,
+        'throughput': units / p50,
+        'unit': f'{unit}/s',
+        'peak_rss_mb': peak_rss() / 1024 / 1024,
+        'warm_rss_mb': baseline_rss / 1024 / 1024,
+    }
+
+
+def run_case_process(case, fixtures, repeat, work_dir):
+    """Run one case in a new Python process and return its measurements.
+
+    A subprocess rather than a multiprocessing worker: stamping skips the
+    page-parallel path inside worker processes, as it does in batch workers.
+    """
+    spec = json.dumps({'case': case, 'fixtures': fixtures, 'repeat': repeat, 'work_dir': work_dir})
+    completed = subprocess.run([sys.executable, os.path.abspath(__file__), '--run-case', spec],
+                               stdout=subprocess.PIPE, check=True, text=True)
+    # The measurements are the last line; anything before it is the case's own output
+    return json.loads(completed.stdout.strip().splitlines()[-1])
+
+
+def environment():
+    try:
+        commit = subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=ROOT, capture_output=True,
+                                text=True).stdout.strip() or None
+    except OSError:
+        commit = None
+    return {
+        'commit': commit,
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'cpus': os.cpu_count(),
+    }
+
+
+def print_header():
+    print(f"{'case':<52} {'runs':>4} {'p50 ms':>9} {'p99 ms':>9} {'throughput':>16} {'peak MB':>8}")
+
+
+def print_result(result):
+    print(f"{result['name']:<52} {result['runs']:>4} {result['p50_ms']:>9.1f} {result['p99_ms']:>9.1f} "
+          f"{result['throughput']:>10.1f} {result['unit']:<5} {result['peak_rss_mb']:>8.0f}", flush=True)
+
+
+def compare(before_path, after_path):
+    with open(before_path) as before_file, open(after_path) as after_file:
+        before = {result['name']: result for result in json.load(before_file)['results']}
+        after = {result['name']: result for result in json.load(after_file)['results']}
+    print(f"{'case':<52} {'p50 before':>11} {'p50 after':>10} {'change':>8} {'peak MB':>14}")
+    for name, result in after.items():
+        if name not in before:
+            continue
+        old = before[name]
+        change = result['p50_ms'] / old['p50_ms'] - 1
+        print(f"{name:<52} {old['p50_ms']:>11.1f} {result['p50_ms']:>10.1f} {change:>+8.1%} "
+              f"{old['peak_rss_mb']:>6.0f} -> {result['peak_rss_mb']:<5.0f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmark the stamping functions and HTTP routes.')
+    parser.add_argument('--repeat', type=int, default=5, help='timed runs per case, after one warm-up run')
+    parser.add_argument('--quick', action='store_true', help='skip the largest fixtures')
+    parser.add_argument('--only', help='only run cases whose name contains this text')
+    parser.add_argument('--fixtures', help='directory to keep generated fixtures in between runs')
+    parser.add_argument('--json', help='also write the results to this file')
+    parser.add_argument('--compare', nargs=2, metavar=('BEFORE', 'AFTER'), help='compare two JSON result files')
+    parser.add_argument('--run-case', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.compare:
+        compare(*args.compare)
+        return
+    if args.run_case:
+        spec = json.loads(args.run_case)
+        print(json.dumps(run_case(tuple(spec['case']), spec['fixtures'], spec['repeat'], spec['work_dir'])))
+        return
+
+    work_dir = tempfile.mkdtemp(prefix='stamp-bench-')
+    try:
+        print('Generating fixtures...', file=sys.stderr)
+        fixtures = make_fixtures(args.fixtures or os.path.join(work_dir, 'fixtures'), args.quick)
+
+        # Routes write their output and logs to the temporary directory
+        os.environ['DOWNLOADS_DIR'] = os.path.join(work_dir, 'downloads')
+        os.environ['AUDIT_LOG_FILE'] = os.path.join(work_dir, 'stamping.log')
+        os.chdir(ROOT)
+
+        results = []
+        print_header()
+        for case in cases(fixtures):
+            if args.only and args.only not in case[0]:
+                continue
+            # A new process per case, so each peak RSS only covers that case
+            results.append(run_case_process(case, fixtures, args.repeat, work_dir))
+            print_result(results[-1])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    if args.json:
+        with open(args.json, 'w') as json_file:
+            json.dump({'environment': environment(), 'repeat': args.repeat, 'results': results}, json_file, indent=2)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,132 @@
+import logging
+import os
+import threading
+from jobs import job_queue
+from results import delete_expired_results
+from storage import storage
+
+# Seconds between sweeps for expired files
+EXPIRY_INTERVAL_SECONDS = float(os.getenv('EXPIRY_INTERVAL_SECONDS', 60))
+# Files deleted in one go before pausing, so a sweep never saturates the disk
+EXPIRY_BATCH_SIZE = int(os.getenv('EXPIRY_BATCH_SIZE', 100))
+EXPIRY_BATCH_PAUSE_SECONDS = float(os.getenv('EXPIRY_BATCH_PAUSE_SECONDS', 0.05))
+# When stored files take up this fraction of their byte budget
+# (DOWNLOADS_MAX_BYTES; 0 turns it off), files are evicted before they
+# expire, soonest-expiring first, until they drop to the low-water mark
+DISK_HIGH_WATER = float(os.getenv('DISK_HIGH_WATER', 0.9))
+DISK_LOW_WATER = float(os.getenv('DISK_LOW_WATER', 0.8))
+
+
+class ExpiryScheduler:
+    """Deletes stamped files as they expire, from a background thread.
+
+    Every ``interval`` seconds expired buckets are emptied in batches of
+    ``batch_size`` files with a pause between batches, so deletion is spread
+    out instead of arriving as one large sweep. If the stored files take up
+    more than ``high_water`` of their byte budget, unexpired files are
+    evicted, those expiring soonest first, until they are below ``low_water``.
+    """
+
+    def __init__(self, storage, interval=EXPIRY_INTERVAL_SECONDS, batch_size=EXPIRY_BATCH_SIZE,
+                 batch_pause=EXPIRY_BATCH_PAUSE_SECONDS, high_water=DISK_HIGH_WATER, low_water=DISK_LOW_WATER):
+        self.storage = storage
+        self.interval = interval
+        self.batch_size = batch_size
+        self.batch_pause = batch_pause
+        self.high_water = high_water
+        self.low_water = low_water
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._thread = None
+        self._pid = None
+        self._stats = {'sweeps': 0, 'expired': 0, 'evicted': 0, 'errors': 0}
+
+    def start(self):
+        """Start the background thread if this process isn't running it yet."""
+        with self._lock:
+            # A thread started before a fork doesn't exist in the child
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._stop.clear()
+            self._thread = threading.Thread(target=self._run, name='expiry', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+
+    def _run(self):
+        while not self._stop.wait(self.interval):
+            self.sweep()
+
+    def sweep(self, now=None):
+        """Delete expired files, then evict files if they take up too much space.
+        Job statuses are tidied up on the same schedule."""
+        try:
+            self._count('expired', self.expire(now))
+            self._count('evicted', self.evict())
+        except Exception as e:
+            self._count('errors', 1)
+            logging.warning(f'Download expiry failed: {e}')
+        try:
+            job_queue.sweep(now)
+        except Exception as e:
+            self._count('errors', 1)
+            logging.warning(f'Job status sweep failed: {e}')
+        self._count('sweeps', 1)
+
+    def expire(self, now=None):
+        deleted = 0
+        for bucket in self.storage.expired_buckets(now):
+            deleted += self._delete(self.storage.bucket_files(bucket))
+            if self._stop.is_set():
+                break
+            self.storage.remove_bucket(bucket)
+        self.storage.delete_legacy(now)
+        # Result entries pointing at the files that just expired
+        delete_expired_results(now)
+        return deleted
+
+    def evict(self):
+        if not self.high_water:
+            return 0
+        usage = self.storage.usage()
+        if usage is None:
+            return 0
+        used, budget = usage
+        if used <= self.high_water * budget:
+            return 0
+        evicted = 0
+        for bucket in self.storage.buckets():
+            # The bucket itself is left in place: files may still be written into it
+            names = self.storage.bucket_files(bucket)
+            for start in range(0, len(names), self.batch_size):
+                if evicted and self._stop.wait(self.batch_pause):
+                    return evicted
+                batch = names[start:start + self.batch_size]
+                for name in batch:
+                    used -= self.storage.delete(name)
+                evicted += len(batch)
+                if used <= self.low_water * budget:
+                    return evicted
+        return evicted
+
+    def _delete(self, names):
+        """Delete ``names`` in batches, pausing between them."""
+        for start in range(0, len(names), self.batch_size):
+            if start and self._stop.wait(self.batch_pause):
+                return start
+            for name in names[start:start + self.batch_size]:
+                self.storage.delete(name)
+        return len(names)
+
+    def _count(self, name, value):
+        with self._lock:
+            self._stats[name] += value
+
+    def stats(self):
+        with self._lock:
+            return dict(self._stats)
+
+
+expiry_scheduler = ExpiryScheduler(storage)
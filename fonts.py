@@ -0,0 +1,115 @@
+import os
+import re
+import threading
+from PIL import ImageFont
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFError, TTFont
+
+FONT_DIR = 'font/helvetica'
+FONT_EXTENSIONS = ('.ttf', '.otf')
+DEFAULT_FONT = 'helvetica'
+
+# Fonts that every PDF viewer provides, so PDFs can use them without embedding
+STANDARD_PDF_FONTS = {
+    'helvetica': 'Helvetica',
+    'helvetica-bold': 'Helvetica-Bold',
+    'helvetica-oblique': 'Helvetica-Oblique',
+    'helvetica-bold-oblique': 'Helvetica-BoldOblique',
+}
+
+# Font files carry an upload hash suffix, e.g. helvetica-light-587ebe5a59211.ttf
+_HASH_SUFFIX = re.compile(r'-[0-9a-f]{13}$')
+
+
+def font_name(name):
+    """Normalize a font name, so 'Helvetica Bold', 'helvetica_bold' and
+    'Helvetica-Bold' all refer to the same font."""
+    name = re.sub(r'(?<=[a-z])(?=[A-Z])', '-', name.strip())
+    return re.sub(r'[\s_-]+', '-', name).lower()
+
+
+class Font:
+    """A font file usable by both the PDF (reportlab) and raster (Pillow) paths."""
+
+    def __init__(self, name, path):
+        self.name = name
+        self.path = path
+        self.pdf_name = None
+        self._image_fonts = {}
+        self._lock = threading.Lock()
+
+    def load(self):
+        """Make the font available to reportlab.
+
+        Standard PDF fonts are referenced by name. Other TrueType fonts are
+        registered with reportlab once, which embeds a subset of them in each
+        document that uses them. CFF-based OpenType fonts can't be embedded
+        by reportlab and are only available for images.
+        """
+        if self.name in STANDARD_PDF_FONTS:
+            self.pdf_name = STANDARD_PDF_FONTS[self.name]
+            return
+        try:
+            pdfmetrics.registerFont(TTFont(self.name, self.path))
+            self.pdf_name = self.name
+        except TTFError:
+            self.pdf_name = None
+
+    def image_font(self, size):
+        """Return the Pillow font for ``size``, loading it on first use."""
+        font = self._image_fonts.get(size)
+        if font is None:
+            with self._lock:
+                font = self._image_fonts.get(size)
+                if font is None:
+                    font = ImageFont.truetype(self.path, size)
+                    self._image_fonts[size] = font
+        return font
+
+
+class FontRegistry:
+    """The fonts shipped under a directory, loaded once per process."""
+
+    def __init__(self, directory):
+        self.directory = directory
+        self.fonts = {}
+        self._lock = threading.Lock()
+
+    def preload(self):
+        """Load every font in the directory. Safe to call more than once."""
+        with self._lock:
+            if self.fonts:
+                return
+            fonts = {}
+            for filename in sorted(os.listdir(self.directory)):
+                stem, extension = os.path.splitext(filename)
+                if extension.lower() not in FONT_EXTENSIONS:
+                    continue
+                font = Font(font_name(_HASH_SUFFIX.sub('', stem)), os.path.join(self.directory, filename))
+                font.load()
+                fonts[font.name] = font
+            self.fonts = fonts
+
+    def get(self, name=None, context_type='pdf'):
+        """Return the font called ``name``, or the default font.
+
+        Raises ValueError for unknown fonts and for fonts that can't be
+        used in a PDF when ``context_type`` is 'pdf'.
+        """
+        if not self.fonts:
+            self.preload()
+        font = self.fonts.get(font_name(name or DEFAULT_FONT))
+        if font is None:
+            raise ValueError(f'Unknown font: {name}')
+        if context_type == 'pdf' and font.pdf_name is None:
+            raise ValueError(f'Font {font.name} can only be used for images')
+        return font
+
+    def to_list(self):
+        if not self.fonts:
+            self.preload()
+        return [{'name': font.name, 'pdf': font.pdf_name is not None, 'image': True}
+                for font in self.fonts.values()]
+
+
+font_registry = FontRegistry(FONT_DIR)
@@ -0,0 +1,109 @@
+import uuid
+import zlib
+from PyPDF2.generic import ArrayObject, DictionaryObject, EncodedStreamObject, NameObject
+
+
+def flate_stream(data):
+    """Return a Flate-compressed stream object holding ``data``."""
+    stream = EncodedStreamObject()
+    stream[NameObject('/Filter')] = NameObject('/FlateDecode')
+    stream._data = zlib.compress(data)
+    return stream
+
+
+class OverlayForms:
+    """Draws stamp overlays on pages as shared Form XObjects.
+
+    Each distinct overlay becomes one Form XObject (with the fonts and images
+    it uses) and a tiny content stream that draws it. A stamped page keeps
+    its own content streams untouched, wrapped in ``q``/``Q`` so its graphics
+    state can't leak into the stamp, so stamping costs the same however
+    much content a page has. Subclasses say where new objects are added.
+    """
+
+    def __init__(self):
+        self._forms = {}
+        self._prefix = None
+
+    def add(self, obj):
+        """Add ``obj`` to the output and return a reference to it."""
+        raise NotImplementedError
+
+    def import_object(self, obj):
+        """Copy ``obj`` from the overlay PDF into the output."""
+        raise NotImplementedError
+
+    def _overlay_form(self, overlay):
+        """Return the XObject name, the form and the drawing stream for an overlay page."""
+        form = self._forms.get(id(overlay))
+        if form is None:
+            contents = overlay.get_contents()
+            if isinstance(contents, ArrayObject):
+                data = b'\n'.join(part.get_object().get_data() for part in contents)
+            else:
+                data = contents.get_data() if contents is not None else b''
+
+            xobject = flate_stream(data)
+            xobject[NameObject('/Type')] = NameObject('/XObject')
+            xobject[NameObject('/Subtype')] = NameObject('/Form')
+            xobject[NameObject('/BBox')] = ArrayObject(overlay.mediabox)
+            if '/Resources' in overlay:
+                xobject[NameObject('/Resources')] = self.import_object(overlay.raw_get('/Resources'))
+
+            name = NameObject(f'/Stamp{uuid.uuid4().hex[:12]}')
+            suffix = self.add(flate_stream(b'Q\nq ' + name.encode() + b' Do Q\n'))
+            form = (name, self.add(xobject), suffix)
+            self._forms[id(overlay)] = form
+        return form
+
+    def stamped_entries(self, page, overlay):
+        """Return the ``/Contents`` and ``/Resources`` of ``page`` with ``overlay`` drawn on top."""
+        if self._prefix is None:
+            self._prefix = self.add(flate_stream(b'q\n'))
+        name, form, suffix = self._overlay_form(overlay)
+
+        contents = []
+        if '/Contents' in page:
+            original = page.raw_get('/Contents')
+            if isinstance(original.get_object(), ArrayObject):
+                contents = list(original.get_object())
+            else:
+                contents = [original]
+
+        # Resources may be shared with other pages, so they are copied
+        resources = DictionaryObject()
+        if '/Resources' in page:
+            resources.update(page['/Resources'].items())
+        xobjects = DictionaryObject()
+        if '/XObject' in resources:
+            xobjects.update(resources['/XObject'].items())
+        xobjects[name] = form
+        resources[NameObject('/XObject')] = xobjects
+
+        return ArrayObject([self._prefix] + contents + [suffix]), resources
+
+
+class WriterForms(OverlayForms):
+    """Adds stamped pages to a PdfWriter, drawing overlays as Form XObjects.
+
+    Unlike ``PageObject.merge_page``, which parses and rewrites the content
+    of every page it merges, this leaves page content as it is.
+    """
+
+    def __init__(self, writer):
+        super().__init__()
+        self.writer = writer
+
+    def add(self, obj):
+        return self.writer._add_object(obj)
+
+    def import_object(self, obj):
+        return obj.clone(self.writer)
+
+    def stamp_page(self, page, overlay):
+        """Add ``page`` to the writer with ``overlay`` drawn on top."""
+        page = self.writer.add_page(page)
+        contents, resources = self.stamped_entries(page, overlay)
+        page[NameObject('/Contents')] = contents
+        page[NameObject('/Resources')] = resources
+        return page
@@ -0,0 +1,48 @@
+import os
+
+bind = os.getenv('BIND', '0.0.0.0:8000')
+
+# A worker process per core. Each one keeps its own caches and admission
+# capacity, and its threads overlap requests; the CPU-heavy work (large
+# PDFs and batches) runs in process pools. Metrics are saved to
+# METRICS_DIR, so /metrics reports all workers whichever one answers
+workers = int(os.getenv('WEB_WORKERS', os.cpu_count() or 1))
+os.environ.setdefault('METRICS_DIR', 'metrics')
+worker_class = 'gthread'
+threads = int(os.getenv('WEB_THREADS', 4))
+
+# The app is created in the master, which loads fonts and templates and
+# stamps a warm-up document, so forked workers share that memory and are
+# ready for their first request
+preload_app = True
+
+# Large documents take a while to stamp
+timeout = int(os.getenv('WEB_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+# Recycle workers now and then to give back memory fragmented by large images
+max_requests = int(os.getenv('WEB_MAX_REQUESTS', 1000))
+max_requests_jitter = max_requests // 10
+
+
+def on_starting(server):
+    # Metrics saved by an earlier run belong to processes that are gone
+    directory = os.environ['METRICS_DIR']
+    if os.path.isdir(directory):
+        for filename in os.listdir(directory):
+            os.remove(os.path.join(directory, filename))
+
+
+def worker_exit(server, worker):
+    # Jobs queued in this worker can't be handed to another one, so they
+    # are finished or marked failed before it exits
+    from jobs import job_queue
+    from metrics import registry
+    job_queue.drain()
+    registry.save()
+
+
+def child_exit(server, worker):
+    from metrics import registry
+    registry.retire(worker.pid)
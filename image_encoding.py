@@ -0,0 +1,159 @@
+import math
+import os
+from PIL import Image, ImageOps
+
+# Encoder settings per mode: 'fast' favours latency, 'small' favours output size
+ENCODING_MODES = {
+    'fast': {'png': {'compress_level': 1}, 'jpeg': {'optimize': False}},
+    'balanced': {'png': {'compress_level': 6}, 'jpeg': {'optimize': False}},
+    'small': {'png': {'compress_level': 9, 'optimize': True}, 'jpeg': {'optimize': True, 'progressive': True}},
+}
+DEFAULT_ENCODING_MODE = 'balanced'
+
+# Longest side of preview images when no max_dimension is given
+PREVIEW_MAX_DIMENSION = int(os.getenv('PREVIEW_MAX_DIMENSION', 1024))
+
+# Images with more pixels than this are refused before they are decoded
+MAX_IMAGE_PIXELS = int(os.getenv('MAX_IMAGE_PIXELS', 120_000_000))
+# Pillow warns above its own limit and refuses twice it; keep it in line
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+# Image modes whose pixels are not RGB, so an RGB ICC profile can't describe them
+_COLOR_SPACES = {'1': 'gray', 'L': 'gray', 'LA': 'gray', 'I': 'gray', 'I;16': 'gray', 'F': 'gray', 'CMYK': 'cmyk'}
+
+# JPEG quality when the source's own quantization tables can't be reused
+DEFAULT_JPEG_QUALITY = 90
+
+
+class EncodeOptions:
+    """How a stamped image is encoded.
+
+    ``mode`` picks a preset from ENCODING_MODES; ``quality`` (JPEG, 1-95),
+    ``compression`` (PNG zlib level, 0-9) and ``progressive`` (JPEG)
+    override it. Raises ValueError for invalid values.
+    """
+
+    def __init__(self, mode=None, quality=None, compression=None, progressive=None):
+        self.mode = mode or DEFAULT_ENCODING_MODE
+        if self.mode not in ENCODING_MODES:
+            raise ValueError(f'Unknown encoding mode: {self.mode!r} (use {", ".join(ENCODING_MODES)})')
+        self.quality = self._number('quality', quality, 1, 95)
+        self.compression = self._number('compression', compression, 0, 9)
+        self.progressive = progressive
+
+    @staticmethod
+    def _number(name, value, low, high):
+        if value is None or value == '':
+            return None
+        try:
+            number = int(value)
+        except (TypeError, ValueError):
+            raise ValueError(f'Invalid {name}: {value!r}')
+        if not low <= number <= high:
+            raise ValueError(f'{name} must be between {low} and {high}')
+        return number
+
+    def save_arguments(self, image, image_format):
+        """Return the Pillow save() keyword arguments for ``image``."""
+        if image_format == 'PNG':
+            arguments = dict(ENCODING_MODES[self.mode]['png'])
+            if self.compression is not None:
+                arguments['compress_level'] = self.compression
+            return arguments
+
+        arguments = dict(ENCODING_MODES[self.mode]['jpeg'])
+        if self.quality is not None:
+            arguments['quality'] = self.quality
+        elif getattr(image, 'quantization', None):
+            # Re-encode with the source's own quantization tables and chroma
+            # subsampling, so the stamp doesn't change the file's quality
+            arguments['quality'] = 'keep'
+            arguments['subsampling'] = 'keep'
+        else:
+            arguments['quality'] = DEFAULT_JPEG_QUALITY
+        if self.progressive is not None:
+            arguments['progressive'] = self.progressive
+        return arguments
+
+
+def max_dimension_option(max_dimension=None, preview=False):
+    """Validate a max_dimension option; ``preview`` defaults it to PREVIEW_MAX_DIMENSION."""
+    if max_dimension is None or max_dimension == '':
+        return PREVIEW_MAX_DIMENSION if preview else None
+    try:
+        max_dimension = int(max_dimension)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid max_dimension: {max_dimension!r}')
+    if max_dimension < 1:
+        raise ValueError('max_dimension must be at least 1')
+    return max_dimension
+
+
+class RasterSource:
+    """The format and metadata of an opened image, kept for re-encoding it."""
+
+    def __init__(self, image):
+        self.format = image.format
+        self.mode = image.mode
+        self.icc_profile = image.info.get('icc_profile')
+        self.exif = image.info.get('exif')
+
+
+def check_image_size(image):
+    """Raise DecompressionBombError if an opened (not yet decoded) image has
+    more than MAX_IMAGE_PIXELS pixels."""
+    if image.width * image.height > MAX_IMAGE_PIXELS:
+        raise Image.DecompressionBombError(f'Image of {image.width}x{image.height} pixels is larger than '
+                                           f'the limit of {MAX_IMAGE_PIXELS} pixels')
+
+
+def open_image(file, native_modes, max_dimension=None):
+    """Open an image for stamping.
+
+    The image is turned upright according to its EXIF orientation, so stamps
+    are drawn the right way up, and converted to RGBA unless its mode is in
+    ``native_modes``. With ``max_dimension`` the image is scaled down to fit
+    within that many pixels before anything else is done with it. Returns
+    the image and its RasterSource.
+    """
+    image = Image.open(file)
+    check_image_size(image)
+    if max_dimension and max(image.size) > max_dimension:
+        # JPEGs are decoded at the smallest DCT scale (1/2, 1/4 or 1/8) that
+        # is still at least the target size, so the full-size image is
+        # never decoded; other formats are resampled right after decoding
+        scale = max_dimension / max(image.size)
+        image.draft(None, (math.ceil(image.width * scale), math.ceil(image.height * scale)))
+        if image.mode.startswith('I;16'):
+            # Pillow can't resample 16-bit modes; 32-bit 'I' holds the same values
+            image = image.convert('I')
+        image.thumbnail((max_dimension, max_dimension), reducing_gap=3.0)
+    ImageOps.exif_transpose(image, in_place=True)
+    source = RasterSource(image)
+    if image.mode not in native_modes:
+        image = image.convert('RGBA')
+    return image, source
+
+
+def save_image(image, output, source, options=None):
+    """Encode a stamped image in its source format, keeping its ICC profile and EXIF."""
+    options = options or EncodeOptions()
+    image_format = 'JPEG' if source.format == 'JPEG' else 'PNG'
+    if image_format == 'JPEG' and image.mode != 'RGB':
+        image = image.convert('RGB')
+
+    arguments = options.save_arguments(image, image_format)
+    # A profile only describes the pixels if they are still in the source's colour space
+    if source.icc_profile and _COLOR_SPACES.get(image.mode, 'rgb') == _COLOR_SPACES.get(source.mode, 'rgb'):
+        arguments['icc_profile'] = source.icc_profile
+    if source.exif:
+        # Orientation was applied when the image was opened
+        arguments['exif'] = source.exif
+    image.save(output, format=image_format, **arguments)
+
+
+def image_extension(source, extension):
+    """The output file extension, keeping the upload's own if it matches the format."""
+    if source.format == 'JPEG':
+        return extension if extension in ('jpg', 'jpeg') else 'jpg'
+    return 'png'
@@ -0,0 +1,179 @@
+import io
+import re
+import shutil
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, NameObject, NumberObject, StreamObject
+from forms import OverlayForms, flate_stream
+
+
+class IncrementalUpdate(OverlayForms):
+    """Stamp pages of an existing PDF by appending an incremental update.
+
+    The original bytes are copied through untouched and only the new objects
+    are written after them: one Form XObject per distinct overlay (with the
+    fonts and images it uses), two tiny content streams that wrap the page in
+    ``q``/``Q`` and draw the form, and the modified page dictionaries. Output
+    cost is proportional to the stamp rather than the document, and byte
+    ranges covered by existing digital signatures stay valid.
+    """
+
+    def __init__(self, reader, source):
+        if reader.is_encrypted:
+            raise ValueError('Incremental updates are not supported for encrypted PDFs')
+        super().__init__()
+        self.reader = reader
+        self.source = source
+
+        # Find the cross-reference section the update will point back to
+        source.seek(0, io.SEEK_END)
+        self.source_size = source.tell()
+        source.seek(max(0, self.source_size - 2048))
+        tail = source.read()
+        startxref = tail.rfind(b'startxref')
+        self.previous_xref = int(tail[startxref + len(b'startxref'):].split()[0])
+        source.seek(self.previous_xref)
+        head = source.read(1024)
+        self.uses_xref_stream = not head.startswith(b'xref')
+
+        # New objects are numbered after every object the original defines
+        size = int(reader.trailer.get('/Size', 0))
+        if self.uses_xref_stream:
+            match = re.search(rb'/Size\s+(\d+)', head)
+            if match:
+                size = max(size, int(match.group(1)))
+        for numbers in reader.xref.values():
+            size = max(size, max(numbers, default=-1) + 1)
+        size = max(size, max(reader.xref_objStm, default=-1) + 1)
+        self.next_number = size
+
+        # object number -> (generation, object)
+        self.objects = {}
+        self._imported = {}
+
+    def add(self, obj, number=None, generation=0):
+        if number is None:
+            number = self.next_number
+            self.next_number += 1
+        self.objects[number] = (generation, obj)
+        return IndirectObject(number, generation, None)
+
+    def import_object(self, obj):
+        """Copy ``obj`` from another PDF, giving its indirect objects new numbers."""
+        if isinstance(obj, IndirectObject):
+            key = (id(obj.pdf), obj.idnum, obj.generation)
+            reference = self._imported.get(key)
+            if reference is None:
+                # Reserve the number first so reference cycles terminate
+                reference = IndirectObject(self.next_number, 0, None)
+                self.next_number += 1
+                self._imported[key] = reference
+                self.objects[reference.idnum] = (0, self.import_object(obj.get_object()))
+            return reference
+        if isinstance(obj, StreamObject):
+            copy = obj.__class__()
+            copy._data = obj._data
+            for name, value in obj.items():
+                copy[name] = self.import_object(value)
+            return copy
+        if isinstance(obj, DictionaryObject):
+            copy = DictionaryObject()
+            for name, value in obj.items():
+                copy[name] = self.import_object(value)
+            return copy
+        if isinstance(obj, ArrayObject):
+            return ArrayObject(self.import_object(value) for value in obj)
+        return obj
+
+    def stamp_page(self, page, overlay):
+        """Replace ``page`` with a revision that draws ``overlay`` on top."""
+        contents, resources = self.stamped_entries(page, overlay)
+
+        revision = DictionaryObject()
+        revision.update(page.items())
+        revision[NameObject('/Contents')] = contents
+        revision[NameObject('/Resources')] = resources
+
+        reference = page.indirect_reference
+        self.add(revision, reference.idnum, reference.generation)
+
+    def _trailer_entries(self):
+        entries = DictionaryObject()
+        for key in ('/Root', '/Info', '/ID'):
+            if key in self.reader.trailer:
+                entries[NameObject(key)] = self.reader.trailer.raw_get(key)
+        return entries
+
+    def write(self, output):
+        """Write the original PDF followed by the update to ``output``."""
+        # The update is small, so it is assembled in memory before writing
+        base = self.source_size + 1
+        update = io.BytesIO()
+        offsets = {}
+        for number in sorted(self.objects):
+            generation, obj = self.objects[number]
+            offsets[number] = (base + update.tell(), generation)
+            update.write(b'%d %d obj\n' % (number, generation))
+            obj.write_to_stream(update, None)
+            update.write(b'\nendobj\n')
+
+        xref_offset = base + update.tell()
+        trailer = self._trailer_entries()
+        trailer[NameObject('/Prev')] = NumberObject(self.previous_xref)
+        if self.uses_xref_stream:
+            self._write_xref_stream(update, offsets, xref_offset, trailer)
+        else:
+            self._write_xref_table(update, offsets, trailer)
+        update.write(b'\nstartxref\n%d\n%%%%EOF\n' % xref_offset)
+
+        self.source.seek(0)
+        shutil.copyfileobj(self.source, output)
+        output.write(b'\n')
+        output.write(update.getvalue())
+
+    @staticmethod
+    def _subsections(numbers):
+        """Group sorted object numbers into runs of consecutive numbers."""
+        runs = []
+        for number in numbers:
+            if runs and runs[-1][-1] + 1 == number:
+                runs[-1].append(number)
+            else:
+                runs.append([number])
+        return runs
+
+    def _write_xref_table(self, update, offsets, trailer):
+        # Restate the head of the free list, as most writers do, so readers
+        # don't mistake the table for one that is not zero-indexed
+        update.write(b'xref\n0 1\n0000000000 65535 f\r\n')
+        for run in self._subsections(sorted(offsets)):
+            update.write(b'%d %d\n' % (run[0], len(run)))
+            for number in run:
+                offset, generation = offsets[number]
+                update.write(b'%010d %05d n\r\n' % (offset, generation))
+        trailer[NameObject('/Size')] = NumberObject(self.next_number)
+        update.write(b'trailer\n')
+        trailer.write_to_stream(update, None)
+
+    def _write_xref_stream(self, update, offsets, xref_offset, trailer):
+        # The original uses a cross-reference stream, so the update does too
+        number = self.next_number
+        offsets[number] = (xref_offset, 0)
+        offset_width = max(4, (xref_offset.bit_length() + 7) // 8)
+
+        rows = []
+        index = ArrayObject()
+        for run in self._subsections(sorted(offsets)):
+            index.extend([NumberObject(run[0]), NumberObject(len(run))])
+            for entry in run:
+                offset, generation = offsets[entry]
+                rows.append(b'\x01' + offset.to_bytes(offset_width, 'big') + generation.to_bytes(2, 'big'))
+
+        xref = flate_stream(b''.join(rows))
+        xref.update(trailer)
+        xref[NameObject('/Type')] = NameObject('/XRef')
+        xref[NameObject('/Size')] = NumberObject(number + 1)
+        xref[NameObject('/Index')] = index
+        xref[NameObject('/W')] = ArrayObject([NumberObject(1), NumberObject(offset_width), NumberObject(2)])
+
+        update.write(b'%d 0 obj\n' % number)
+        xref.write_to_stream(update, None)
+        update.write(b'\nendobj')
@@ -0,0 +1,245 @@
+import json
+import os
+import queue
+import re
+import threading
+import time
+import uuid
+
+# Worker threads that run asynchronous stamping jobs
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', 2))
+# Jobs allowed to wait for a worker before new submissions are refused
+JOB_QUEUE_SIZE = int(os.getenv('JOB_QUEUE_SIZE', 32))
+# Seconds a finished job's status is kept for polling
+JOB_RESULT_TTL = int(os.getenv('JOB_RESULT_TTL', 3600))
+# Job status is also written here, so any server process can answer a poll
+JOBS_DIR = os.getenv('JOBS_DIR', 'jobs')
+# Least time between writes of a running job's progress
+PROGRESS_SAVE_INTERVAL = 0.5
+# Seconds an exiting server process waits for its jobs to finish before
+# marking the rest failed
+JOB_DRAIN_SECONDS = float(os.getenv('JOB_DRAIN_SECONDS', 25))
+# Seconds after which a queued or running job whose status hasn't been
+# touched is taken to be lost with the process that ran it, and marked
+# failed. The process running a job touches it on every expiry sweep
+JOB_STALE_SECONDS = float(os.getenv('JOB_STALE_SECONDS', 300))
+# Error of jobs that were lost
+JOB_LOST_ERROR = 'The server stopped before the job finished'
+
+_JOB_ID = re.compile('[0-9a-f]{32}')
+
+
+def job_path(job_id):
+    return os.path.join(JOBS_DIR, f'{job_id}.json')
+
+
+class Job:
+    """An asynchronous stamping job and its progress."""
+
+    def __init__(self, work):
+        self.job_id = uuid.uuid4().hex
+        self.work = work
+        self.status = 'queued'
+        self.pages_done = 0
+        self.pages_total = None
+        self.output_filename = None
+        self.error = None
+        self.created_at = time.time()
+        self.finished_at = None
+        self._saved_at = 0
+
+    @classmethod
+    def load(cls, job_id):
+        """Read a job's status as last saved by whichever process runs it,
+        or return None if there is no such job."""
+        if not _JOB_ID.fullmatch(job_id):
+            return None
+        try:
+            with open(job_path(job_id)) as status_file:
+                saved = json.load(status_file)
+        except (FileNotFoundError, ValueError):
+            return None
+        job = cls(None)
+        job.__dict__.update(saved)
+        return job
+
+    def save(self):
+        os.makedirs(JOBS_DIR, exist_ok=True)
+        saved = dict(self.to_dict(), output_filename=self.output_filename, created_at=self.created_at,
+                     finished_at=self.finished_at)
+        # Written under a temporary name and renamed, so readers never see half a status
+        temporary_path = f'{job_path(self.job_id)}.{os.getpid()}.{threading.get_ident()}'
+        with open(temporary_path, 'w') as status_file:
+            json.dump(saved, status_file)
+        os.replace(temporary_path, job_path(self.job_id))
+        self._saved_at = time.monotonic()
+
+    def update_progress(self, pages_done, pages_total):
+        self.pages_done = pages_done
+        self.pages_total = pages_total
+        if time.monotonic() - self._saved_at >= PROGRESS_SAVE_INTERVAL:
+            self.save()
+
+    def run(self):
+        self.status = 'running'
+        self.save()
+        try:
+            self.output_filename = self.work(self.update_progress)
+            self.status = 'done'
+        except Exception as e:
+            self.error = str(e) or e.__class__.__name__
+            self.status = 'failed'
+        finally:
+            self.work = None
+            self.finished_at = time.time()
+            self.save()
+
+    def fail(self, error):
+        self.error = error
+        self.status = 'failed'
+        self.finished_at = time.time()
+        self.save()
+
+    def to_dict(self):
+        return {
+            'job_id': self.job_id,
+            'status': self.status,
+            'pages_done': self.pages_done,
+            'pages_total': self.pages_total,
+            'error': self.error,
+        }
+
+
+class JobQueue:
+    """A bounded in-process job queue served by a fixed pool of worker threads.
+
+    This stands in for an external broker: submissions beyond ``max_queued``
+    waiting jobs are refused so in-flight work stays bounded. Jobs run in
+    the process that accepted them, which also saves their status to
+    JOBS_DIR so a poll answered by another process finds it.
+    """
+
+    def __init__(self, workers, max_queued):
+        self.workers = workers
+        self._queue = queue.Queue(maxsize=max_queued)
+        self._jobs = {}
+        self._lock = threading.Lock()
+        self._threads = []
+        self._draining = False
+
+    def _start(self):
+        # Threads are started on first use so they are never forked
+        if not self._threads:
+            for _ in range(self.workers):
+                thread = threading.Thread(target=self._worker, daemon=True)
+                thread.start()
+                self._threads.append(thread)
+
+    def _worker(self):
+        while True:
+            job = self._queue.get()
+            try:
+                job.run()
+            finally:
+                self._queue.task_done()
+
+    def _prune(self):
+        cutoff = time.time() - JOB_RESULT_TTL
+        for job_id in [job_id for job_id, job in self._jobs.items()
+                       if job.finished_at is not None and job.finished_at < cutoff]:
+            del self._jobs[job_id]
+            try:
+                os.remove(job_path(job_id))
+            except FileNotFoundError:
+                pass
+
+    def submit(self, work):
+        """Queue ``work(progress)`` and return its Job, or None if the queue is full.
+
+        ``work`` receives a ``progress(pages_done, pages_total)`` callback and
+        returns the output filename.
+        """
+        job = Job(work)
+        with self._lock:
+            if self._draining:
+                return None
+            self._start()
+            self._prune()
+            # Saved before a worker can pick the job up and save it as running
+            job.save()
+            try:
+                self._queue.put_nowait(job)
+            except queue.Full:
+                os.remove(job_path(job.job_id))
+                return None
+            self._jobs[job.job_id] = job
+        return job
+
+    def _unfinished(self):
+        with self._lock:
+            return [job for job in self._jobs.values() if job.status in ('queued', 'running')]
+
+    def drain(self, timeout=JOB_DRAIN_SECONDS):
+        """Refuse new jobs and wait up to ``timeout`` seconds for the queued
+        and running ones, then mark those still unfinished failed. Called
+        when the server process is about to exit."""
+        with self._lock:
+            self._draining = True
+        deadline = time.monotonic() + timeout
+        while self._unfinished() and time.monotonic() < deadline:
+            time.sleep(0.1)
+        for job in self._unfinished():
+            job.fail(JOB_LOST_ERROR)
+
+    def sweep(self, now=None):
+        """Touch the status of this process's unfinished jobs, mark those
+        of other processes that haven't been touched for JOB_STALE_SECONDS
+        failed, and delete those finished more than JOB_RESULT_TTL ago."""
+        now = time.time() if now is None else now
+        for job in self._unfinished():
+            try:
+                os.utime(job_path(job.job_id))
+            except FileNotFoundError:
+                pass
+        try:
+            filenames = os.listdir(JOBS_DIR)
+        except FileNotFoundError:
+            return
+        for filename in filenames:
+            job_id, extension = os.path.splitext(filename)
+            if extension != '.json' or not _JOB_ID.fullmatch(job_id):
+                continue
+            try:
+                touched_at = os.path.getmtime(job_path(job_id))
+            except FileNotFoundError:
+                continue
+            job = Job.load(job_id)
+            if job is None:
+                continue
+            if job.finished_at is None:
+                if touched_at < now - JOB_STALE_SECONDS:
+                    job.fail(JOB_LOST_ERROR)
+            elif job.finished_at < now - JOB_RESULT_TTL:
+                try:
+                    os.remove(job_path(job_id))
+                except FileNotFoundError:
+                    pass
+
+    def get(self, job_id):
+        """Return the job, from this process or as saved by another one."""
+        with self._lock:
+            job = self._jobs.get(job_id)
+        return job if job is not None else Job.load(job_id)
+
+    def stats(self):
+        with self._lock:
+            statuses = [job.status for job in self._jobs.values()]
+        return {
+            'queued': statuses.count('queued'),
+            'running': statuses.count('running'),
+            'done': statuses.count('done'),
+            'failed': statuses.count('failed'),
+        }
+
+
+job_queue = JobQueue(JOB_WORKERS, JOB_QUEUE_SIZE)
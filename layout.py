@@ -0,0 +1,46 @@
+from functools import lru_cache
+from reportlab.pdfbase.pdfmetrics import stringWidth
+from fonts import font_registry
+
+
+@lru_cache(maxsize=65536)
+def text_width(text, font_name, font_size, context_type='pdf'):
+    """Width of ``text`` in points (PDF) or pixels (image), cached per string."""
+    font = font_registry.get(font_name, context_type)
+    if context_type == 'image':
+        return font.image_font(font_size).getlength(text)
+    return stringWidth(text, font.pdf_name, font_size)
+
+
+@lru_cache(maxsize=4096)
+def wrap_text(text, max_width, font_name='helvetica', font_size=12, context_type='pdf'):
+    """Greedily wrap ``text`` into lines no wider than ``max_width``.
+
+    Each distinct word is measured once and line widths are summed as words
+    are added, so wrapping is linear in the length of the text. Whole
+    layouts are memoized too, since the same stamp is usually laid out for
+    many pages or images of the same width. Returns a tuple of lines; a word
+    wider than ``max_width`` gets a line to itself.
+    """
+    space_width = text_width(' ', font_name, font_size, context_type)
+    lines = []
+    current_words = []
+    current_width = 0
+
+    for word in text.split():
+        word_width = text_width(word, font_name, font_size, context_type)
+        if not current_words:
+            current_words = [word]
+            current_width = word_width
+        elif current_width + space_width + word_width <= max_width:
+            current_words.append(word)
+            current_width += space_width + word_width
+        else:
+            lines.append(' '.join(current_words))
+            current_words = [word]
+            current_width = word_width
+
+    if current_words:
+        lines.append(' '.join(current_words))
+
+    return tuple(lines)
@@ -0,0 +1,375 @@
+import json
+import logging
+import math
+import os
+import threading
+import time
+from contextlib import contextmanager
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+PAGE_BUCKETS = (1, 2, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000)
+PIXEL_BUCKETS = (1e5, 5e5, 1e6, 2e6, 5e6, 1e7, 2.5e7, 5e7, 1e8)
+# Directory where each server process saves its metrics, so /metrics reports
+# all of them whichever process answers; empty keeps them per process
+METRICS_DIR = os.getenv('METRICS_DIR', '')
+# Seconds between saves of a server process's metrics to METRICS_DIR
+METRICS_SAVE_INTERVAL = float(os.getenv('METRICS_SAVE_INTERVAL', 5))
+# Saved metrics of exited processes, merged together
+EXITED_METRICS_FILE = 'exited.json'
+
+
+def _format_value(value):
+    if value == math.inf:
+        return '+Inf'
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _format_labels(names, values):
+    if not names:
+        return ''
+    escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for value in values)
+    return '{' + ','.join(f'{name}="{value}"' for name, value in zip(names, escaped)) + '}'
+
+
+class Metric:
+    """A metric family in the Prometheus text format, with optional labels."""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=()):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+
+    def snapshot(self):
+        """Return a copy of the values, ``{label values: value}``."""
+        with self._lock:
+            return dict(self._values)
+
+    @staticmethod
+    def combine(value, other):
+        """Return the sum of two values of this metric from different processes."""
+        return value + other
+
+    def samples(self, values=None):
+        """Yield ``(suffix, label names, label values, value)`` for each sample
+        of ``values`` (default: this process's values)."""
+        values = self.snapshot() if values is None else values
+        for labelvalues, value in sorted(values.items()):
+            yield '', self.labelnames, labelvalues, value
+
+    def render(self, values=None):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.type}']
+        for suffix, names, labelvalues, value in self.samples(values):
+            lines.append(f'{self.name}{suffix}{_format_labels(names, labelvalues)} {_format_value(value)}')
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def set(self, value, *labelvalues):
+        with self._lock:
+            self._values[labelvalues] = value
+
+    def inc(self, *labelvalues, amount=1):
+        with self._lock:
+            self._values[labelvalues] = self._values.get(labelvalues, 0) + amount
+
+    def dec(self, *labelvalues, amount=1):
+        self.inc(*labelvalues, amount=-amount)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name, documentation, labelnames=(), buckets=LATENCY_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(buckets) + (math.inf,)
+
+    def observe(self, value, *labelvalues):
+        with self._lock:
+            counts, total = self._values.get(labelvalues) or ([0] * len(self.buckets), 0)
+            for index, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[index] += 1
+                    break
+            self._values[labelvalues] = (counts, total + value)
+
+    @contextmanager
+    def time(self, *labelvalues):
+        """Observe the time spent in the ``with`` block, in seconds."""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *labelvalues)
+
+    def snapshot(self):
+        with self._lock:
+            return {labelvalues: (list(counts), total) for labelvalues, (counts, total) in self._values.items()}
+
+    @staticmethod
+    def combine(value, other):
+        (counts, total), (other_counts, other_total) = value, other
+        return [count + other_count for count, other_count in zip(counts, other_counts)], total + other_total
+
+    def samples(self, values=None):
+        bucket_names = self.labelnames + ('le',)
+        values = self.snapshot() if values is None else values
+        for labelvalues, (counts, total) in sorted(values.items()):
+            cumulative = 0
+            for bound, count in zip(self.buckets, counts):
+                cumulative += count
+                yield '_bucket', bucket_names, labelvalues + (_format_value(bound),), cumulative
+            yield '_sum', self.labelnames, labelvalues, total
+            yield '_count', self.labelnames, labelvalues, cumulative
+
+
+class Collected(Metric):
+    """A metric read from elsewhere when it is exported, such as a cache's
+    own hit counters. ``collect()`` returns ``{label values: value}``."""
+
+    def __init__(self, name, documentation, metric_type, labelnames, collect):
+        super().__init__(name, documentation, labelnames)
+        self.type = metric_type
+        self.collect = collect
+
+    def snapshot(self):
+        return dict(self.collect())
+
+
+def _read_json(path):
+    try:
+        with open(path) as saved_file:
+            return json.load(saved_file)
+    except (FileNotFoundError, ValueError):
+        return None
+
+
+def _write_json(path, saved):
+    # Written under a temporary name and renamed, so readers never see half a file
+    temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}'
+    with open(temporary_path, 'w') as saved_file:
+        json.dump(saved, saved_file)
+    os.replace(temporary_path, path)
+
+
+class Registry:
+    """The exported metrics.
+
+    With a ``directory``, each server process saves its metrics there every
+    ``interval`` seconds, and rendering adds those of the other processes
+    to this one's: counters and histograms of every process, including
+    ones that have exited, and gauges of the processes still running.
+    """
+
+    def __init__(self, directory=METRICS_DIR, interval=METRICS_SAVE_INTERVAL):
+        self.metrics = []
+        self.directory = directory
+        self.interval = interval
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def register(self, metric):
+        self.metrics.append(metric)
+        return metric
+
+    def clear(self):
+        for metric in self.metrics:
+            metric.clear()
+
+    def start(self):
+        """Start saving this process's metrics, if they are shared and it
+        isn't saving them yet."""
+        if not self.directory:
+            return
+        with self._lock:
+            # A thread started before a fork doesn't exist in the child
+            if self._thread is not None and self._pid == os.getpid():
+                return
+            self._thread = threading.Thread(target=self._run, name='metrics', daemon=True)
+            self._pid = os.getpid()
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.save()
+            except OSError as e:
+                logging.warning(f'Saving metrics failed: {e}')
+
+    def _snapshot(self):
+        return {metric.name: metric.snapshot() for metric in self.metrics}
+
+    def save(self):
+        """Save this process's metrics to the directory."""
+        if self.directory:
+            os.makedirs(self.directory, exist_ok=True)
+            _write_json(os.path.join(self.directory, f'{os.getpid()}.json'), self._encode(self._snapshot()))
+
+    def retire(self, pid):
+        """Merge the saved metrics of process ``pid``, which has exited, into
+        those of earlier exited processes. Only one process (the gunicorn
+        master) may call this."""
+        if not self.directory:
+            return
+        path = os.path.join(self.directory, f'{pid}.json')
+        saved = _read_json(path)
+        if saved is not None:
+            exited_path = os.path.join(self.directory, EXITED_METRICS_FILE)
+            exited = _read_json(exited_path) or {'pids': [], 'metrics': {}}
+            values = self._merge(self._decode(exited['metrics']), self._decode(saved), gauges=False)
+            # Readers skip the saved metrics of recently merged processes, in case
+            # they read them just before they were removed
+            exited = {'pids': (exited['pids'] + [pid])[-100:], 'metrics': self._encode(values)}
+            _write_json(exited_path, exited)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    @staticmethod
+    def _encode(values):
+        return {name: [[list(labelvalues), value] for labelvalues, value in metric_values.items()]
+                for name, metric_values in values.items()}
+
+    def _decode(self, saved):
+        metrics = {metric.name: metric for metric in self.metrics}
+        values = {}
+        for name, samples in saved.items():
+            if name not in metrics:
+                continue
+            values[name] = {tuple(labelvalues): tuple(value) if isinstance(value, list) else value
+                            for labelvalues, value in samples}
+        return values
+
+    def _merge(self, values, other, gauges=True):
+        """Add the values ``other`` to ``values``, leaving out gauges unless ``gauges``."""
+        for metric in self.metrics:
+            if metric.name not in other or (metric.type == 'gauge' and not gauges):
+                continue
+            merged = values.setdefault(metric.name, {})
+            for labelvalues, value in other[metric.name].items():
+                merged[labelvalues] = metric.combine(merged[labelvalues], value) if labelvalues in merged else value
+        return values
+
+    def _collect(self):
+        """The values of this process's metrics added to those saved by other processes."""
+        values = self._snapshot()
+        if not self.directory:
+            return values
+        try:
+            filenames = sorted(os.listdir(self.directory))
+        except FileNotFoundError:
+            return values
+        saved = {}
+        for filename in filenames:
+            pid, extension = os.path.splitext(filename)
+            if extension == '.json' and pid.isdigit() and int(pid) != os.getpid():
+                saved[int(pid)] = _read_json(os.path.join(self.directory, filename))
+        # Read after the other processes' files, so a process merged in between is in here
+        exited = _read_json(os.path.join(self.directory, EXITED_METRICS_FILE))
+        if exited is not None:
+            self._merge(values, self._decode(exited['metrics']), gauges=False)
+        for pid, process_values in saved.items():
+            if process_values is None or (exited is not None and pid in exited['pids']):
+                continue
+            self._merge(values, self._decode(process_values), gauges=_running(pid))
+        return values
+
+    def render(self):
+        """All metrics in the Prometheus text exposition format."""
+        values = self._collect()
+        return ''.join(metric.render(values[metric.name]) + '\n' for metric in self.metrics)
+
+
+def _running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+registry = Registry()
+
+stage_seconds = registry.register(Histogram(
+    'stamp_stage_seconds', 'Time spent in each stage of stamping a document.', ('stage',)))
+request_seconds = registry.register(Histogram(
+    'stamp_request_seconds', 'Time taken to answer a request.', ('endpoint', 'status')))
+requests_in_flight = registry.register(Gauge(
+    'stamp_requests_in_flight', 'Requests being answered.'))
+document_pages = registry.register(Histogram(
+    'stamp_document_pages', 'Pages in each stamped PDF.', buckets=PAGE_BUCKETS))
+image_pixels = registry.register(Histogram(
+    'stamp_image_pixels', 'Pixels in each stamped image, after any downscaling.', buckets=PIXEL_BUCKETS))
+
+
+# The record that stages and counts of the current thread's stamping are added to
+_local = threading.local()
+
+
+@contextmanager
+def recording(record):
+    """Add what is stamped in this thread inside the block to ``record``:
+    seconds per stage under ``'stages'``, and ``'pages'`` or ``'pixels'``."""
+    previous = getattr(_local, 'record', None)
+    _local.record = record
+    try:
+        yield record
+    finally:
+        _local.record = previous
+
+
+@contextmanager
+def stage(name):
+    """Time a stage of stamping: ingest, keying, layout, overlay, merge or write.
+
+    Stages can be nested, e.g. layout happens while an overlay is rendered.
+    """
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        stage_seconds.observe(elapsed, name)
+        record = getattr(_local, 'record', None)
+        if record is not None:
+            stages = record.setdefault('stages', {})
+            stages[name] = stages.get(name, 0) + elapsed
+
+
+def count_pages(page_count):
+    document_pages.observe(page_count)
+    record = getattr(_local, 'record', None)
+    if record is not None:
+        record['pages'] = page_count
+
+
+def count_pixels(pixel_count):
+    image_pixels.observe(pixel_count)
+    record = getattr(_local, 'record', None)
+    if record is not None:
+        record['pixels'] = pixel_count
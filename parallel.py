@@ -0,0 +1,78 @@
+import io
+import math
+import multiprocessing
+import os
+import shutil
+import tempfile
+from PyPDF2 import PdfReader, PdfWriter
+from pools import WorkerPool
+
+# PDFs with at least this many pages are stamped in chunks across processes
+PARALLEL_PAGE_THRESHOLD = int(os.getenv('PARALLEL_PAGE_THRESHOLD', 400))
+# Worker processes for page-parallel stamping (default: one per CPU core)
+PARALLEL_WORKERS = int(os.getenv('PARALLEL_WORKERS', os.cpu_count() or 1))
+# Smallest chunk worth sending to a worker
+PARALLEL_MIN_CHUNK_PAGES = int(os.getenv('PARALLEL_MIN_CHUNK_PAGES', 50))
+
+# The process pool shared by all page-parallel stamping
+parallel_pool = WorkerPool(PARALLEL_WORKERS)
+
+
+def use_parallel(page_count):
+    """Whether a PDF of ``page_count`` pages should be stamped in chunks.
+
+    Small documents stay in one process, where pool overhead would outweigh
+    the gain, and so do documents already being stamped inside a worker
+    process (such as a batch worker).
+    """
+    return (PARALLEL_WORKERS > 1 and page_count >= PARALLEL_PAGE_THRESHOLD
+            and multiprocessing.parent_process() is None)
+
+
+def page_chunks(page_count):
+    """Split ``range(page_count)`` into ``(start, stop)`` chunks.
+
+    There are a few chunks per worker, so a chunk of slow pages doesn't
+    leave the other workers idle at the end.
+    """
+    size = max(PARALLEL_MIN_CHUNK_PAGES, math.ceil(page_count / (PARALLEL_WORKERS * 4)))
+    return [(start, min(start + size, page_count)) for start in range(0, page_count, size)]
+
+
+def stamp_chunk(stamp_function, path, page_range, args, kwargs):
+    """Stamp pages ``page_range`` of the PDF at ``path`` in a worker process."""
+    output = io.BytesIO()
+    with open(path, 'rb') as file:
+        stamp_function(file, *args, output=output, page_range=page_range, **kwargs)
+    return output.getvalue()
+
+
+def stamp_parallel(stamp_function, file, page_count, args, kwargs, progress=None):
+    """Stamp a PDF in page chunks across the process pool.
+
+    ``stamp_function`` is called in the workers with ``page_range`` and the
+    given arguments, which must be picklable. The stamped chunks are
+    reassembled in page order into a PdfWriter, which is returned.
+    """
+    # Workers read the document from disk rather than receiving a copy each
+    with tempfile.NamedTemporaryFile(suffix='.pdf', delete=False) as source:
+        file.seek(0)
+        shutil.copyfileobj(file, source)
+    futures = []
+    try:
+        for page_range in page_chunks(page_count):
+            futures.append((page_range, parallel_pool.submit(stamp_chunk, stamp_function, source.name, page_range,
+                                                             args, kwargs)))
+
+        output_pdf = PdfWriter()
+        for (start, stop), future in futures:
+            for page in PdfReader(io.BytesIO(future.result())).pages:
+                output_pdf.add_page(page)
+            if progress is not None:
+                progress(stop, page_count)
+        return output_pdf
+    finally:
+        # Chunks still queued after a failure are not worth running
+        for page_range, future in futures:
+            future.cancel()
+        os.remove(source.name)
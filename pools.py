@@ -0,0 +1,56 @@
+import multiprocessing
+import os
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+# How pool worker processes are started. A server process runs request,
+# expiry, audit and job threads, and a forked child can inherit a lock one
+# of them holds, so workers come from a fork server (or are spawned)
+POOL_START_METHOD = os.getenv('POOL_START_METHOD', 'forkserver' if 'forkserver' in
+                              multiprocessing.get_all_start_methods() else 'spawn')
+
+
+class WorkerPool:
+    """A process pool that is started on first use and replaced when it breaks.
+
+    If a worker dies (for example killed for using too much memory), the
+    futures it was running fail with BrokenProcessPool and the pool is
+    dropped, so later submissions get a new one instead of failing too.
+    """
+
+    def __init__(self, max_workers, start_method=POOL_START_METHOD):
+        self.max_workers = max_workers
+        self.start_method = start_method
+        self._executor = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def executor(self):
+        with self._lock:
+            # A pool started before a fork belongs to the parent
+            if self._executor is None or self._pid != os.getpid():
+                self._executor = ProcessPoolExecutor(max_workers=self.max_workers,
+                                                     mp_context=multiprocessing.get_context(self.start_method))
+                self._pid = os.getpid()
+            return self._executor
+
+    def submit(self, function, *args, **kwargs):
+        executor = self.executor()
+        try:
+            future = executor.submit(function, *args, **kwargs)
+        except BrokenProcessPool:
+            self._discard(executor)
+            executor = self.executor()
+            future = executor.submit(function, *args, **kwargs)
+        future.add_done_callback(lambda done: self._check(executor, done))
+        return future
+
+    def _check(self, executor, future):
+        if not future.cancelled() and isinstance(future.exception(), BrokenProcessPool):
+            self._discard(executor)
+
+    def _discard(self, executor):
+        with self._lock:
+            if self._executor is executor:
+                self._executor = None
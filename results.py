@@ -0,0 +1,158 @@
+import hashlib
+import math
+import os
+import shutil
+import threading
+import time
+from storage import DEFAULT_TTL, storage
+
+# Entries are kept at <RESULTS_DIR>/<expiry bucket>/<shard>/<key>, in the
+# bucket of the stamped file they point to, so they are deleted along with it
+RESULTS_DIR = os.getenv('RESULTS_DIR', 'results')
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+_lock = threading.Lock()
+_stats = {'hits': 0, 'misses': 0, 'stored': 0}
+
+
+def _hash_file(digest, file):
+    file.seek(0)
+    while True:
+        chunk = file.read(HASH_CHUNK_SIZE)
+        if not chunk:
+            break
+        digest.update(chunk)
+    file.seek(0)
+
+
+def content_hash(file):
+    """SHA-256 of a file's contents, remembered on the file object so an
+    upload is only hashed once per request."""
+    file_hash = getattr(file, 'content_hash', None)
+    if file_hash is None:
+        file_digest = hashlib.sha256()
+        _hash_file(file_digest, file)
+        file_hash = file_digest.hexdigest()
+        try:
+            file.content_hash = file_hash
+        except AttributeError:
+            pass
+    return file_hash
+
+
+def _key_part(digest, value):
+    """Feed a stamp argument into ``digest`` in a stable form."""
+    if hasattr(value, 'read') and hasattr(value, 'seek'):
+        # Uploaded files are identified by their content, not their name
+        digest.update(b'file:' + bytes.fromhex(content_hash(value)))
+    elif hasattr(value, 'template_id'):
+        digest.update(f'template:{value.template_id}'.encode())
+    elif hasattr(value, '__dict__'):
+        # Option objects such as PageSelection and EncodeOptions
+        digest.update(f'{value.__class__.__name__}:{sorted(vars(value).items())!r}'.encode())
+    else:
+        digest.update(repr(value).encode())
+    digest.update(b'\0')
+
+
+def result_key(stamp_function, file, args, kwargs):
+    """Content hash identifying a stamp request: the document's bytes, the
+    stamp image's bytes and every other stamp setting."""
+    digest = hashlib.sha256(stamp_function.__name__.encode() + b'\0')
+    _key_part(digest, file)
+    for value in args:
+        _key_part(digest, value)
+    for name in sorted(kwargs):
+        if name == 'ttl':
+            # Checked against the stored file's expiry instead, see find_result()
+            continue
+        digest.update(name.encode() + b'=')
+        _key_part(digest, kwargs[name])
+    return digest.hexdigest()
+
+
+def _result_path(bucket, key):
+    return os.path.join(RESULTS_DIR, str(bucket), key[:2], key)
+
+
+def _buckets():
+    """The expiry buckets that have entries, in ascending order."""
+    try:
+        return sorted(int(name) for name in os.listdir(RESULTS_DIR) if name.isdigit())
+    except FileNotFoundError:
+        return []
+
+
+def find_result(key, ttl=None):
+    """Return the stamped file stored for ``key``, or None if there is none
+    that stays downloadable for at least ``ttl`` seconds (default:
+    DEFAULT_TTL), as long as a newly stamped file would."""
+    ttl = DEFAULT_TTL if ttl is None else ttl
+    # A file stamped now would expire at the end of this bucket
+    first_bucket = math.ceil((time.time() + ttl) / storage.bucket_seconds)
+    output_filename = None
+    for bucket in _buckets():
+        if bucket < first_bucket:
+            continue
+        try:
+            with open(_result_path(bucket, key)) as result_file:
+                output_filename = result_file.read().strip()
+        except FileNotFoundError:
+            continue
+        if storage.exists(output_filename):
+            break
+        # The stamped file was evicted before it expired
+        try:
+            os.remove(_result_path(bucket, key))
+        except FileNotFoundError:
+            pass
+        output_filename = None
+
+    with _lock:
+        _stats['hits' if output_filename is not None else 'misses'] += 1
+    return output_filename
+
+
+def store_result(key, output_filename):
+    """Record ``output_filename`` as the result for ``key``."""
+    expires_at = storage.expires_at(output_filename)
+    if expires_at is None:
+        return
+    path = _result_path(expires_at // storage.bucket_seconds, key)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    # Written under a temporary name and renamed, so readers never see half an entry
+    temporary_path = f'{path}.{os.getpid()}.{threading.get_ident()}'
+    with open(temporary_path, 'w') as result_file:
+        result_file.write(output_filename)
+    os.replace(temporary_path, path)
+    with _lock:
+        _stats['stored'] += 1
+
+
+def delete_expired_results(now=None):
+    """Delete the entries of expired buckets, and entries from before they
+    were kept in buckets. Returns how many buckets were deleted."""
+    now = time.time() if now is None else now
+    deleted = 0
+    try:
+        entries = list(os.scandir(RESULTS_DIR))
+    except FileNotFoundError:
+        return 0
+    for entry in entries:
+        if entry.name.isdigit():
+            if int(entry.name) * storage.bucket_seconds <= now:
+                shutil.rmtree(entry.path, ignore_errors=True)
+                deleted += 1
+        elif entry.is_file():
+            # A flat entry written before buckets
+            try:
+                os.remove(entry.path)
+            except FileNotFoundError:
+                pass
+    return deleted
+
+
+def stats():
+    with _lock:
+        return dict(_stats)
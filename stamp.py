@@ -1,49 +1,37 @@
+import hashlib
 import io
 import os
-import uuid
-from datetime import datetime
+import threading
 from PyPDF2 import PdfReader, PdfWriter
 from reportlab.lib.utils import ImageReader
 from reportlab.pdfgen import canvas
 from reportlab.lib.pagesizes import letter
 from flask import send_file
-from PIL import Image, ImageDraw, ImageFont
+from PIL import Image, ImageChops, ImageDraw
+from cache import LRUCache
+from forms import WriterForms
+from incremental import IncrementalUpdate
+from fonts import font_registry
+from image_encoding import check_image_size, image_extension, open_image, save_image
+from layout import wrap_text
+from metrics import count_pages, count_pixels, stage
+from parallel import stamp_parallel, use_parallel
+from storage import storage
 
 
-def split_text_to_fit(text, context, max_width, font_name="Helvetica", font_size=12, context_type='image'):
-    words = text.split()
-    lines = []
-    current_line = ""
+# Stamp pixels at least this light on every channel are keyed out as background
+KEY_THRESHOLD = int(os.getenv('KEY_THRESHOLD', 200))
+# Width of the alpha ramp below KEY_THRESHOLD; 0 gives a hard cutoff
+KEY_SOFTNESS = int(os.getenv('KEY_SOFTNESS', 32))
 
-    if context_type == 'image':
-        try:
-            font = ImageFont.truetype("Helvetica.ttf", font_size)
-        except IOError:
-            font = ImageFont.load_default()
-    else:
-        font = font_name
-
-    for word in words:
-        test_line = current_line + " " + word if current_line else word
-        if context_type == 'image':
-            bbox = context.textbbox((0, 0), test_line, font=font)
-            line_width = bbox[2] - bbox[0]
-            if line_width <= max_width:
-                current_line = test_line
-            else:
-                lines.append(current_line)
-                current_line = word
-        elif context_type == 'pdf':
-            if context.stringWidth(test_line, font, font_size) <= max_width:
-                current_line = test_line
-            else:
-                lines.append(current_line)
-                current_line = word
+# Keyed stamp images shared by the PDF and raster paths, keyed by content hash
+stamp_asset_cache = LRUCache(int(os.getenv('STAMP_CACHE_MAX_BYTES', 64 * 1024 * 1024)))
 
-    if current_line:
-        lines.append(current_line)
+# Resized copies of a stamp image kept for reuse by the raster path
+MAX_RESIZED_VARIANTS = 4
 
-    return lines
+# Image modes stamped in place; anything else is converted to RGBA first
+RASTER_NATIVE_MODES = ('RGB', 'RGBA')
 
 
 def calculate_position(width, height, stamp_width, stamp_height, position):
@@ -60,248 +48,526 @@ def calculate_position(width, height, stamp_width, stamp_height, position):
         return (width - stamp_width) // 2, (height - stamp_height) // 2
 
 
-def generate_unique_filename(extension):
-    unique_id = uuid.uuid4()
-    timestamp = datetime.now().strftime('%Y%m%d%H%M%S')
-    return f"{unique_id}_{timestamp}.{extension}"
-
+def overlay_key(width, height, rotation, spec):
+    return float(width), float(height), rotation, spec
+
+
+def page_overlay_key(page, spec):
+    return overlay_key(page.mediabox.width, page.mediabox.height, page.rotation, spec)
+
+
+def render_overlay_pdf(sizes, draw):
+    """Draw a stamp on a blank page of each size and return the PDF bytes."""
+    packet = io.BytesIO()
+    can = canvas.Canvas(packet)
+    for width, height in sizes:
+        can.setPageSize((width, height))
+        draw(can, width, height)
+        can.showPage()
+    can.save()
+    return packet.getvalue()
+
+
+def render_overlays(pages, spec, draw, shared_overlays=None):
+    """Return the stamp overlay pages for ``pages``, keyed by page_overlay_key.
+
+    Overlays are keyed by page geometry and stamp spec, so pages sharing a
+    mediabox and rotation reuse one rendered and parsed overlay instead of
+    redrawing it. Overlays for the remaining geometries are drawn as pages of
+    a single canvas, so their fonts and images are embedded once per document
+    however many page sizes it mixes. ``shared_overlays`` is an optional
+    LRUCache of rendered overlays that outlives the request, such as the one
+    held by a stamp template; its entries are (PDF bytes, page index).
+    """
+    overlays = {}
+    missing = {}
+    readers = {}
+    for page in pages:
+        key = page_overlay_key(page, spec)
+        if key in overlays or key in missing:
+            continue
+        entry = shared_overlays.get(key) if shared_overlays is not None else None
+        if entry is None:
+            missing[key] = (float(page.mediabox.width), float(page.mediabox.height))
+            continue
+        # Overlays rendered together share one reader, and so their resources
+        data, index = entry
+        reader = readers.get(id(data))
+        if reader is None:
+            reader = readers[id(data)] = PdfReader(io.BytesIO(data))
+        overlays[key] = reader.pages[index]
+
+    if missing:
+        with stage('overlay'):
+            data = render_overlay_pdf(missing.values(), draw)
+            reader = PdfReader(io.BytesIO(data))
+            for index, key in enumerate(missing):
+                overlays[key] = reader.pages[index]
+                if shared_overlays is not None:
+                    shared_overlays.put(key, (data, index), len(data))
+
+    return overlays
+
+
+def draw_text_lines(can, width, height, text, font, position, font_size=12):
+    """Draw ``text`` on a PDF canvas, wrapped to the page width."""
+    can.setFont(font.pdf_name, font_size)
+    # Split the text into lines that fit within the page width
+    # 40 to account for some margin
+    with stage('layout'):
+        lines = wrap_text(text, width - 40, font.name, font_size)
 
-# stamp pdf with text
-def stamp_pdf(file, stamp_text, position='center'):
-    # Read the uploaded PDF
-    input_pdf = PdfReader(file)
+    # Draw each line of text
+    for line in lines:
+        text_width = can.stringWidth(line, font.pdf_name, font_size)
+        x_position, y_position = calculate_position(width, height, text_width, font_size, position)
+        can.drawString(x_position, y_position, line)
+
+
+def key_white_to_transparent(image, threshold=KEY_THRESHOLD, softness=KEY_SOFTNESS):
+    """Make white (and near-white) pixels of a stamp image transparent.
+
+    A pixel's lightness is the darkest of its R, G and B values. Pixels at or
+    above ``threshold`` become fully transparent, pixels below
+    ``threshold - softness`` keep their alpha, and pixels in between fade
+    linearly so anti-aliased edges don't leave a white fringe. All the work is
+    done with Pillow band operations, so the cost is a few C passes over the
+    image instead of a Python loop per pixel.
+    """
+    image = image.convert("RGBA")
+    red, green, blue, alpha = image.split()
+    lightness = ImageChops.darker(ImageChops.darker(red, green), blue)
+
+    low = threshold - softness
+    lut = []
+    for value in range(256):
+        if value >= threshold:
+            lut.append(0)
+        elif value < low:
+            lut.append(255)
+        else:
+            lut.append(int(255 * (threshold - value) / softness))
+
+    key = lightness.point(lut)
+    image.putalpha(ImageChops.multiply(alpha, key))
+    return image
+
+
+class StampAsset:
+    """A stamp image keyed for transparency and ready to draw.
+
+    ``image`` is the keyed RGBA image used by the raster path and ``reader``
+    wraps it for reportlab on the PDF path. ``key`` identifies the source
+    bytes and keying parameters.
+    """
+
+    def __init__(self, image, key):
+        self.image = image
+        self.key = key
+        self.reader = ImageReader(image)
+        # Decode the pixel data up front: ImageReader fills it in lazily,
+        # which is not safe once the asset is shared between requests
+        self.reader.getRGBData()
+        self._variants = {}
+        self._variant_bytes = 0
+        self._lock = threading.Lock()
+
+    @property
+    def variant_max_bytes(self):
+        # Resized copies may take as much memory as the RGBA image itself
+        return self.image.width * self.image.height * 4
+
+    @property
+    def size(self):
+        # RGBA image plus the RGB and alpha planes held by the reader, plus
+        # room for the resized copies
+        return self.image.width * self.image.height * 8 + self.variant_max_bytes
+
+    def resized(self, size):
+        """Return the stamp image resized to ``size``, reusing recent resizes."""
+        with self._lock:
+            variant = self._variants.get(size)
+        if variant is None:
+            variant = self.image.resize(size, Image.LANCZOS)
+            variant_bytes = size[0] * size[1] * 4
+            if variant_bytes > self.variant_max_bytes:
+                # Larger than the source: not worth keeping
+                return variant
+            with self._lock:
+                if size not in self._variants:
+                    while self._variants and (len(self._variants) >= MAX_RESIZED_VARIANTS or
+                                              self._variant_bytes + variant_bytes > self.variant_max_bytes):
+                        evicted = self._variants.pop(next(iter(self._variants)))
+                        self._variant_bytes -= evicted.width * evicted.height * 4
+                    self._variants[size] = variant
+                    self._variant_bytes += variant_bytes
+        return variant
+
+
+def load_stamp_image_bytes(data, threshold=KEY_THRESHOLD, softness=KEY_SOFTNESS):
+    """Return the processed StampAsset for raw stamp image bytes.
+
+    Assets are cached by a hash of the bytes plus the keying parameters, so
+    clients that send the same seal on every request only pay for decoding
+    and keying it once.
+    """
+    key = (hashlib.sha256(data).hexdigest(), threshold, softness)
+
+    asset = stamp_asset_cache.get(key)
+    if asset is None:
+        with stage('keying'):
+            image = Image.open(io.BytesIO(data))
+            check_image_size(image)
+            asset = StampAsset(key_white_to_transparent(image, threshold, softness), key)
+        stamp_asset_cache.put(key, asset, asset.size)
+
+    return asset
+
+
+def load_stamp_asset(stamp_image_file, threshold=KEY_THRESHOLD, softness=KEY_SOFTNESS):
+    """Return the processed StampAsset for an uploaded stamp image."""
+    return load_stamp_image_bytes(stamp_image_file.read(), threshold, softness)
+
+
+def image_stamp_spec(asset, signer_text, position, stamp_width, stamp_height, font):
+    """Return the overlay cache spec for an image stamp."""
+    return 'image', asset.key, signer_text, position, stamp_width, stamp_height, font.name
+
+
+def draw_image_stamp(can, width, height, asset, signer_text, position, stamp_width, stamp_height, font):
+    # check if signer_text is None
+    if signer_text is not None:
+        draw_text_lines(can, width, height, signer_text, font, position)
+
+    x_stamp, y_stamp = calculate_position(width, height, stamp_width, stamp_height, position)
+    can.drawImage(asset.reader, x_stamp, y_stamp,
+                  width=stamp_width, height=stamp_height, mask='auto')
+
+
+def generate_unique_filename(extension, ttl=None):
+    return storage.new_name(extension, ttl)
+
+
+class PageSelection:
+    """The pages of a PDF to stamp, parsed from a spec such as ``1-3,7,last``.
+
+    The spec is a comma-separated list of 1-based page numbers, ranges
+    (``2-5``, or ``10-`` for page 10 to the end) and the keywords ``first``,
+    ``last``, ``odd``, ``even`` and ``all``. Raises ValueError for anything
+    else.
+    """
+
+    KEYWORDS = ('first', 'last', 'odd', 'even', 'all')
+
+    def __init__(self, spec):
+        self.spec = spec
+        self.parts = []
+        for part in spec.lower().replace(' ', '').split(','):
+            if part in self.KEYWORDS:
+                self.parts.append(part)
+                continue
+            start, separator, end = part.partition('-')
+            try:
+                start = int(start)
+                end = (int(end) if end else None) if separator else start
+            except ValueError:
+                raise ValueError(f'Invalid page selection: {part!r}')
+            if start < 1 or (end is not None and end < start):
+                raise ValueError(f'Invalid page range: {part!r}')
+            self.parts.append((start, end))
+
+    def includes(self, index, page_count):
+        """Whether the page at 0-based ``index`` is selected."""
+        number = index + 1
+        for part in self.parts:
+            if part == 'all':
+                return True
+            elif part == 'first':
+                if number == 1:
+                    return True
+            elif part == 'last':
+                if number == page_count:
+                    return True
+            elif part == 'odd':
+                if number % 2 == 1:
+                    return True
+            elif part == 'even':
+                if number % 2 == 0:
+                    return True
+            else:
+                start, end = part
+                if start <= number and (end is None or number <= end):
+                    return True
+        return False
+
+
+def write_output(write, extension, output=None, ttl=None):
+    """Write a stamped result with ``write(file)``.
+
+    The result goes to ``output`` when one is given, otherwise to a new file
+    in storage that expires after ``ttl`` seconds (default: DEFAULT_TTL).
+    Returns the new file's name, or None if ``output`` was used.
+    """
+    with stage('write'):
+        if output is not None:
+            write(output)
+            return None
+        return storage.save(write, extension, ttl)
+
+
+def stamp_pdf_pages(file, input_pdf, spec, draw, progress=None, output=None, incremental=False, pages=None,
+                    page_range=None, shared_overlays=None, ttl=None):
+    """Stamp the pages of ``input_pdf`` selected by ``pages`` and write the result.
+
+    ``page_range`` is a ``(start, stop)`` pair of 0-based page indexes that
+    limits the output to those pages; it is how the chunks of a page-parallel
+    run are stamped.
+    """
+    # In incremental mode the stamps are appended after the original bytes
+    # instead of re-serializing the whole document
+    update = IncrementalUpdate(input_pdf, file) if incremental else None
     output_pdf = PdfWriter()
+    forms = WriterForms(output_pdf)
+    page_count = len(input_pdf.pages)
+    start, stop = page_range or (0, page_count)
+    selected = [input_pdf.pages[index] for index in range(start, stop)
+                if pages is None or pages.includes(index, page_count)]
+    overlays = render_overlays(selected, spec, draw, shared_overlays)
+    with stage('merge'):
+        for index in range(start, stop):
+            page = input_pdf.pages[index]
+            if pages is not None and not pages.includes(index, page_count):
+                # Pages left unstamped are passed through without touching their content
+                if update is None:
+                    output_pdf.add_page(page)
+            elif update is not None:
+                update.stamp_page(page, overlays[page_overlay_key(page, spec)])
+            else:
+                # Drawn as a form shared by the pages, leaving the page content as it is
+                forms.stamp_page(page, overlays[page_overlay_key(page, spec)])
+            if progress is not None:
+                progress(index + 1, page_count)
 
-    output_filename = generate_unique_filename('pdf')
-    output_path = os.path.join('downloads', output_filename)
-
-    # Create a stamped version of the document
-    for page_number in range(len(input_pdf.pages)):
-        page = input_pdf.pages[page_number]
-
-        # Get page dimensions
-        width = float(page.mediabox.width)
-        height = float(page.mediabox.height)
-
-        # Create a canvas to add the stamp
-        packet = io.BytesIO()
-        can = canvas.Canvas(packet, pagesize=(width, height))
+    if update is not None:
+        return write_output(update.write, 'pdf', output, ttl)
+    return write_output(output_pdf.write, 'pdf', output, ttl)
 
-        # Split the text into lines that fit within the page width
-        # 40 to account for some margin
-        lines = split_text_to_fit(stamp_text, can, width - 40, 'Helvetica', 12, context_type='pdf')
 
-        # Draw each line of text
-        for line in lines:
-            text_width = can.stringWidth(line, 'Helvetica', 12)
-            x_position, y_position = calculate_position(width, height, text_width, 12, position)
-            can.drawString(x_position, y_position, line)
+# stamp pdf with text
+def stamp_pdf(file, stamp_text, position='center', progress=None, output=None, incremental=False, pages=None,
+              font=None, page_range=None, ttl=None):
+    font = font_registry.get(font, 'pdf')
 
-        can.save()
+    # Read the uploaded PDF
+    with stage('ingest'):
+        input_pdf = PdfReader(file)
+        page_count = len(input_pdf.pages)
+    if page_range is None:
+        count_pages(page_count)
+    if page_range is None and not incremental and use_parallel(page_count):
+        # Large documents are stamped in page chunks across processes
+        output_pdf = stamp_parallel(stamp_pdf, file, page_count, (stamp_text, position),
+                                    {'pages': pages, 'font': font.name}, progress)
+        return write_output(output_pdf.write, 'pdf', output, ttl)
+
+    def draw_stamp(can, width, height):
+        draw_text_lines(can, width, height, stamp_text, font, position)
 
-        # Move to the beginning of the StringIO buffer
-        packet.seek(0)
+    # Create a stamped version of the document
+    spec = ('text', stamp_text, position, font.name)
+    return stamp_pdf_pages(file, input_pdf, spec, draw_stamp, progress, output, incremental, pages, page_range,
+                           ttl=ttl)
 
-        # Read the canvas as a PDF
-        new_pdf = PdfReader(packet)
 
-        # Merge the canvas PDF with the existing page
-        page.merge_page(new_pdf.pages[0])
-        output_pdf.add_page(page)
+def composite_region(image, box, draw):
+    """Alpha-composite a stamp onto ``box`` of ``image`` in place.
 
-    with open(output_path, 'wb') as output_file:
-        output_pdf.write(output_file)
+    Only the stamp's bounding box is converted to RGBA, drawn on and
+    composited, so the memory and time used depend on the size of the stamp
+    rather than the image. ``draw(draw_context, left, top)`` draws the stamp
+    in image coordinates offset by the box origin.
+    """
+    left, top, right, bottom = box
+    left, top = max(0, left), max(0, top)
+    right, bottom = min(image.width, right), min(image.height, bottom)
+    if right <= left or bottom <= top:
+        return
 
-    return output_filename
+    region = image.crop((left, top, right, bottom)).convert('RGBA')
+    overlay = Image.new('RGBA', region.size)
+    draw(ImageDraw.Draw(overlay), left, top)
+    region = Image.alpha_composite(region, overlay)
+    image.paste(region if image.mode == 'RGBA' else region.convert(image.mode), (left, top))
 
 
 # stamp image with text
-def stamp_image(file, stamp_text, position='center'):
+def stamp_image(file, stamp_text, position='center', progress=None, output=None, font=None, encoding=None,
+                max_dimension=None, ttl=None):
+    font = font_registry.get(font, 'image')
+
     # Open the image file
-    image = Image.open(file).convert("RGBA")
+    with stage('ingest'):
+        image, source = open_image(file, RASTER_NATIVE_MODES, max_dimension)
     width, height = image.size
+    count_pixels(width * height)
 
     # Calculate font size (2.5% of image width)
-    font_size = int(width * 0.025)  # 2.5% of image width
-
-    # Create a blank RGBA image for the text overlay
-    stamp = Image.new('RGBA', (width, height))
-
-    # Create a drawing context
-    draw = ImageDraw.Draw(stamp)
-
-    # Define font (default PIL font)
-    try:
-        font_path = "font/helvetica/Helvetica.ttf"
-        font = ImageFont.truetype(font_path, font_size)
-    except IOError:
-        font = ImageFont.load_default()
+    font_size = max(1, int(width * 0.025))  # 2.5% of image width
+    image_font = font.image_font(font_size)
 
     # Split the text into lines that fit within the image width
     # 40 to account for some margin
-    lines = split_text_to_fit(stamp_text, draw, width - 40, "Helvetica", font_size, context_type='image')
+    with stage('layout'):
+        lines = wrap_text(stamp_text, width - 40, font.name, font_size, context_type='image')
 
-    # Draw each line of text
+    # Position each line of text and find the box they cover
+    placed = []
+    box = None
     for line in lines:
-        bbox = draw.textbbox((0, 0), line, font=font)
+        bbox = image_font.getbbox(line)
         text_width = bbox[2] - bbox[0]
         x_position, y_position = calculate_position(width, height, text_width, font_size, position)
-        draw.text((x_position, y_position), line, font=font, fill=(255, 255, 255, 255))  # White text
+        placed.append((x_position, y_position, line))
+        line_box = (x_position + bbox[0], y_position + bbox[1], x_position + bbox[2], y_position + bbox[3])
+        box = line_box if box is None else (min(box[0], line_box[0]), min(box[1], line_box[1]),
+                                            max(box[2], line_box[2]), max(box[3], line_box[3]))
 
-    # Combine the original image with the text overlay
-    stamped_image = Image.alpha_composite(image, stamp)
+    def draw_text(draw, left, top):
+        for x_position, y_position, line in placed:
+            draw.text((x_position - left, y_position - top), line, font=image_font,
+                      fill=(255, 255, 255, 255))  # White text
 
-    extension = file.filename.split('.')[-1].lower()
-    output_filename = generate_unique_filename(extension)
-    output_path = os.path.join('downloads', output_filename)
+    if box is not None:
+        with stage('merge'):
+            composite_region(image, box, draw_text)
 
-    stamped_image.save(output_path, format=extension)
+    extension = image_extension(source, file.filename.split('.')[-1].lower())
+    output_filename = write_output(lambda output_file: save_image(image, output_file, source, encoding),
+                                   extension, output, ttl)
+
+    if progress is not None:
+        progress(1, 1)
 
     return output_filename
 
 
 # stamp pdf with image or/and text
-def stamp_pdf_with_image(file, stamp_image_file, signer_text=None, position='center'):
+def stamp_pdf_with_image(file, stamp_image_file=None, signer_text=None, position='center', template=None,
+                         progress=None, output=None, incremental=False, pages=None, font=None, page_range=None,
+                         ttl=None):
     # Read the uploaded PDF
-    input_pdf = PdfReader(file)
-    output_pdf = PdfWriter()
-
-    output_filename = generate_unique_filename('pdf')
-    output_path = os.path.join('downloads', output_filename)
-
-    # Read the stamp image and add transparency
-    stamp_img = Image.open(stamp_image_file).convert("RGBA")
-    datas = stamp_img.getdata()
-
-    new_data = []
-    for item in datas:
-        # Change all white (also shades of whites)
-        # pixels to transparent
-        if item[0] in list(range(200, 256)):
-            new_data.append((255, 255, 255, 0))
-        else:
-            new_data.append(item)
-
-    stamp_img.putdata(new_data)
-
-    # Save the modified image to a BytesIO object
-    image_io = io.BytesIO()
-    stamp_img.save(image_io, format='PNG')
-    image_io.seek(0)
-    transparent_stamp_image = ImageReader(image_io)
+    with stage('ingest'):
+        input_pdf = PdfReader(file)
+        page_count = len(input_pdf.pages)
+    if page_range is None:
+        count_pages(page_count)
+
+    if template is not None:
+        # Registered templates come with the stamp already processed and
+        # keep their rendered overlays between requests
+        asset = template.asset
+        stamp_width, stamp_height = template.stamp_width, template.stamp_height
+        font = font_registry.get(template.font.name, 'pdf')
+        shared_overlays = template.overlays
+        stamp_image_bytes = None
+    else:
+        # Read the stamp image with transparency added
+        stamp_image_bytes = stamp_image_file.read()
+        asset = load_stamp_image_bytes(stamp_image_bytes)
+        stamp_width, stamp_height = 100, 100
+        font = font_registry.get(font, 'pdf')
+        shared_overlays = None
+
+    if page_range is None and not incremental and use_parallel(page_count):
+        # Large documents are stamped in page chunks across processes; workers
+        # load templates themselves and get uploaded stamps as bytes
+        stamp_image_copy = io.BytesIO(stamp_image_bytes) if stamp_image_bytes is not None else None
+        output_pdf = stamp_parallel(stamp_pdf_with_image, file, page_count, (stamp_image_copy, signer_text, position),
+                                    {'template': template, 'pages': pages, 'font': font.name}, progress)
+        return write_output(output_pdf.write, 'pdf', output, ttl)
+
+    def draw_stamp(can, width, height):
+        draw_image_stamp(can, width, height, asset, signer_text, position, stamp_width, stamp_height, font)
 
     # Create a stamped version of the document
-    for page_number in range(len(input_pdf.pages)):
-        page = input_pdf.pages[page_number]
-
-        # Get page dimensions
-        width = float(page.mediabox.width)
-        height = float(page.mediabox.height)
-
-        # Create a canvas to add the stamp
-        packet = io.BytesIO()
-        can = canvas.Canvas(packet, pagesize=(width, height))
-
-        # check if signer_text is None
-        if signer_text is not None:
-            # Split the text into lines that fit within the page width
-            lines = split_text_to_fit(signer_text, can, width - 40, 'Helvetica', 12, context_type='pdf')
-
-            # Calculate the total height of the text block
-            line_height = 12
-            total_text_height = line_height * len(lines)
-            y_position = 0
-
-            # Draw each line of text
-            for line in lines:
-                text_width = can.stringWidth(line, 'Helvetica', 12)
-                x_position, y_position = calculate_position(width, height, text_width, 12, position)
-                can.drawString(x_position, y_position, line)
-
-            y_position -= total_text_height
-
-        else:
-            y_position = height / 2  # Center the image vertically if no text
-
-        # Adjust position and size as needed
-        stamp_width = 100
-        stamp_height = 100
-        x_stamp,  y_stamp = calculate_position(width, height, stamp_width, stamp_height, position)
-        can.drawImage(transparent_stamp_image, x_stamp, y_stamp,
-                      width=stamp_width, height=stamp_height, mask='auto')
-        can.save()
-
-        # Move to the beginning of the StringIO buffer
-        packet.seek(0)
-
-        # Read the canvas as a PDF
-        new_pdf = PdfReader(packet)
-
-        # Merge the canvas PDF with the existing page
-        page.merge_page(new_pdf.pages[0])
-        output_pdf.add_page(page)
-
-    with open(output_path, 'wb') as output_file:
-        output_pdf.write(output_file)
-
-    return output_filename
-
-
-def stamp_image_with_image(file, stamp_image_file, signer_text=None, position='center'):
-    image = Image.open(file).convert("RGBA")
-    stamp_img = Image.open(stamp_image_file).convert("RGBA")
-
-    # Adjust the transparency of the stamp image
-    new_data = [(255, 255, 255, 0) if 200 <= pixel[0] <= 255 else pixel for pixel in stamp_img.getdata()]
-    stamp_img.putdata(new_data)
+    spec = image_stamp_spec(asset, signer_text, position, stamp_width, stamp_height, font)
+    return stamp_pdf_pages(file, input_pdf, spec, draw_stamp, progress, output, incremental, pages, page_range,
+                           shared_overlays, ttl)
+
+
+def stamp_image_with_image(file, stamp_image_file=None, signer_text=None, position='center', template=None,
+                           progress=None, output=None, font=None, encoding=None, max_dimension=None, ttl=None):
+    # Text and the stamp image are drawn straight onto the image, which only
+    # touches the pixels they cover
+    with stage('ingest'):
+        base, source = open_image(file, RASTER_NATIVE_MODES, max_dimension)
+    if template is not None:
+        asset = template.asset
+        stamp_ratio = template.stamp_ratio
+        font = template.font
+    else:
+        asset = load_stamp_asset(stamp_image_file)
+        stamp_ratio = 0.2
+        font = font_registry.get(font, 'image')
 
-    width, height = image.size
+    width, height = base.size
+    count_pixels(width * height)
 
     # Calculate the font size as 5% of the image width
-    font_size = int(width * 0.02)
-    try:
-        font_path = "font/helvetica/Helvetica.ttf"
-        font = ImageFont.truetype(font_path, font_size)
-    except IOError:
-        font = ImageFont.load_default()
-
-    base = image.copy()
+    font_size = max(1, int(width * 0.02))
+    image_font = font.image_font(font_size)
+
     draw = ImageDraw.Draw(base)
 
     if signer_text:
-        # Use the existing split_text_to_fit function
-        lines = split_text_to_fit(signer_text, draw, width - 40, "Helvetica", font_size, context_type='image')
+        with stage('layout'):
+            lines = wrap_text(signer_text, width - 40, font.name, font_size, context_type='image')
 
         # Calculate the total height of the text block
-        text_height = sum(draw.textbbox((0, 0), line, font=font)[3] -
-                          draw.textbbox((0, 0), line, font=font)[1] + 10 for line in lines)
+        text_height = sum(draw.textbbox((0, 0), line, font=image_font)[3] -
+                          draw.textbbox((0, 0), line, font=image_font)[1] + 10 for line in lines)
         text_y_position = (height // 2) - (text_height // 2)
 
         # Draw each line of text
         for line in lines:
-            bbox = draw.textbbox((0, 0), line, font=font)
+            bbox = draw.textbbox((0, 0), line, font=image_font)
             text_width = bbox[2] - bbox[0]
             text_x_position, text_y_position = calculate_position(width, height,
                                                                   text_width, bbox[3] - bbox[1], position)
-            draw.text((text_x_position, text_y_position), line, font=font, fill=(255, 0, 0, 255))
+            draw.text((text_x_position, text_y_position), line, font=image_font, fill=(255, 0, 0, 255))
             text_y_position += (bbox[3] - bbox[1]) + 10  # Adjust spacing between lines
 
-    stamp_ratio = 0.2
-    stamp_width = int(width * stamp_ratio)
-    stamp_height = int(stamp_width * (stamp_img.height / stamp_img.width))
-    stamp_img = stamp_img.resize((stamp_width, stamp_height), Image.LANCZOS)
+    # At least a pixel each way, however small the image is scaled to
+    stamp_width = max(1, int(width * stamp_ratio))
+    stamp_height = max(1, int(stamp_width * (asset.image.height / asset.image.width)))
+    stamp_img = asset.resized((stamp_width, stamp_height))
 
     x_image_position, y_image_position = calculate_position(width, height, stamp_width, stamp_height, position)
-    base.paste(stamp_img, (x_image_position, y_image_position), stamp_img)
+    with stage('merge'):
+        base.paste(stamp_img, (x_image_position, y_image_position), stamp_img)
 
-    extension = file.filename.split('.')[-1].lower()
-    if extension == 'jpg' or extension == 'jpeg':
-        base = base.convert("RGB")  # Convert to RGB before saving as JPEG
-        extension = 'jpeg'
+    extension = image_extension(source, file.filename.split('.')[-1].lower())
+    output_filename = write_output(lambda output_file: save_image(base, output_file, source, encoding),
+                                   extension, output, ttl)
 
-    output_filename = generate_unique_filename(extension)
-    output_path = os.path.join('downloads', output_filename)
-
-    base.save(output_path, format=extension)
+    if progress is not None:
+        progress(1, 1)
 
     return output_filename
+
+
+def warm_up():
+    """Stamp a blank PDF page and small PNG and JPEG images to memory.
+
+    Modules, fonts and encoders that are only loaded on first use are loaded
+    here, so a server can pay for them once, before forking its workers.
+    """
+    blank_pdf = io.BytesIO(render_overlay_pdf([letter], lambda can, width, height: None))
+    blank_pdf.filename = 'warm-up.pdf'
+    stamp_pdf(blank_pdf, 'warm-up', output=io.BytesIO())
+    for image_format, extension in (('PNG', 'png'), ('JPEG', 'jpg')):
+        image_file = io.BytesIO()
+        Image.new('RGB', (400, 300), (255, 255, 255)).save(image_file, image_format)
+        image_file.seek(0)
+        image_file.filename = f'warm-up.{extension}'
+        stamp_image(image_file, 'warm-up', output=io.BytesIO())
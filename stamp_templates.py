@@ -0,0 +1,181 @@
+import json
+import os
+import re
+import uuid
+from reportlab.lib.pagesizes import A4, letter
+from cache import LRUCache
+from fonts import font_registry
+from stamp import draw_image_stamp, image_stamp_spec, load_stamp_image_bytes, overlay_key, render_overlay_pdf
+
+TEMPLATES_DIR = 'stamp_templates'
+
+# Page sizes whose overlays are rendered when a template is registered
+PRELOAD_PAGE_SIZES = (letter, A4)
+
+# Rendered overlay PDFs kept per template
+TEMPLATE_OVERLAY_MAX_BYTES = 8 * 1024 * 1024
+
+_TEMPLATE_ID = re.compile(r'[0-9a-f]{32}')
+
+# Templates loaded at startup by preload_templates(), most recently registered first
+TEMPLATE_PRELOAD_LIMIT = int(os.getenv('TEMPLATE_PRELOAD_LIMIT', 16))
+
+# Loaded templates, shared by requests in this process
+template_cache = LRUCache(int(os.getenv('TEMPLATE_CACHE_MAX_BYTES', 256 * 1024 * 1024)))
+
+
+class StampTemplate:
+    """A registered stamp with everything reusable prepared up front.
+
+    The stamp image is keyed for transparency and decoded for reportlab once,
+    and the rendered overlays are kept between requests, so stamping with a
+    template is mostly a page merge.
+    """
+
+    def __init__(self, template_id, image_bytes, signer_text=None, position='center',
+                 stamp_width=100, stamp_height=100, stamp_ratio=0.2, font=None):
+        self.template_id = template_id
+        self.signer_text = signer_text
+        self.position = position
+        self.stamp_width = stamp_width
+        self.stamp_height = stamp_height
+        self.stamp_ratio = stamp_ratio
+        self.font = font_registry.get(font, 'image')
+        self.image_bytes = image_bytes
+        self.asset = load_stamp_image_bytes(image_bytes)
+        self.overlays = LRUCache(TEMPLATE_OVERLAY_MAX_BYTES)
+
+    @property
+    def size(self):
+        return len(self.image_bytes) + self.asset.size + self.overlays.max_bytes
+
+    def __reduce__(self):
+        # Templates are passed to worker processes with their stamp image,
+        # so a template deleted meanwhile still stamps the jobs already using it
+        settings = self.to_dict()
+        del settings['template_id']
+        return _restore_template, (self.template_id, self.image_bytes, settings)
+
+    def preload(self):
+        """Render the overlays for the common page sizes."""
+        if self.font.pdf_name is None:
+            # The template's font can only be used to stamp images
+            return
+        spec = image_stamp_spec(self.asset, self.signer_text, self.position, self.stamp_width, self.stamp_height,
+                                self.font)
+
+        def draw(can, width, height):
+            draw_image_stamp(can, width, height, self.asset, self.signer_text, self.position,
+                             self.stamp_width, self.stamp_height, self.font)
+
+        # Rendered as one document, so the overlays share their font and image
+        data = render_overlay_pdf(PRELOAD_PAGE_SIZES, draw)
+        for index, (width, height) in enumerate(PRELOAD_PAGE_SIZES):
+            self.overlays.put(overlay_key(width, height, 0, spec), (data, index), len(data))
+
+    def to_dict(self):
+        return {
+            'template_id': self.template_id,
+            'signer_text': self.signer_text,
+            'position': self.position,
+            'stamp_width': self.stamp_width,
+            'stamp_height': self.stamp_height,
+            'stamp_ratio': self.stamp_ratio,
+            'font': self.font.name,
+        }
+
+
+def _template_paths(template_id):
+    return (os.path.join(TEMPLATES_DIR, f'{template_id}.img'),
+            os.path.join(TEMPLATES_DIR, f'{template_id}.json'))
+
+
+def register_template(image_bytes, signer_text=None, position='center',
+                      stamp_width=100, stamp_height=100, stamp_ratio=0.2, font=None):
+    """Store a stamp template on disk and return it preprocessed."""
+    template_id = uuid.uuid4().hex
+    template = StampTemplate(template_id, image_bytes, signer_text, position,
+                             stamp_width, stamp_height, stamp_ratio, font)
+    template.preload()
+
+    # Persist the template so every worker process can load it
+    os.makedirs(TEMPLATES_DIR, exist_ok=True)
+    image_path, meta_path = _template_paths(template_id)
+    with open(image_path, 'wb') as image_file:
+        image_file.write(image_bytes)
+    with open(meta_path, 'w') as meta_file:
+        json.dump(template.to_dict(), meta_file)
+
+    template_cache.put(template_id, template, template.size)
+    return template
+
+
+def get_template(template_id):
+    """Return the StampTemplate for ``template_id``, or None if unknown."""
+    if not template_id or not _TEMPLATE_ID.fullmatch(template_id):
+        return None
+
+    image_path, meta_path = _template_paths(template_id)
+    template = template_cache.get(template_id)
+    if template is not None:
+        # Another process may have deleted it since it was cached here
+        if os.path.exists(meta_path):
+            return template
+        template_cache.pop(template_id)
+        return None
+
+    try:
+        with open(meta_path) as meta_file:
+            meta = json.load(meta_file)
+        with open(image_path, 'rb') as image_file:
+            image_bytes = image_file.read()
+    except FileNotFoundError:
+        return None
+
+    template = StampTemplate(template_id, image_bytes, meta['signer_text'], meta['position'],
+                             meta['stamp_width'], meta['stamp_height'], meta['stamp_ratio'],
+                             meta.get('font'))
+    template.preload()
+    template_cache.put(template_id, template, template.size)
+    return template
+
+
+def _restore_template(template_id, image_bytes, settings):
+    """Return a template passed to this process, prepared here at most once."""
+    template = template_cache.get(template_id)
+    if template is None:
+        template = StampTemplate(template_id, image_bytes, **settings)
+        template.preload()
+        template_cache.put(template_id, template, template.size)
+    return template
+
+
+def preload_templates(limit=TEMPLATE_PRELOAD_LIMIT):
+    """Load up to ``limit`` registered templates into the cache and return
+    how many were loaded."""
+    try:
+        entries = [entry for entry in os.scandir(TEMPLATES_DIR) if entry.name.endswith('.json')]
+    except FileNotFoundError:
+        return 0
+    entries.sort(key=lambda entry: entry.stat().st_mtime, reverse=True)
+    loaded = 0
+    for entry in entries[:limit]:
+        if get_template(entry.name[:-len('.json')]) is not None:
+            loaded += 1
+    return loaded
+
+
+def delete_template(template_id):
+    """Delete a stamp template. Returns False if it did not exist."""
+    if not template_id or not _TEMPLATE_ID.fullmatch(template_id):
+        return False
+
+    template_cache.pop(template_id)
+    deleted = False
+    for path in _template_paths(template_id):
+        try:
+            os.remove(path)
+            deleted = True
+        except FileNotFoundError:
+            pass
+    return deleted
@@ -0,0 +1,350 @@
+import hashlib
+import io
+import math
+import os
+import re
+import shutil
+import threading
+import time
+import uuid
+from cache import LRUCache
+
+STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'local')
+DOWNLOADS_DIR = os.getenv('DOWNLOADS_DIR', 'downloads')
+
+# How long stamped files stay downloadable, unless a request asks otherwise
+DEFAULT_TTL = int(os.getenv('DOWNLOAD_TTL_SECONDS', 24 * 3600))
+MAX_TTL = int(os.getenv('MAX_DOWNLOAD_TTL_SECONDS', 7 * 24 * 3600))
+
+# Files expiring in the same period share a bucket, which is deleted as a whole
+BUCKET_SECONDS = int(os.getenv('STORAGE_BUCKET_SECONDS', 3600))
+
+# Bytes stored files may take up, which eviction keeps them under; 0 means
+# their own size plus the free space left on the disk they are kept on
+DOWNLOADS_MAX_BYTES = int(os.getenv('DOWNLOADS_MAX_BYTES', 0))
+
+HASH_CHUNK_SIZE = 1024 * 1024
+
+# <expiry bucket>_<random hex>.<extension>
+_NAME = re.compile(r'(\d+)_([0-9a-f]{32})\.([a-z0-9]+)')
+# Names given out before buckets were introduced: <uuid>_<timestamp>.<extension>
+_LEGACY_NAME = re.compile(r'[0-9a-f-]{36}_\d{14}\.[a-z0-9]+')
+
+
+def ttl_option(ttl):
+    """Validate a requested TTL in seconds; None means DEFAULT_TTL."""
+    if ttl is None or ttl == '':
+        return None
+    try:
+        ttl = int(ttl)
+    except (TypeError, ValueError):
+        raise ValueError(f'Invalid ttl: {ttl!r}')
+    if not 60 <= ttl <= MAX_TTL:
+        raise ValueError(f'ttl must be between 60 and {MAX_TTL} seconds')
+    return ttl
+
+
+class Storage:
+    """Where stamped files are kept until they expire.
+
+    File names encode their expiry time, rounded up to a bucket of
+    BUCKET_SECONDS, so files expiring together can be deleted together
+    without an index or a stat() per file. Subclasses store the bytes.
+    """
+
+    # Whether other processes on this host see the same files
+    shared = False
+
+    def __init__(self, bucket_seconds=BUCKET_SECONDS, max_bytes=DOWNLOADS_MAX_BYTES):
+        self.bucket_seconds = bucket_seconds
+        self.max_bytes = max_bytes
+        # Stored files never change, so each one's hash is computed once
+        self._etags = LRUCache(1024 * 1024)
+
+    def new_name(self, extension, ttl=None):
+        ttl = DEFAULT_TTL if ttl is None else ttl
+        bucket = math.ceil((time.time() + ttl) / self.bucket_seconds)
+        return f'{bucket}_{uuid.uuid4().hex}.{extension}'
+
+    @staticmethod
+    def parse_name(name):
+        """Return ``(bucket, shard)`` for a valid file name, else None."""
+        match = _NAME.fullmatch(name)
+        if match is None:
+            return None
+        return match.group(1), match.group(2)[:2]
+
+    def expires_at(self, name):
+        """When ``name`` expires, as a Unix time, or None if the name is invalid."""
+        parsed = self.parse_name(name)
+        if parsed is None:
+            return None
+        return int(parsed[0]) * self.bucket_seconds
+
+    def expired(self, name, now=None):
+        expires_at = self.expires_at(name)
+        return expires_at is not None and expires_at <= (now or time.time())
+
+    def save(self, write, extension, ttl=None):
+        """Store a new file written by ``write(file)`` and return its name."""
+        name = self.new_name(extension, ttl)
+        self._write(name, write)
+        return name
+
+    def _write(self, name, write):
+        raise NotImplementedError
+
+    def open(self, name):
+        """Open a stored file for reading. Raises FileNotFoundError for
+        unknown and expired files."""
+        raise NotImplementedError
+
+    def path(self, name):
+        """The local filesystem path of ``name``, if it is kept on one."""
+        return None
+
+    def etag(self, name):
+        """A strong ETag for ``name``: the SHA-256 of its contents. Raises
+        FileNotFoundError like open()."""
+        etag = self._etags.get(name)
+        if etag is None:
+            digest = hashlib.sha256()
+            with self.open(name) as stored_file:
+                while True:
+                    chunk = stored_file.read(HASH_CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+            etag = digest.hexdigest()
+            self._etags.put(name, etag, len(name) + len(etag))
+        elif self.expired(name):
+            raise FileNotFoundError(name)
+        return etag
+
+    def size(self, name):
+        """The size of ``name`` in bytes. Raises FileNotFoundError like open()."""
+        with self.open(name) as stored_file:
+            return stored_file.seek(0, os.SEEK_END)
+
+    def exists(self, name):
+        try:
+            self.open(name).close()
+        except FileNotFoundError:
+            return False
+        return True
+
+    def delete(self, name):
+        """Delete ``name`` and return the number of bytes freed."""
+        raise NotImplementedError
+
+    def buckets(self):
+        """The buckets holding files, soonest to expire first."""
+        raise NotImplementedError
+
+    def expired_buckets(self, now=None):
+        """The buckets whose files have all expired, oldest first."""
+        now = now or time.time()
+        return [bucket for bucket in self.buckets() if int(bucket) * self.bucket_seconds <= now]
+
+    def bucket_files(self, bucket):
+        """The names of the files in ``bucket``."""
+        raise NotImplementedError
+
+    def remove_bucket(self, bucket):
+        """Forget ``bucket`` once its files have been deleted."""
+
+    def delete_legacy(self, now=None):
+        """Delete files stored before names carried their expiry."""
+
+    def used_bytes(self):
+        """The bytes taken up by stored files."""
+        raise NotImplementedError
+
+    def usage(self):
+        """Return ``(used bytes, byte budget)`` for the stored files, or None
+        if they have no budget."""
+        if not self.max_bytes:
+            return None
+        return self.used_bytes(), self.max_bytes
+
+    def delete_expired(self, now=None):
+        """Delete expired files and return how many buckets were removed."""
+        buckets = self.expired_buckets(now)
+        for bucket in buckets:
+            for name in self.bucket_files(bucket):
+                self.delete(name)
+            self.remove_bucket(bucket)
+        return len(buckets)
+
+
+class LocalStorage(Storage):
+    """Files on the local filesystem under ``root/<bucket>/<shard>/``.
+
+    The two-character shard directories keep every directory small, and
+    expired buckets are removed with one rmtree each.
+    """
+
+    shared = True
+
+    def __init__(self, root=DOWNLOADS_DIR, bucket_seconds=BUCKET_SECONDS, max_bytes=DOWNLOADS_MAX_BYTES):
+        super().__init__(bucket_seconds, max_bytes)
+        self.root = root
+
+    def path(self, name):
+        """The local path of ``name``, or None if it isn't a valid name."""
+        parsed = self.parse_name(name)
+        if parsed is not None:
+            bucket, shard = parsed
+            return os.path.join(self.root, bucket, shard, name)
+        if _LEGACY_NAME.fullmatch(name):
+            return os.path.join(self.root, name)
+        return None
+
+    def _write(self, name, write):
+        path = self.path(name)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'wb') as output_file:
+            write(output_file)
+
+    def open(self, name):
+        path = self.path(name)
+        if path is None or self.expired(name):
+            raise FileNotFoundError(name)
+        return open(path, 'rb')
+
+    def delete(self, name):
+        path = self.path(name)
+        if path is None:
+            return 0
+        try:
+            size = os.path.getsize(path)
+            os.remove(path)
+        except FileNotFoundError:
+            return 0
+        return size
+
+    def buckets(self):
+        try:
+            entries = os.listdir(self.root)
+        except FileNotFoundError:
+            return []
+        return [str(bucket) for bucket in sorted(int(entry) for entry in entries if entry.isdigit())]
+
+    def bucket_files(self, bucket):
+        names = []
+        bucket_path = os.path.join(self.root, bucket)
+        try:
+            shards = os.listdir(bucket_path)
+        except FileNotFoundError:
+            return names
+        for shard in shards:
+            try:
+                names.extend(os.listdir(os.path.join(bucket_path, shard)))
+            except (FileNotFoundError, NotADirectoryError):
+                pass
+        return names
+
+    def remove_bucket(self, bucket):
+        # Whatever is left is only empty shard directories, or files written
+        # into the bucket after it was listed, which have expired too
+        shutil.rmtree(os.path.join(self.root, bucket), ignore_errors=True)
+
+    def used_bytes(self):
+        used = 0
+        directories = [self.root]
+        while directories:
+            try:
+                entries = list(os.scandir(directories.pop()))
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+            for entry in entries:
+                try:
+                    if entry.is_dir(follow_symlinks=False):
+                        directories.append(entry.path)
+                    else:
+                        used += entry.stat(follow_symlinks=False).st_size
+                except FileNotFoundError:
+                    pass
+        return used
+
+    def usage(self):
+        if self.max_bytes:
+            return super().usage()
+        # Without a budget the files may grow into whatever else on the
+        # disk leaves free
+        try:
+            free = shutil.disk_usage(self.root).free
+        except FileNotFoundError:
+            return None
+        used = self.used_bytes()
+        return used, used + free
+
+    def delete_expired(self, now=None):
+        removed = super().delete_expired(now)
+        self.delete_legacy(now)
+        return removed
+
+    def delete_legacy(self, now=None):
+        """Delete files from before buckets, which sit directly in the root
+        and expire by age."""
+        now = now or time.time()
+        try:
+            entries = list(os.scandir(self.root))
+        except FileNotFoundError:
+            return
+        for entry in entries:
+            if entry.is_file() and _LEGACY_NAME.fullmatch(entry.name) and now - entry.stat().st_mtime > DEFAULT_TTL:
+                try:
+                    os.remove(entry.path)
+                except FileNotFoundError:
+                    pass
+
+
+class MemoryStorage(Storage):
+    """Files kept in memory, for tests and single-process development servers."""
+
+    def __init__(self, bucket_seconds=BUCKET_SECONDS, max_bytes=DOWNLOADS_MAX_BYTES):
+        super().__init__(bucket_seconds, max_bytes)
+        self.files = {}
+        self._lock = threading.Lock()
+
+    def _write(self, name, write):
+        buffer = io.BytesIO()
+        write(buffer)
+        with self._lock:
+            self.files[name] = buffer.getvalue()
+
+    def open(self, name):
+        with self._lock:
+            data = self.files.get(name)
+        if data is None or self.expired(name):
+            raise FileNotFoundError(name)
+        return io.BytesIO(data)
+
+    def delete(self, name):
+        with self._lock:
+            return len(self.files.pop(name, b''))
+
+    def used_bytes(self):
+        with self._lock:
+            return sum(len(data) for data in self.files.values())
+
+    def buckets(self):
+        with self._lock:
+            names = list(self.files)
+        return [str(bucket) for bucket in sorted({int(self.parse_name(name)[0]) for name in names})]
+
+    def bucket_files(self, bucket):
+        with self._lock:
+            return [name for name in self.files if self.parse_name(name)[0] == bucket]
+
+
+def create_storage(backend=STORAGE_BACKEND):
+    if backend == 'local':
+        return LocalStorage()
+    if backend == 'memory':
+        return MemoryStorage()
+    raise ValueError(f'Unknown storage backend: {backend!r}')
+
+
+storage = create_storage()
@@ -0,0 +1,87 @@
+import queue
+import threading
+
+# Bytes collected before a chunk is handed to the response
+CHUNK_SIZE = 64 * 1024
+# Chunks allowed to wait for the client before the writer blocks
+MAX_PENDING_CHUNKS = 16
+
+_DONE = object()
+
+
+class ResponseCancelled(Exception):
+    pass
+
+
+class StreamingOutput:
+    """A write-only file object whose contents are streamed to an HTTP response.
+
+    A stamp function writes to it from a background thread while the response
+    iterates over ``chunks()``. The queue between them is bounded, so a slow
+    client slows the writer down instead of letting the output pile up in
+    memory. ``tell()`` is supported because PdfWriter records object offsets.
+    """
+
+    def __init__(self):
+        self._queue = queue.Queue(maxsize=MAX_PENDING_CHUNKS)
+        self._buffer = bytearray()
+        self._position = 0
+        self._error = None
+        self._cancelled = threading.Event()
+
+    def write(self, data):
+        if self._cancelled.is_set():
+            raise ResponseCancelled()
+        self._buffer += data
+        self._position += len(data)
+        if len(self._buffer) >= CHUNK_SIZE:
+            self._put(bytes(self._buffer))
+            self._buffer.clear()
+        return len(data)
+
+    def tell(self):
+        return self._position
+
+    def flush(self):
+        pass
+
+    def _put(self, item):
+        while not self._cancelled.is_set():
+            try:
+                self._queue.put(item, timeout=1)
+                return
+            except queue.Full:
+                continue
+        raise ResponseCancelled()
+
+    def start(self, write):
+        """Run ``write(self)`` in a background thread."""
+        def run():
+            try:
+                write(self)
+                if self._buffer:
+                    self._put(bytes(self._buffer))
+            except ResponseCancelled:
+                return
+            except Exception as e:
+                self._error = e
+            try:
+                self._put(_DONE)
+            except ResponseCancelled:
+                pass
+
+        threading.Thread(target=run, daemon=True).start()
+
+    def chunks(self):
+        """Yield the written bytes, re-raising any error from the writer."""
+        try:
+            while True:
+                chunk = self._queue.get()
+                if chunk is _DONE:
+                    break
+                yield chunk
+            if self._error is not None:
+                raise self._error
+        finally:
+            # Unblock the writer if the client went away
+            self._cancelled.set()
@@ -0,0 +1,40 @@
+import io
+import os
+import sys
+import tempfile
+
+import pytest
+
+# The modules live at the repository root
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# Keep the audit log of requests made by the tests out of the working tree
+os.environ.setdefault('AUDIT_LOG_FILE', os.path.join(tempfile.gettempdir(), 'stamping-tests.log'))
+
+
+def make_pdf(page_count=1, size=(300, 400)):
+    """A PDF of ``page_count`` pages with a line of text on each."""
+    from reportlab.pdfgen import canvas
+
+    data = io.BytesIO()
+    can = canvas.Canvas(data, pagesize=size)
+    for number in range(page_count):
+        can.drawString(50, 200, f'Page {number + 1}')
+        can.showPage()
+    can.save()
+    return data.getvalue()
+
+
+@pytest.fixture
+def client(tmp_path, monkeypatch):
+    """A test client of the app that keeps everything it writes under ``tmp_path``."""
+    import app
+    import jobs
+    import results
+    import stamp_templates
+    from storage import storage
+
+    monkeypatch.setattr(storage, 'root', str(tmp_path / 'downloads'))
+    monkeypatch.setattr(results, 'RESULTS_DIR', str(tmp_path / 'results'))
+    monkeypatch.setattr(jobs, 'JOBS_DIR', str(tmp_path / 'jobs'))
+    monkeypatch.setattr(stamp_templates, 'TEMPLATES_DIR', str(tmp_path / 'templates'))
+    return app.app.test_client()
@@ -0,0 +1,149 @@
+import io
+import threading
+import zlib
+
+import pytest
+from PIL import Image
+
+import admission
+from admission import InputTooLarge, Saturated, WorkLimiter, estimate_cost
+from conftest import make_pdf
+
+
+def raw_pdf(objects):
+    """A PDF made of ``objects`` (object 1 is the catalog), with a classic
+    cross-reference table."""
+    data = io.BytesIO()
+    data.write(b'%PDF-1.4\n')
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(data.tell())
+        data.write(b'%d 0 obj\n%s\nendobj\n' % (number, obj))
+    xref_offset = data.tell()
+    data.write(b'xref\n0 %d\n0000000000 65535 f \n' % (len(objects) + 1))
+    for offset in offsets:
+        data.write(b'%010d 00000 n \n' % offset)
+    data.write(b'trailer\n<< /Size %d /Root 1 0 R >>\nstartxref\n%d\n%%%%EOF\n' % (len(objects) + 1, xref_offset))
+    return data.getvalue()
+
+
+def one_page_pdf(page_entries=b'', extra_objects=()):
+    return raw_pdf([
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 200 200] ' + page_entries + b' >>',
+        *extra_objects,
+    ])
+
+
+def flate_stream(data, entries=b''):
+    compressed = zlib.compress(data)
+    return b'<< /Length %d /Filter /FlateDecode %s >>\nstream\n%s\nendstream' % (len(compressed), entries, compressed)
+
+
+def pdf_cost(data):
+    return estimate_cost(io.BytesIO(data), 'pdf')
+
+
+def test_pdfs_cost_their_pages():
+    assert pdf_cost(make_pdf(1)) == 1
+    assert pdf_cost(make_pdf(12)) == 12
+
+
+def test_declared_page_count_is_not_trusted(monkeypatch):
+    data = make_pdf(30)
+    assert b'/Count 30' in data
+    lying = data.replace(b'/Count 30', b'/Count 1 ')
+    assert pdf_cost(lying) == 30
+
+    monkeypatch.setattr(admission, 'MAX_PDF_PAGES', 10)
+    with pytest.raises(InputTooLarge):
+        pdf_cost(lying)
+
+
+def test_page_tree_cycles_end():
+    data = raw_pdf([
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R 2 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 200 200] >>',
+    ])
+    assert pdf_cost(data) == 1
+
+
+def test_page_content_that_decompresses_too_far_is_refused(monkeypatch):
+    monkeypatch.setattr(admission, 'MAX_PDF_PAGE_CONTENT_BYTES', 1024 * 1024)
+    small = one_page_pdf(b'/Contents 4 0 R', [flate_stream(b'\n' * 1000)])
+    assert pdf_cost(small) == 1
+    bomb = one_page_pdf(b'/Contents 4 0 R', [flate_stream(b'\n' * (10 * 1024 * 1024))])
+    with pytest.raises(InputTooLarge):
+        pdf_cost(bomb)
+
+
+def test_embedded_images_over_the_pixel_limit_are_refused(monkeypatch):
+    monkeypatch.setattr(admission, 'MAX_IMAGE_PIXELS', 1_000_000)
+    image = flate_stream(b'\0' * 3, b'/Type /XObject /Subtype /Image /Width 5000 /Height 5000 '
+                                     b'/ColorSpace /DeviceGray /BitsPerComponent 8')
+    data = one_page_pdf(b'/Resources << /XObject << /Im0 4 0 R >> >>', [image])
+    with pytest.raises(InputTooLarge):
+        pdf_cost(data)
+
+
+def png(width, height):
+    data = io.BytesIO()
+    Image.new('RGB', (width, height)).save(data, 'PNG')
+    data.seek(0)
+    return data
+
+
+def test_images_cost_their_megapixels():
+    assert estimate_cost(png(10, 10), 'png') == 1
+    assert estimate_cost(png(2000, 1500), 'png') == 3
+
+
+def test_unreadable_files_cost_one():
+    assert estimate_cost(io.BytesIO(b'not a pdf'), 'pdf') == 1
+    assert estimate_cost(io.BytesIO(b'not an image'), 'png') == 1
+
+
+def test_clients_past_their_share_are_throttled():
+    limiter = WorkLimiter(capacity=10, client_share=0.5)
+    held = limiter.acquire(4, 'client')
+    with pytest.raises(Saturated) as refused:
+        limiter.acquire(2, 'client', timeout=0)
+    assert refused.value.status == 429
+    # Other clients still get in
+    limiter.release(limiter.acquire(2, 'other', timeout=0), 'other')
+    limiter.release(held, 'client')
+    assert limiter.acquire(2, 'client', timeout=0) == 2
+    assert limiter.stats()['throttled'] == 1
+
+
+def test_requests_wait_for_capacity_or_are_refused():
+    limiter = WorkLimiter(capacity=10, client_share=1)
+    held = limiter.acquire(8)
+    with pytest.raises(Saturated) as refused:
+        limiter.acquire(5, timeout=0)
+    assert refused.value.status == 503
+
+    # Released capacity wakes a waiting request
+    threading.Timer(0.05, limiter.release, (held,)).start()
+    assert limiter.acquire(5, timeout=5) == 5
+    assert limiter.stats()['in_use'] == 5
+
+
+def test_oversized_requests_get_413(client, monkeypatch):
+    monkeypatch.setattr(admission, 'MAX_PDF_PAGES', 10)
+    lying = make_pdf(30).replace(b'/Count 30', b'/Count 1 ')
+    response = client.post('/api/stamp/text', data={'file': (io.BytesIO(lying), 'document.pdf'), 'stamp': 'DRAFT'})
+    assert response.status_code == 413
+    assert response.get_json()['status'] == 'fail'
+
+
+def test_busy_server_answers_503_with_retry_after(client, monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'work_limiter', WorkLimiter(capacity=10, client_share=1))
+    app.work_limiter.acquire(10)
+    response = client.post('/api/stamp/text', data={'file': (io.BytesIO(make_pdf()), 'document.pdf'),
+                                                    'stamp': 'DRAFT'})
+    assert response.status_code == 503
+    assert response.headers['Retry-After'] == str(admission.ADMISSION_RETRY_AFTER_SECONDS)
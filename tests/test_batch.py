@@ -0,0 +1,89 @@
+import base64
+import io
+import zipfile
+
+import pytest
+
+import admission
+import batch
+from admission import InputTooLarge
+from batch import check_documents, read_archive
+from conftest import make_pdf
+
+
+def make_zip(members):
+    data = io.BytesIO()
+    with zipfile.ZipFile(data, 'w', zipfile.ZIP_DEFLATED) as zip_file:
+        for name, content in members.items():
+            zip_file.writestr(name, content)
+    data.seek(0)
+    return data
+
+
+def test_archive_members_are_loaded_on_demand():
+    documents = read_archive(make_zip({'a.pdf': b'first', 'nested/b.png': b'second'}))
+    assert [filename for filename, load in documents] == ['a.pdf', 'b.png']
+    assert [load() for filename, load in documents] == [b'first', b'second']
+
+
+def test_archives_with_too_many_files_are_refused(monkeypatch):
+    monkeypatch.setattr(batch, 'BATCH_MAX_DOCUMENTS', 2)
+    with pytest.raises(InputTooLarge):
+        read_archive(make_zip({f'{number}.pdf': b'x' for number in range(3)}))
+
+
+def test_archives_that_expand_too_far_are_refused(monkeypatch):
+    monkeypatch.setattr(batch, 'MAX_UPLOAD_BYTES', 1024)
+    with pytest.raises(InputTooLarge):
+        read_archive(make_zip({'a.pdf': b'\0' * 2048}))
+
+    monkeypatch.setattr(batch, 'BATCH_MAX_BYTES', 1536)
+    with pytest.raises(InputTooLarge):
+        read_archive(make_zip({'a.pdf': b'\0' * 1000, 'b.pdf': b'\0' * 1000}))
+
+
+def test_documents_too_large_to_stamp_are_rejected(monkeypatch):
+    monkeypatch.setattr(admission, 'MAX_PDF_PAGES', 10)
+    lying = make_pdf(30).replace(b'/Count 30', b'/Count 1 ')
+    documents = [('a.pdf', lambda: make_pdf(2)), ('b.pdf', lambda: lying), ('notes.txt', lambda: b'notes')]
+    cost, rejected = check_documents(documents)
+    assert cost == 2
+    assert list(rejected) == [1]
+
+
+def encoded(data):
+    return base64.b64encode(data).decode()
+
+
+def test_batches_without_files_are_refused(client):
+    response = client.post('/api/stamp/batch', json={'files': []})
+    assert response.status_code == 400
+    assert response.get_json()['message'] == 'No files to stamp'
+
+
+def test_batches_over_the_document_limit_are_refused(client, monkeypatch):
+    import app
+    monkeypatch.setattr(app, 'BATCH_MAX_DOCUMENTS', 2)
+    files = [{'file': encoded(b'x'), 'filename': f'{number}.pdf'} for number in range(3)]
+    assert client.post('/api/stamp/batch', json={'files': files}).status_code == 413
+
+    monkeypatch.setattr(batch, 'BATCH_MAX_DOCUMENTS', 2)
+    archive = make_zip({f'{number}.pdf': b'x' for number in range(3)})
+    assert client.post('/api/stamp/batch', data={'archive': (archive, 'a.zip')}).status_code == 413
+
+
+def test_invalid_archives_are_refused(client):
+    response = client.post('/api/stamp/batch', data={'archive': (io.BytesIO(b'not a zip'), 'a.zip')})
+    assert response.status_code == 400
+    assert response.get_json()['message'] == 'Invalid zip archive'
+
+
+def test_documents_that_cant_be_stamped_are_listed_as_failed(client, monkeypatch):
+    monkeypatch.setattr(admission, 'MAX_PDF_PAGES', 10)
+    lying = make_pdf(30).replace(b'/Count 30', b'/Count 1 ')
+    files = [{'file': encoded(lying), 'filename': 'long.pdf'}, {'file': encoded(b'notes'), 'filename': 'notes.txt'}]
+    response = client.post('/api/stamp/batch', json={'files': files})
+    assert response.status_code == 200
+    documents = response.get_json()['documents']
+    assert [document['status'] for document in documents] == ['fail', 'fail']
+    assert documents[1]['message'] == 'Unsupported file type'
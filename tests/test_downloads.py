@@ -0,0 +1,63 @@
+import io
+import os
+
+import pytest
+
+from conftest import make_pdf
+
+
+@pytest.fixture
+def download(client):
+    """The path of a freshly stamped PDF and its bytes."""
+    response = client.post('/api/stamp/text', data={'file': (io.BytesIO(make_pdf(3)), 'document.pdf'),
+                                                    'stamp': 'DRAFT'})
+    path = '/download/' + response.get_json()['download_link'].rsplit('/', 1)[1]
+    return path, client.get(path).data
+
+
+def test_downloads_carry_an_etag_and_expiry(client, download):
+    path, data = download
+    response = client.get(path)
+    assert response.status_code == 200
+    assert response.data == data
+    assert response.headers['ETag']
+    assert response.headers['Accept-Ranges'] == 'bytes'
+    assert 'private' in response.headers['Cache-Control']
+    assert 'immutable' in response.headers['Cache-Control']
+
+
+def test_matching_etag_gets_not_modified(client, download):
+    path, data = download
+    etag = client.get(path).headers['ETag']
+    response = client.get(path, headers={'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.data == b''
+    assert client.get(path, headers={'If-None-Match': '"other"'}).status_code == 200
+
+
+def test_byte_ranges_are_served(client, download):
+    path, data = download
+    response = client.get(path, headers={'Range': 'bytes=0-9'})
+    assert response.status_code == 206
+    assert response.data == data[:10]
+    assert response.headers['Content-Range'] == f'bytes 0-9/{len(data)}'
+
+    response = client.get(path, headers={'Range': 'bytes=-5'})
+    assert response.status_code == 206
+    assert response.data == data[-5:]
+
+
+def test_unsatisfiable_ranges_are_refused(client, download):
+    path, data = download
+    response = client.get(path, headers={'Range': f'bytes={len(data) + 10}-'})
+    assert response.status_code == 416
+
+
+def test_expired_and_unknown_files_are_not_found(client, tmp_path):
+    assert client.get('/download/1_' + 'ab' * 16 + '.pdf').status_code == 404
+    # A file still on disk past its expiry isn't served either
+    expired = tmp_path / 'downloads' / '1' / 'cd'
+    os.makedirs(expired)
+    (expired / ('1_cd' + 'ef' * 15 + '.pdf')).write_bytes(b'%PDF')
+    assert client.get('/download/1_cd' + 'ef' * 15 + '.pdf').status_code == 404
+    assert client.get('/download/../app.py').status_code == 404
@@ -0,0 +1,142 @@
+import io
+
+import pytest
+from PyPDF2 import PdfReader, PdfWriter
+from PyPDF2.generic import DictionaryObject
+from reportlab.pdfgen import canvas
+
+from incremental import IncrementalUpdate
+from stamp import PageSelection, stamp_pdf
+
+
+def table_pdf(page_count=2):
+    """A PDF with a classic cross-reference table, as reportlab writes."""
+    data = io.BytesIO()
+    can = canvas.Canvas(data, pagesize=(300, 400))
+    for number in range(page_count):
+        can.drawString(50, 200, f'Page {number + 1}')
+        can.showPage()
+    can.save()
+    return data.getvalue()
+
+
+def xref_stream_pdf():
+    """A one-page PDF whose cross-reference section is a stream."""
+    content = b'BT /F1 12 Tf 50 100 Td (Page 1) Tj ET'
+    objects = [
+        b'<< /Type /Catalog /Pages 2 0 R >>',
+        b'<< /Type /Pages /Kids [3 0 R] /Count 1 >>',
+        b'<< /Type /Page /Parent 2 0 R /MediaBox [0 0 200 200] /Contents 4 0 R '
+        b'/Resources << /Font << /F1 << /Type /Font /Subtype /Type1 /BaseFont /Helvetica >> >> >> >>',
+        b'<< /Length %d >>\nstream\n%s\nendstream' % (len(content), content),
+    ]
+    data = io.BytesIO()
+    data.write(b'%PDF-1.5\n')
+    offsets = []
+    for number, obj in enumerate(objects, 1):
+        offsets.append(data.tell())
+        data.write(b'%d 0 obj\n%s\nendobj\n' % (number, obj))
+    xref_offset = data.tell()
+    offsets.append(xref_offset)
+    rows = b'\x00' + (0).to_bytes(4, 'big') + (65535).to_bytes(2, 'big')
+    rows += b''.join(b'\x01' + offset.to_bytes(4, 'big') + (0).to_bytes(2, 'big') for offset in offsets)
+    data.write(b'%d 0 obj\n<< /Type /XRef /Size %d /W [1 4 2] /Root 1 0 R /Length %d >>\nstream\n'
+               % (len(offsets), len(offsets) + 1, len(rows)))
+    data.write(rows + b'\nendstream\nendobj\nstartxref\n%d\n%%%%EOF\n' % xref_offset)
+    return data.getvalue()
+
+
+def startxref(data):
+    return int(data[data.rindex(b'startxref') + len(b'startxref'):].split()[0])
+
+
+def stamp_incrementally(data, text='STAMPED', pages=None):
+    file = io.BytesIO(data)
+    file.filename = 'document.pdf'
+    output = io.BytesIO()
+    stamp_pdf(file, text, output=output, incremental=True, pages=pages)
+    return output.getvalue()
+
+
+def content(page):
+    return b'\n'.join(part.get_object().get_data() for part in page['/Contents'])
+
+
+def stamp_names(page):
+    xobjects = page['/Resources'].get('/XObject', {})
+    return [name for name in xobjects if name.startswith('/Stamp')]
+
+
+@pytest.mark.parametrize('make_pdf', [table_pdf, xref_stream_pdf])
+def test_original_bytes_are_kept(make_pdf):
+    original = make_pdf()
+    stamped = stamp_incrementally(original)
+    assert stamped.startswith(original)
+    assert len(stamped) > len(original)
+
+
+@pytest.mark.parametrize('make_pdf', [table_pdf, xref_stream_pdf])
+def test_every_page_draws_the_stamp(make_pdf):
+    original = make_pdf()
+    reader = PdfReader(io.BytesIO(stamp_incrementally(original)))
+    assert len(reader.pages) == len(PdfReader(io.BytesIO(original)).pages)
+    for page in reader.pages:
+        names = stamp_names(page)
+        assert len(names) == 1
+        assert f'{names[0]} Do'.encode() in content(page)
+
+
+def test_table_update_points_back_to_the_original_table():
+    original = table_pdf()
+    update = stamp_incrementally(original)[len(original):]
+    assert b'\nxref\n0 1\n0000000000 65535 f\r\n' in update
+    assert b'/Prev %d' % startxref(original) in update
+    assert b'/XRef' not in update
+
+
+def test_stream_update_writes_a_cross_reference_stream():
+    original = xref_stream_pdf()
+    update = stamp_incrementally(original)[len(original):]
+    assert b'/Type /XRef' in update
+    assert b'/Prev %d' % startxref(original) in update
+    assert b'\nxref\n' not in update
+    assert b'trailer' not in update
+
+
+@pytest.mark.parametrize('make_pdf', [table_pdf, xref_stream_pdf])
+def test_updates_can_be_chained(make_pdf):
+    original = make_pdf()
+    first = stamp_incrementally(original, 'FIRST')
+    second = stamp_incrementally(first, 'SECOND')
+    assert second.startswith(first)
+    assert b'/Prev %d' % startxref(first) in second[len(first):]
+
+    reader = PdfReader(io.BytesIO(second))
+    for page in reader.pages:
+        assert len(stamp_names(page)) == 2
+
+
+def test_new_objects_are_numbered_after_existing_ones():
+    original = table_pdf()
+    reader = PdfReader(io.BytesIO(original))
+    update = IncrementalUpdate(reader, io.BytesIO(original))
+    assert update.next_number == int(reader.trailer['/Size'])
+    reference = update.add(DictionaryObject())
+    assert reference.idnum == int(reader.trailer['/Size'])
+
+
+def test_unselected_pages_are_left_alone():
+    original = table_pdf(3)
+    reader = PdfReader(io.BytesIO(stamp_incrementally(original, pages=PageSelection('2'))))
+    assert [len(stamp_names(page)) for page in reader.pages] == [0, 1, 0]
+
+
+def test_encrypted_pdfs_are_refused():
+    writer = PdfWriter()
+    writer.append_pages_from_reader(PdfReader(io.BytesIO(table_pdf())))
+    writer.encrypt('secret')
+    data = io.BytesIO()
+    writer.write(data)
+    reader = PdfReader(io.BytesIO(data.getvalue()))
+    with pytest.raises(ValueError):
+        IncrementalUpdate(reader, io.BytesIO(data.getvalue()))
@@ -0,0 +1,149 @@
+import io
+import os
+import threading
+import time
+
+import pytest
+
+import jobs
+from conftest import make_pdf
+from jobs import JOB_LOST_ERROR, Job, JobQueue
+
+
+@pytest.fixture(autouse=True)
+def jobs_dir(tmp_path, monkeypatch):
+    monkeypatch.setattr(jobs, 'JOBS_DIR', str(tmp_path / 'jobs'))
+
+
+def wait_for(job_queue, job_id, statuses=('done', 'failed')):
+    for _ in range(200):
+        job = job_queue.get(job_id)
+        if job.status in statuses:
+            return job
+        time.sleep(0.01)
+    raise AssertionError(f'Job {job_id} is still {job.status}')
+
+
+def test_job_runs_from_queued_to_done():
+    release = threading.Event()
+    seen = []
+
+    def work(progress):
+        release.wait(5)
+        progress(1, 2)
+        seen.append(Job.load(job.job_id).status)
+        return 'stamped.pdf'
+
+    job_queue = JobQueue(1, 4)
+    blocker = job_queue.submit(lambda progress: release.wait(5) and 'first.pdf')
+    job = job_queue.submit(work)
+    # Waiting behind the first job, and saved for other processes to read
+    assert Job.load(job.job_id).status == 'queued'
+    release.set()
+
+    done = wait_for(job_queue, job.job_id)
+    assert seen == ['running']
+    assert done.to_dict() == {'job_id': job.job_id, 'status': 'done', 'pages_done': 1, 'pages_total': 2,
+                              'error': None}
+    assert Job.load(job.job_id).output_filename == 'stamped.pdf'
+    assert wait_for(job_queue, blocker.job_id).status == 'done'
+
+
+def test_failed_work_is_reported():
+    def work(progress):
+        raise ValueError('Invalid PDF')
+
+    job_queue = JobQueue(1, 4)
+    job = wait_for(job_queue, job_queue.submit(work).job_id)
+    assert job.status == 'failed'
+    assert job.error == 'Invalid PDF'
+
+
+def test_status_is_read_by_other_processes():
+    job_queue = JobQueue(1, 4)
+    job = wait_for(job_queue, job_queue.submit(lambda progress: 'stamped.pdf').job_id)
+    # A queue in another process only has the saved status
+    loaded = JobQueue(1, 4).get(job.job_id)
+    assert loaded.to_dict() == job.to_dict()
+    assert JobQueue(1, 4).get('ab' * 16) is None
+    assert Job.load('../../etc/passwd') is None
+
+
+def test_full_queue_refuses_jobs():
+    release = threading.Event()
+    job_queue = JobQueue(1, 1)
+    running = job_queue.submit(lambda progress: release.wait(5) and 'running.pdf')
+    time.sleep(0.05)
+    queued = job_queue.submit(lambda progress: 'queued.pdf')
+    assert job_queue.submit(lambda progress: 'refused.pdf') is None
+    release.set()
+    wait_for(job_queue, running.job_id)
+    wait_for(job_queue, queued.job_id)
+
+
+def test_drain_fails_jobs_left_unfinished():
+    release = threading.Event()
+    job_queue = JobQueue(1, 4)
+    running = job_queue.submit(lambda progress: release.wait(5) and 'running.pdf')
+    queued = job_queue.submit(lambda progress: 'queued.pdf')
+    job_queue.drain(timeout=0.1)
+    for job in (running, queued):
+        assert Job.load(job.job_id).status == 'failed'
+        assert Job.load(job.job_id).error == JOB_LOST_ERROR
+    assert job_queue.submit(lambda progress: 'late.pdf') is None
+    release.set()
+    job_queue._queue.join()
+
+
+def test_sweep_fails_jobs_lost_with_their_process_and_deletes_old_ones():
+    lost = Job(None)
+    lost.status = 'running'
+    lost.save()
+    finished = Job(None)
+    finished.status = 'done'
+    finished.finished_at = time.time()
+    finished.save()
+
+    job_queue = JobQueue(1, 4)
+    job_queue.sweep()
+    assert Job.load(lost.job_id).status == 'running'
+
+    job_queue.sweep(now=time.time() + jobs.JOB_STALE_SECONDS + 1)
+    assert Job.load(lost.job_id).status == 'failed'
+    assert Job.load(lost.job_id).error == JOB_LOST_ERROR
+
+    job_queue.sweep(now=time.time() + jobs.JOB_RESULT_TTL + 1)
+    assert Job.load(lost.job_id) is None
+    assert Job.load(finished.job_id) is None
+
+
+def test_sweep_keeps_this_processs_jobs_alive():
+    release = threading.Event()
+    job_queue = JobQueue(1, 4)
+    job = job_queue.submit(lambda progress: release.wait(5) and 'slow.pdf')
+    path = jobs.job_path(job.job_id)
+    os.utime(path, (0, 0))
+    job_queue.sweep()
+    # Touched again, so other processes don't take it for lost
+    assert os.path.getmtime(path) > time.time() - 60
+    release.set()
+    job_queue._queue.join()
+
+
+def test_async_stamping_lifecycle(client):
+    response = client.post('/api/stamp/text?async=1', data={'file': (io.BytesIO(make_pdf(3)), 'document.pdf'),
+                                                            'stamp': 'DRAFT'})
+    assert response.status_code == 202
+    job_id = response.get_json()['job_id']
+
+    for _ in range(200):
+        body = client.get(f'/api/jobs/{job_id}').get_json()
+        if body['job']['status'] in ('done', 'failed'):
+            break
+        time.sleep(0.01)
+    assert body['job']['status'] == 'done'
+    assert body['job']['pages_done'] == body['job']['pages_total'] == 3
+    download = '/download/' + body['download_link'].rsplit('/', 1)[1]
+    assert client.get(download).data.startswith(b'%PDF')
+
+    assert client.get('/api/jobs/' + 'ab' * 16).status_code == 404
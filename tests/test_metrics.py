@@ -0,0 +1,130 @@
+import json
+import os
+
+import pytest
+
+from metrics import Collected, Counter, Gauge, Histogram, Registry
+
+# No process has this ID, so its saved metrics are those of an exited process
+EXITED_PID = 2 ** 22 + 1
+
+
+def make_registry(directory=''):
+    registry = Registry(directory)
+    registry.register(Counter('stamps_total', 'Stamps.', ('kind',)))
+    registry.register(Gauge('in_flight', 'Requests in flight.'))
+    registry.register(Histogram('seconds', 'Latency.', buckets=(1, 5)))
+    return registry
+
+
+def metric(registry, name):
+    return next(metric for metric in registry.metrics if metric.name == name)
+
+
+def save_as(registry, pid, directory):
+    """Save ``registry`` as if it belonged to process ``pid``."""
+    with open(os.path.join(directory, f'{pid}.json'), 'w') as saved_file:
+        json.dump(registry._encode(registry._snapshot()), saved_file)
+
+
+def test_render_in_the_text_format():
+    registry = make_registry()
+    metric(registry, 'stamps_total').inc('pdf')
+    metric(registry, 'stamps_total').inc('pdf')
+    metric(registry, 'in_flight').set(3)
+    metric(registry, 'seconds').observe(0.5)
+    metric(registry, 'seconds').observe(3)
+    metric(registry, 'seconds').observe(30)
+    assert registry.render() == (
+        '# HELP stamps_total Stamps.\n'
+        '# TYPE stamps_total counter\n'
+        'stamps_total{kind="pdf"} 2\n'
+        '# HELP in_flight Requests in flight.\n'
+        '# TYPE in_flight gauge\n'
+        'in_flight 3\n'
+        '# HELP seconds Latency.\n'
+        '# TYPE seconds histogram\n'
+        'seconds_bucket{le="1"} 1\n'
+        'seconds_bucket{le="5"} 2\n'
+        'seconds_bucket{le="+Inf"} 3\n'
+        'seconds_sum 33.5\n'
+        'seconds_count 3\n'
+    )
+
+
+def test_label_values_are_escaped():
+    registry = Registry()
+    registry.register(Counter('errors_total', 'Errors.', ('message',))).inc('say "hi"\n')
+    assert 'errors_total{message="say \\"hi\\"\\n"} 1' in registry.render()
+
+
+def test_collected_metrics_are_read_when_rendered():
+    registry = Registry()
+    hits = {'pdf': 1}
+    registry.register(Collected('hits_total', 'Hits.', 'counter', ('cache',),
+                                lambda: {(name,): count for name, count in hits.items()}))
+    hits['pdf'] = 5
+    assert 'hits_total{cache="pdf"} 5' in registry.render()
+
+
+@pytest.fixture
+def directory(tmp_path):
+    return str(tmp_path)
+
+
+def test_metrics_of_other_processes_are_added(directory):
+    registry = make_registry(directory)
+    metric(registry, 'stamps_total').inc('pdf')
+    metric(registry, 'in_flight').set(1)
+    metric(registry, 'seconds').observe(0.5)
+
+    # Process 1 is always running
+    other = make_registry()
+    metric(other, 'stamps_total').inc('pdf', amount=2)
+    metric(other, 'stamps_total').inc('png')
+    metric(other, 'in_flight').set(2)
+    metric(other, 'seconds').observe(3)
+    save_as(other, 1, directory)
+
+    rendered = registry.render()
+    assert 'stamps_total{kind="pdf"} 3' in rendered
+    assert 'stamps_total{kind="png"} 1' in rendered
+    assert 'in_flight 3' in rendered
+    assert 'seconds_bucket{le="1"} 1' in rendered
+    assert 'seconds_count 2' in rendered
+
+
+def test_gauges_of_exited_processes_are_left_out(directory):
+    registry = make_registry(directory)
+    exited = make_registry()
+    metric(exited, 'stamps_total').inc('pdf', amount=4)
+    metric(exited, 'in_flight').set(7)
+    save_as(exited, EXITED_PID, directory)
+
+    rendered = registry.render()
+    assert 'stamps_total{kind="pdf"} 4' in rendered
+    assert not any(line.startswith('in_flight ') for line in rendered.splitlines())
+
+
+def test_retired_processes_keep_counting(directory):
+    registry = make_registry(directory)
+    for amount in (2, 3):
+        exited = make_registry()
+        metric(exited, 'stamps_total').inc('pdf', amount=amount)
+        metric(exited, 'seconds').observe(amount)
+        save_as(exited, EXITED_PID, directory)
+        registry.retire(EXITED_PID)
+
+    assert sorted(os.listdir(directory)) == ['exited.json']
+    rendered = registry.render()
+    assert 'stamps_total{kind="pdf"} 5' in rendered
+    assert 'seconds_count 2' in rendered
+
+
+def test_save_writes_this_processs_metrics(directory):
+    registry = make_registry(directory)
+    metric(registry, 'stamps_total').inc('pdf')
+    registry.save()
+    assert os.listdir(directory) == [f'{os.getpid()}.json']
+    # Its own file isn't added to its live values a second time
+    assert 'stamps_total{kind="pdf"} 1' in registry.render()
@@ -0,0 +1,68 @@
+import io
+
+import pytest
+from PyPDF2 import PdfReader
+from reportlab.pdfgen import canvas
+
+from stamp import PageSelection, stamp_pdf
+
+
+def selected(spec, page_count):
+    selection = PageSelection(spec)
+    return [index + 1 for index in range(page_count) if selection.includes(index, page_count)]
+
+
+@pytest.mark.parametrize('spec, pages', [
+    ('1', [1]),
+    ('3', [3]),
+    ('2-4', [2, 3, 4]),
+    ('5-', [5, 6, 7]),
+    ('1,3,7', [1, 3, 7]),
+    ('1-2,6-', [1, 2, 6, 7]),
+    ('first', [1]),
+    ('last', [7]),
+    ('odd', [1, 3, 5, 7]),
+    ('even', [2, 4, 6]),
+    ('all', [1, 2, 3, 4, 5, 6, 7]),
+    ('first,last', [1, 7]),
+    ('even,7', [2, 4, 6, 7]),
+    ('2-3,3-4', [2, 3, 4]),
+])
+def test_includes(spec, pages):
+    assert selected(spec, 7) == pages
+
+
+def test_spaces_and_case_are_ignored():
+    assert selected(' 1 - 2 , LAST ', 5) == [1, 2, 5]
+
+
+def test_pages_past_the_end_select_nothing():
+    assert selected('9', 7) == []
+    assert selected('6-12', 7) == [6, 7]
+
+
+def test_last_depends_on_the_page_count():
+    assert selected('last', 1) == [1]
+    assert selected('last', 3) == [3]
+
+
+@pytest.mark.parametrize('spec', ['0', '-3', '4-2', 'abc', '1-x', '', '1,,2', 'last-2', '1.5'])
+def test_invalid_specs_are_refused(spec):
+    with pytest.raises(ValueError):
+        PageSelection(spec)
+
+
+def test_only_selected_pages_are_stamped():
+    data = io.BytesIO()
+    can = canvas.Canvas(data, pagesize=(300, 400))
+    for _ in range(4):
+        can.showPage()
+    can.save()
+    file = io.BytesIO(data.getvalue())
+    file.filename = 'document.pdf'
+    output = io.BytesIO()
+    stamp_pdf(file, 'SELECTED', output=output, pages=PageSelection('2,last'))
+
+    pages = PdfReader(io.BytesIO(output.getvalue())).pages
+    assert len(pages) == 4
+    assert ['SELECTED' in page.extract_text() for page in pages] == [False, True, False, True]
@@ -0,0 +1,81 @@
+import io
+import time
+
+import pytest
+
+import results
+from conftest import make_pdf
+from results import delete_expired_results, find_result, result_key, store_result
+from stamp import stamp_pdf
+
+
+@pytest.fixture
+def storage(tmp_path, monkeypatch):
+    from storage import storage
+    monkeypatch.setattr(storage, 'root', str(tmp_path / 'downloads'))
+    monkeypatch.setattr(results, 'RESULTS_DIR', str(tmp_path / 'results'))
+    return storage
+
+
+def upload(data, filename='document.pdf'):
+    file = io.BytesIO(data)
+    file.filename = filename
+    return file
+
+
+def test_keys_depend_on_content_and_settings():
+    document = make_pdf()
+    key = result_key(stamp_pdf, upload(document, 'a.pdf'), ('DRAFT',), {'position': 'center'})
+    # The file name doesn't matter, the bytes do
+    assert key == result_key(stamp_pdf, upload(document, 'b.pdf'), ('DRAFT',), {'position': 'center'})
+    assert key != result_key(stamp_pdf, upload(make_pdf(2)), ('DRAFT',), {'position': 'center'})
+    assert key != result_key(stamp_pdf, upload(document), ('FINAL',), {'position': 'center'})
+    assert key != result_key(stamp_pdf, upload(document), ('DRAFT',), {'position': 'top-left'})
+    # The TTL is checked against the stored file instead
+    assert key == result_key(stamp_pdf, upload(document), ('DRAFT',), {'position': 'center', 'ttl': 600})
+
+
+def test_stored_results_are_found(storage):
+    name = storage.save(lambda output: output.write(b'stamped'), 'pdf')
+    store_result('ab' * 32, name)
+    assert find_result('ab' * 32) == name
+    assert find_result('cd' * 32) is None
+
+
+def test_results_expiring_too_soon_are_not_reused(storage):
+    name = storage.save(lambda output: output.write(b'stamped'), 'pdf', ttl=600)
+    store_result('ab' * 32, name)
+    assert find_result('ab' * 32, ttl=600) == name
+    # A request for a longer TTL needs a file that lives as long
+    assert find_result('ab' * 32, ttl=10 * storage.bucket_seconds) is None
+
+
+def test_results_of_evicted_files_are_forgotten(storage):
+    name = storage.save(lambda output: output.write(b'stamped'), 'pdf')
+    store_result('ab' * 32, name)
+    storage.delete(name)
+    assert find_result('ab' * 32) is None
+
+
+def test_expired_result_buckets_are_deleted(storage):
+    name = storage.save(lambda output: output.write(b'stamped'), 'pdf', ttl=600)
+    store_result('ab' * 32, name)
+    assert delete_expired_results(now=time.time()) == 0
+    assert delete_expired_results(now=storage.expires_at(name)) == 1
+    assert find_result('ab' * 32, ttl=0) is None
+
+
+def test_identical_requests_reuse_the_stamped_file(client):
+    document = make_pdf()
+
+    def stamp(text, **fields):
+        response = client.post('/api/stamp/text', data=dict(file=(io.BytesIO(document), 'document.pdf'),
+                                                            stamp=text, **fields))
+        assert response.status_code == 200
+        return response.get_json()['download_link']
+
+    first = stamp('DRAFT')
+    assert stamp('DRAFT') == first
+    assert stamp('FINAL') != first
+    # Kept longer than the first file stays downloadable
+    assert stamp('DRAFT', ttl=str(7 * 24 * 3600)) != first
@@ -0,0 +1,124 @@
+import math
+import time
+
+import pytest
+
+from expiry import ExpiryScheduler
+from storage import LocalStorage, MemoryStorage, ttl_option
+
+BUCKET_SECONDS = 3600
+
+
+@pytest.fixture(autouse=True)
+def index_dirs(tmp_path, monkeypatch):
+    # The expiry sweep also tidies up result entries and job statuses
+    import jobs
+    import results
+    monkeypatch.setattr(results, 'RESULTS_DIR', str(tmp_path / 'results'))
+    monkeypatch.setattr(jobs, 'JOBS_DIR', str(tmp_path / 'jobs'))
+
+
+@pytest.fixture(params=['local', 'memory'])
+def storage(request, tmp_path):
+    if request.param == 'local':
+        return LocalStorage(str(tmp_path / 'downloads'), BUCKET_SECONDS)
+    return MemoryStorage(BUCKET_SECONDS)
+
+
+def write(data):
+    return lambda output: output.write(data)
+
+
+def test_names_carry_the_expiry_bucket(storage):
+    before = time.time()
+    name = storage.save(write(b'data'), 'pdf', ttl=7200)
+    bucket, rest = name.split('_')
+    assert rest.endswith('.pdf')
+    assert int(bucket) == math.ceil((before + 7200) / BUCKET_SECONDS)
+    # A file expires no sooner than its TTL and at most a bucket later
+    assert before + 7200 <= storage.expires_at(name) < time.time() + 7200 + BUCKET_SECONDS
+
+
+def test_stored_files_can_be_read_back(storage):
+    name = storage.save(write(b'stamped'), 'png')
+    with storage.open(name) as stored_file:
+        assert stored_file.read() == b'stamped'
+    assert storage.size(name) == 7
+    assert storage.exists(name)
+
+
+def test_expired_files_are_not_served(storage):
+    name = storage.save(write(b'data'), 'pdf', ttl=60)
+    later = storage.expires_at(name)
+    assert not storage.expired(name)
+    assert storage.expired(name, now=later)
+
+
+@pytest.mark.parametrize('name', ['../etc/passwd', 'report.pdf', '123_abc.pdf'])
+def test_invalid_names_are_not_found(storage, name):
+    with pytest.raises(FileNotFoundError):
+        storage.open(name)
+
+
+def test_delete_expired_removes_only_expired_buckets(storage):
+    short = storage.save(write(b'a'), 'pdf', ttl=60)
+    long = storage.save(write(b'b'), 'pdf', ttl=5 * BUCKET_SECONDS)
+    storage.delete_expired(now=storage.expires_at(short))
+    assert storage.bucket_files(short.split('_')[0]) == []
+    assert storage.exists(long)
+
+
+def test_etag_is_the_content_hash(storage):
+    first = storage.save(write(b'same'), 'pdf')
+    second = storage.save(write(b'same'), 'pdf')
+    other = storage.save(write(b'other'), 'pdf')
+    assert storage.etag(first) == storage.etag(second) != storage.etag(other)
+
+
+def test_delete_reports_the_bytes_freed(storage):
+    name = storage.save(write(b'x' * 100), 'pdf')
+    assert storage.used_bytes() == 100
+    assert storage.delete(name) == 100
+    assert storage.delete(name) == 0
+    assert storage.used_bytes() == 0
+
+
+@pytest.mark.parametrize('ttl, expected', [(None, None), ('', None), ('60', 60), (3600, 3600)])
+def test_ttl_option(ttl, expected):
+    assert ttl_option(ttl) == expected
+
+
+@pytest.mark.parametrize('ttl', ['soon', 59, 10 ** 9])
+def test_ttl_option_rejects_invalid_values(ttl):
+    with pytest.raises(ValueError):
+        ttl_option(ttl)
+
+
+def test_sweep_deletes_expired_files(storage):
+    expired = storage.save(write(b'a'), 'pdf', ttl=60)
+    kept = storage.save(write(b'b'), 'pdf', ttl=5 * BUCKET_SECONDS)
+    scheduler = ExpiryScheduler(storage, batch_pause=0)
+    scheduler.sweep(now=storage.expires_at(expired))
+    assert not storage.exists(expired)
+    assert storage.exists(kept)
+    assert scheduler.stats()['expired'] == 1
+
+
+def test_eviction_deletes_soonest_expiring_files_down_to_the_low_water_mark(storage):
+    storage.max_bytes = 1000
+    names = [storage.save(write(b'x' * 100), 'pdf', ttl=(index + 1) * BUCKET_SECONDS) for index in range(10)]
+    scheduler = ExpiryScheduler(storage, batch_size=1, batch_pause=0, high_water=0.9, low_water=0.5)
+    assert scheduler.evict() == 5
+    assert [storage.exists(name) for name in names] == [False] * 5 + [True] * 5
+    # Below the high-water mark nothing is evicted
+    assert scheduler.evict() == 0
+
+
+def test_eviction_counts_only_stored_files(tmp_path):
+    # Without a budget, other data on the disk leaves the downloads alone
+    storage = LocalStorage(str(tmp_path / 'downloads'), BUCKET_SECONDS)
+    name = storage.save(write(b'x' * 100), 'pdf')
+    used, budget = storage.usage()
+    assert used == 100 and budget > used
+    assert ExpiryScheduler(storage, high_water=0.9, low_water=0.8).evict() == 0
+    assert storage.exists(name)
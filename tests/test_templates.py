@@ -0,0 +1,77 @@
+import base64
+import io
+import pickle
+
+import pytest
+from PIL import Image
+
+from conftest import make_pdf
+from stamp_templates import delete_template, register_template
+
+
+def stamp_png():
+    data = io.BytesIO()
+    Image.new('RGB', (60, 40), 'red').save(data, 'PNG')
+    return data.getvalue()
+
+
+@pytest.fixture
+def template_id(client):
+    response = client.post('/api/templates', json={'stamp_image': base64.b64encode(stamp_png()).decode(),
+                                                   'signer_text_message': 'Approved', 'position': 'top-right'})
+    assert response.status_code == 201
+    return response.get_json()['template_id']
+
+
+def test_templates_are_created_from_forms(client):
+    response = client.post('/api/templates', data={'stamp_image': (io.BytesIO(stamp_png()), 'stamp.png'),
+                                                   'position': 'bottom-left'})
+    assert response.status_code == 201
+    body = response.get_json()
+    assert body['template']['template_id'] == body['template_id']
+    assert body['template']['position'] == 'bottom-left'
+
+
+def test_templates_are_shown_and_deleted(client, template_id):
+    response = client.get(f'/api/templates/{template_id}')
+    assert response.status_code == 200
+    assert response.get_json()['template']['signer_text'] == 'Approved'
+
+    assert client.delete(f'/api/templates/{template_id}').status_code == 200
+    assert client.get(f'/api/templates/{template_id}').status_code == 404
+    assert client.delete(f'/api/templates/{template_id}').status_code == 404
+
+
+def test_templates_need_a_stamp_image(client):
+    for response in (client.post('/api/templates', json={'position': 'center'}),
+                     client.post('/api/templates', data={'position': 'center'})):
+        assert response.status_code == 400
+        assert response.get_json()['message'] == 'No stamp image'
+
+
+def test_invalid_stamp_images_are_refused(client):
+    assert client.post('/api/templates', json={'stamp_image': 'not base64!'}).status_code == 400
+    response = client.post('/api/templates', json={'stamp_image': base64.b64encode(b'not an image').decode()})
+    assert response.status_code == 400
+    assert response.get_json()['message'] == 'Invalid stamp template'
+
+
+def test_documents_are_stamped_with_a_template(client, template_id):
+    response = client.post('/api/stamp/image', data={'file': (io.BytesIO(make_pdf()), 'document.pdf'),
+                                                     'template_id': template_id})
+    assert response.status_code == 200
+    download = '/download/' + response.get_json()['download_link'].rsplit('/', 1)[1]
+    assert client.get(download).data.startswith(b'%PDF')
+
+    response = client.post('/api/stamp/image', data={'file': (io.BytesIO(make_pdf()), 'document.pdf'),
+                                                     'template_id': 'ab' * 16})
+    assert response.status_code == 404
+
+
+def test_pickled_templates_outlive_their_deletion(client):
+    template = register_template(stamp_png(), signer_text='Approved', position='top-left')
+    data = pickle.dumps(template)
+    delete_template(template.template_id)
+    restored = pickle.loads(data)
+    assert restored is not template
+    assert restored.to_dict() == template.to_dict()
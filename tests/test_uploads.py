@@ -0,0 +1,72 @@
+import base64
+import io
+import os
+
+import pytest
+from werkzeug.exceptions import RequestEntityTooLarge
+
+from uploads import Base64Decoder, spool_stream
+
+DATA = os.urandom(1000)
+
+
+def decode_in_chunks(encoded, size, max_bytes=10_000):
+    output = io.BytesIO()
+    decoder = Base64Decoder(output, max_bytes)
+    for start in range(0, len(encoded), size):
+        decoder.feed(encoded[start:start + size])
+    decoder.finish()
+    return output.getvalue()
+
+
+@pytest.mark.parametrize('size', [1, 2, 3, 4, 5, 7, 64, 1001, 5000])
+def test_decodes_chunks_of_any_size(size):
+    assert decode_in_chunks(base64.b64encode(DATA), size) == DATA
+
+
+@pytest.mark.parametrize('length', [1, 2, 3, 4, 5])
+def test_missing_padding_is_tolerated(length):
+    encoded = base64.b64encode(DATA[:length]).rstrip(b'=')
+    assert decode_in_chunks(encoded, 3) == DATA[:length]
+
+
+def test_padding_is_accepted():
+    encoded = base64.b64encode(DATA[:4])
+    assert encoded.endswith(b'==')
+    assert decode_in_chunks(encoded, 2) == DATA[:4]
+
+
+def test_whitespace_is_ignored():
+    encoded = base64.encodebytes(DATA).replace(b'\n', b'\r\n ')
+    assert decode_in_chunks(encoded, 10) == DATA
+
+
+def test_size_is_counted():
+    decoder = Base64Decoder(io.BytesIO())
+    decoder.feed(base64.b64encode(DATA))
+    decoder.finish()
+    assert decoder.size == len(DATA)
+
+
+def test_over_max_bytes_is_refused():
+    with pytest.raises(RequestEntityTooLarge):
+        decode_in_chunks(base64.b64encode(DATA), 100, max_bytes=len(DATA) - 1)
+
+
+def test_exactly_max_bytes_is_accepted():
+    assert decode_in_chunks(base64.b64encode(DATA), 100, max_bytes=len(DATA)) == DATA
+
+
+def test_spool_stream_copies_raw_body():
+    spool = spool_stream(io.BytesIO(DATA))
+    assert spool.read() == DATA
+
+
+def test_spool_stream_decodes_base64_body():
+    spool = spool_stream(io.BytesIO(base64.b64encode(DATA)), base64_encoded=True)
+    assert spool.read() == DATA
+
+
+def test_spool_stream_refuses_large_body():
+    with pytest.raises(RequestEntityTooLarge):
+        spool_stream(io.BytesIO(DATA), max_bytes=len(DATA) - 1)
@@ -0,0 +1,89 @@
+import base64
+import os
+import tempfile
+from werkzeug.exceptions import RequestEntityTooLarge
+
+# Largest document accepted, checked before the body is buffered
+MAX_UPLOAD_BYTES = int(os.getenv('MAX_UPLOAD_BYTES', 100 * 1024 * 1024))
+# Largest request body accepted (base64 JSON is a third larger than the document)
+MAX_REQUEST_BYTES = int(os.getenv('MAX_REQUEST_BYTES', MAX_UPLOAD_BYTES * 4 // 3 + 1024 * 1024))
+# Uploads larger than this are spooled to a temporary file instead of memory
+SPOOL_MAX_MEMORY = int(os.getenv('UPLOAD_SPOOL_BYTES', 8 * 1024 * 1024))
+# Read size for request bodies; a multiple of 4 so base64 chunks decode cleanly
+READ_CHUNK_SIZE = 1024 * 1024
+
+RAW_UPLOAD_MIMETYPES = ('application/pdf', 'image/png', 'image/jpeg')
+
+
+def new_spool():
+    return tempfile.SpooledTemporaryFile(max_size=SPOOL_MAX_MEMORY)
+
+
+class Base64Decoder:
+    """Incrementally decode base64 into a file object.
+
+    Input can arrive in chunks of any size; whitespace is ignored and missing
+    padding is tolerated, like ``decode_base64`` in app.py.
+    """
+
+    def __init__(self, output, max_bytes=MAX_UPLOAD_BYTES):
+        self.output = output
+        self.max_bytes = max_bytes
+        self.size = 0
+        self._pending = b''
+
+    def feed(self, chunk):
+        chunk = self._pending + b''.join(chunk.split())
+        usable = len(chunk) - len(chunk) % 4
+        self._pending = chunk[usable:]
+        if usable:
+            self._write(base64.b64decode(chunk[:usable]))
+
+    def finish(self):
+        if self._pending:
+            self._write(base64.b64decode(self._pending + b'=' * (4 - len(self._pending) % 4)))
+            self._pending = b''
+
+    def _write(self, data):
+        self.size += len(data)
+        if self.size > self.max_bytes:
+            raise RequestEntityTooLarge()
+        self.output.write(data)
+
+
+def spool_stream(stream, base64_encoded=False, max_bytes=MAX_UPLOAD_BYTES):
+    """Copy a request body into a spooled file without holding it all in memory.
+
+    Returns the file positioned at the start. Raises RequestEntityTooLarge as
+    soon as the (decoded) body goes over ``max_bytes``.
+    """
+    spool = new_spool()
+    decoder = Base64Decoder(spool, max_bytes) if base64_encoded else None
+    size = 0
+    while True:
+        chunk = stream.read(READ_CHUNK_SIZE)
+        if not chunk:
+            break
+        if decoder is not None:
+            decoder.feed(chunk)
+            continue
+        size += len(chunk)
+        if size > max_bytes:
+            raise RequestEntityTooLarge()
+        spool.write(chunk)
+
+    if decoder is not None:
+        decoder.finish()
+    spool.seek(0)
+    return spool
+
+
+def spool_base64(data, max_bytes=MAX_UPLOAD_BYTES):
+    """Decode a base64 string chunk by chunk into a spooled file."""
+    spool = new_spool()
+    decoder = Base64Decoder(spool, max_bytes)
+    for start in range(0, len(data), READ_CHUNK_SIZE):
+        decoder.feed(data[start:start + READ_CHUNK_SIZE].encode('ascii'))
+    decoder.finish()
+    spool.seek(0)
+    return spool
@@ -0,0 +1,9 @@
+"""Production entry point, e.g. ``gunicorn wsgi:app`` (settings in gunicorn.conf.py)."""
+from dotenv import load_dotenv
+
+# Settings are read when the modules are imported, so .env is loaded first
+load_dotenv()
+
+from app import create_app  # noqa: E402
+
+app = create_app()